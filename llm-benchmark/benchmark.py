@@ -3,8 +3,8 @@ import argparse
 import json
 import os
 import subprocess
+import sys
 import time
-import urllib.error
 import urllib.request
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from dataclasses import dataclass
@@ -12,6 +12,13 @@ from datetime import datetime, timezone
 from pathlib import Path
 from typing import Any, Dict, List, Tuple
 
+SCRIPTS_DIR = Path(__file__).resolve().parent.parent / "scripts"
+if str(SCRIPTS_DIR) not in sys.path:
+    sys.path.insert(0, str(SCRIPTS_DIR))
+
+import training_pack_course_index as course_index  # noqa: E402
+import training_pack_llm_client as llm_client  # noqa: E402
+
 
 @dataclass
 class TaskSpec:
@@ -30,59 +37,12 @@ def write_json(path: Path, payload: Any):
     path.write_text(json.dumps(payload, ensure_ascii=False, indent=2), encoding="utf-8")
 
 
-def read_final_json(chapter_dir: Path):
-    for name in ("05-final.json", "04-final.json"):
-        p = chapter_dir / name
-        if p.exists():
-            return read_json(p)
-    return None
-
-
-def load_chapters(course_root: Path):
-    chapters_dir = course_root / "chapters"
-    chapter_dirs = [p for p in chapters_dir.iterdir() if p.is_dir()]
-    chapter_dirs.sort()
-    out = []
-    for idx, chapter_dir in enumerate(chapter_dirs, start=1):
-        chapter = read_final_json(chapter_dir)
-        if not chapter or not chapter.get("id"):
-            continue
-        chapter["__index"] = idx
-        out.append(chapter)
-    return out
-
-
-def theory_blocks(chapter: dict):
-    out = []
-    for b in chapter.get("blocks", []):
-        if not isinstance(b, dict) or b.get("type") != "theory" or not b.get("id"):
-            continue
-        theory = b.get("theory", {}) if isinstance(b.get("theory"), dict) else {}
-        out.append(
-            {
-                "index": len(out) + 1,
-                "id": b["id"],
-                "chapter_id": chapter.get("id"),
-                "title": b.get("title", ""),
-                "concept_id": theory.get("concept_id", ""),
-                "content_md": theory.get("content_md", ""),
-                "key_points": theory.get("key_points", []),
-                "common_mistakes": theory.get("common_mistakes", []),
-                "examples": theory.get("examples", []),
-            }
-        )
-    return out
-
-
-def find_block(course_root: Path, chapter_number: int, block_number: int):
-    chapters = load_chapters(course_root)
-    for chapter in chapters:
-        if int(chapter.get("__index", 0)) != chapter_number:
-            continue
-        for block in theory_blocks(chapter):
-            if int(block["index"]) == block_number:
-                return chapter, block
-    raise ValueError(f"Block not found: chapter={chapter_number}, block={block_number}")
+def find_block(course: course_index.CourseIndex, chapter_number: int, block_number: int):
+    found = course.block(chapter_number, block_number)
+    if found is None:
+        raise ValueError(f"Block not found: chapter={chapter_number}, block={block_number}")
+    chapter, block = found
+    return chapter, course.block_spec(chapter["id"], block["id"])
 
 
 def load_system_prompt(course_root: Path):
@@ -106,42 +66,9 @@ def build_prompt(system_prompt: str, block: dict, count: int):
     )
 
 
-def _openai_chat_generate(base_url: str, model: str, prompt: str, timeout_s: int, api_key: str):
-    base = base_url.rstrip("/")
-    body = json.dumps(
-        {
-            "model": model,
-            "messages": [{"role": "user", "content": prompt}],
-            "temperature": 0.3,
-            "stream": False,
-        }
-    ).encode("utf-8")
-    headers = {"Content-Type": "application/json"}
-    if api_key:
-        headers["Authorization"] = f"Bearer {api_key}"
-    req = urllib.request.Request(f"{base}/v1/chat/completions", data=body, headers=headers, method="POST")
-    with urllib.request.urlopen(req, timeout=timeout_s) as resp:
-        payload = json.loads(resp.read().decode("utf-8"))
-    content = payload.get("choices", [{}])[0].get("message", {}).get("content", "[]")
-    return content, "openai-compatible"
-
-
-def _ollama_generate(base_url: str, model: str, prompt: str, timeout_s: int):
-    base = base_url.rstrip("/")
-    body = json.dumps({"model": model, "prompt": prompt, "stream": False}).encode("utf-8")
-    req = urllib.request.Request(f"{base}/api/generate", data=body, headers={"Content-Type": "application/json"}, method="POST")
-    with urllib.request.urlopen(req, timeout=timeout_s) as resp:
-        payload = json.loads(resp.read().decode("utf-8"))
-    return payload.get("response", "[]"), "ollama"
-
-
-def llm_generate(base_url: str, model: str, prompt: str, timeout_s: int, api_key: str):
-    try:
-        return _openai_chat_generate(base_url, model, prompt, timeout_s, api_key)
-    except urllib.error.HTTPError as e:
-        if e.code not in (404, 405):
-            raise
-    return _ollama_generate(base_url, model, prompt, timeout_s)
+def llm_generate(client: llm_client.LLMClient, prompt: str):
+    text, stats = client.generate(prompt)
+    return text or "[]", client.backend or llm_client.BACKEND_OLLAMA, stats
 
 
 def run_shell(command: str, check: bool = True):
@@ -194,19 +121,24 @@ def parse_question_count(raw_text: str) -> Tuple[int, str]:
     return len(parsed), ""
 
 
-def run_one_task(course_root: Path, system_prompt: str, scenario: dict, task: TaskSpec):
-    chapter, block = find_block(course_root, task.chapter_number, task.block_number)
+def scenario_client(scenario: dict) -> llm_client.LLMClient:
+    return llm_client.LLMClient(
+        str(scenario["base_url"]),
+        str(scenario["model"]),
+        api_key=str(scenario.get("api_key", "")).strip(),
+        timeout_s=int(scenario.get("timeout_s", 900)),
+        temperature=0.3,
+        stream=bool(scenario.get("stream", False)),
+        max_idle_connections=int(scenario.get("workers", 4)),
+    )
+
+
+def run_one_task(course: course_index.CourseIndex, system_prompt: str, client: llm_client.LLMClient, task: TaskSpec):
+    chapter, block = find_block(course, task.chapter_number, task.block_number)
     prompt = build_prompt(system_prompt, block, task.question_count)
-    api_key = str(scenario.get("api_key", "")).strip()
     t0 = time.perf_counter()
     try:
-        raw, backend = llm_generate(
-            base_url=str(scenario["base_url"]),
-            model=str(scenario["model"]),
-            prompt=prompt,
-            timeout_s=int(scenario.get("timeout_s", 900)),
-            api_key=api_key,
-        )
+        raw, backend, stats = llm_generate(client, prompt)
         latency = time.perf_counter() - t0
         count, parse_error = parse_question_count(raw)
         ok = parse_error == ""
@@ -222,6 +154,8 @@ def run_one_task(course_root: Path, system_prompt: str, scenario: dict, task: Ta
             "ok": ok,
             "error": parse_error,
             "backend": backend,
+            "ttft_s": stats.as_dict()["ttft_s"],
+            "tokens_per_s": stats.as_dict()["tokens_per_s"],
         }
     except Exception as e:
         latency = time.perf_counter() - t0
@@ -238,7 +172,7 @@ def run_one_task(course_root: Path, system_prompt: str, scenario: dict, task: Ta
         }
 
 
-def run_scenario(course_root: Path, system_prompt: str, scenario: dict, tasks: List[TaskSpec]):
+def run_scenario(course: course_index.CourseIndex, system_prompt: str, scenario: dict, tasks: List[TaskSpec]):
     mode = str(scenario.get("mode", "sequential")).strip().lower()
     workers = int(scenario.get("workers", 4))
     start = 0.0
@@ -249,6 +183,7 @@ def run_scenario(course_root: Path, system_prompt: str, scenario: dict, tasks: L
         flush=True,
     )
     setup_error = ""
+    client = scenario_client(scenario)
     try:
         try:
             setup_scenario_runtime(scenario)
@@ -265,7 +200,7 @@ def run_scenario(course_root: Path, system_prompt: str, scenario: dict, tasks: L
                             f"  -> queued {t.task_id}: chapter={t.chapter_number}, block={t.block_number}, n={t.question_count}",
                             flush=True,
                         )
-                        fut = ex.submit(run_one_task, course_root, system_prompt, scenario, t)
+                        fut = ex.submit(run_one_task, course, system_prompt, client, t)
                         futs[fut] = t
                     done_count = 0
                     for fut in as_completed(futs):
@@ -285,7 +220,7 @@ def run_scenario(course_root: Path, system_prompt: str, scenario: dict, tasks: L
                         f"n={t.question_count} ({i}/{len(tasks)})",
                         flush=True,
                     )
-                    r = run_one_task(course_root, system_prompt, scenario, t)
+                    r = run_one_task(course, system_prompt, client, t)
                     rows.append(r)
                     status = "ok" if r.get("ok") else "fail"
                     print(
@@ -310,6 +245,7 @@ def run_scenario(course_root: Path, system_prompt: str, scenario: dict, tasks: L
                     }
                 )
     finally:
+        client.close()
         teardown_scenario_runtime(scenario)
     elapsed = time.perf_counter() - start
     rows.sort(key=lambda r: r["task_id"])
@@ -358,13 +294,15 @@ def render_summary_md(results: List[dict], started_at: str):
     for r in results:
         lines.append(f"### {r['name']}")
         lines.append("")
-        lines.append("| Task | Ch/Block | Latency (s) | Questions | Status | Error |")
-        lines.append("|---|---:|---:|---:|---:|---|")
+        lines.append("| Task | Ch/Block | Latency (s) | TTFT (s) | tok/s | Questions | Status | Error |")
+        lines.append("|---|---:|---:|---:|---:|---:|---:|---|")
         for row in r["rows"]:
             st = "ok" if row.get("ok") else "fail"
             err = str(row.get("error", "")).replace("|", "\\|")
+            ttft = row.get("ttft_s") if row.get("ttft_s") is not None else "-"
+            tps = row.get("tokens_per_s") if row.get("tokens_per_s") is not None else "-"
             lines.append(
-                f"| `{row['task_id']}` | {row.get('chapter_number')}/{row.get('block_number')} | {row['latency_s']} | {row['questions_returned']} | {st} | {err} |"
+                f"| `{row['task_id']}` | {row.get('chapter_number')}/{row.get('block_number')} | {row['latency_s']} | {ttft} | {tps} | {row['questions_returned']} | {st} | {err} |"
             )
         if r.get("note"):
             lines.append("")
@@ -405,10 +343,11 @@ def main():
 
     started_at = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
     system_prompt = load_system_prompt(course_root)
+    course = course_index.load_course_index(course_root)
     results = []
     for sc in scenarios:
         print(f"\n=== Scenario: {sc['name']} ({sc.get('mode', 'sequential')}) ===", flush=True)
-        r = run_scenario(course_root, system_prompt, sc, tasks)
+        r = run_scenario(course, system_prompt, sc, tasks)
         print(
             f"done: time={r['elapsed_s']}s, ok={r['tasks_ok']}/{r['tasks_total']}, "
             f"questions={r['questions_total']}, qps={r['questions_per_sec']}",
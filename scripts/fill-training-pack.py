@@ -1,14 +1,25 @@
 #!/usr/bin/env python3
 import argparse
-import hashlib
-import json
+import contextlib
+import importlib.util
 import os
 import re
-import subprocess
 import sys
-from datetime import datetime
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timezone
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict
+
+SCRIPTS_DIR = Path(__file__).resolve().parent
+if str(SCRIPTS_DIR) not in sys.path:
+    sys.path.insert(0, str(SCRIPTS_DIR))
+
+import training_pack_fill_scheduler as fill_scheduler  # noqa: E402
+import training_pack_leases as block_leases  # noqa: E402
+import training_pack_progress as progress_store  # noqa: E402
+import training_pack_tokens as tokens  # noqa: E402
+from training_pack_signatures import question_signature  # noqa: E402
 
 
 ANSI_RESET = "\033[0m"
@@ -32,22 +43,10 @@ def log_color(message: str, color: str = ""):
         print(f"{ts}: {message}", flush=True)
 
 
-def summarize_validation_errors(course_root: Path, chapter_id: str, block_id: str):
-    report_path = course_root / "training_pack" / "reports" / "validation-report.json"
-    if not report_path.exists():
-        log_color("    - validation-report.json не найден", ANSI_YELLOW)
-        return
-    try:
-        report = read_json(report_path)
-    except Exception as e:
-        log_color(f"    - не удалось прочитать validation-report: {e}", ANSI_YELLOW)
-        return
-
-    chapters = report.get("chapters", {})
-    chapter_report = chapters.get(chapter_id, {}) if isinstance(chapters, dict) else {}
-    errs = chapter_report.get("errors", []) if isinstance(chapter_report, dict) else []
+def summarize_validation_errors(block_report: dict, block_id: str):
+    errs = block_report.get("errors", []) if isinstance(block_report, dict) else []
     if not errs:
-        log_color("    - явных ошибок по главе в validation-report нет", ANSI_YELLOW)
+        log_color("    - явных ошибок по блоку нет", ANSI_YELLOW)
         return
 
     printed = 0
@@ -66,121 +65,19 @@ def summarize_validation_errors(course_root: Path, chapter_id: str, block_id: st
                 printed += 1
         if printed >= 8:
             break
-    if printed == 0:
-        log_color("    - детальные причины см. training_pack/reports/validation-report.json", ANSI_YELLOW)
-
-
-def read_json(path: Path):
-    return json.loads(path.read_text(encoding="utf-8"))
-
-
-def write_json(path: Path, data):
-    path.write_text(json.dumps(data, ensure_ascii=False, indent=2) + "\n", encoding="utf-8")
-
-
-def normalize_text(v):
-    if v is None:
-        return ""
-    t = str(v).strip().lower()
-    t = re.sub(r"[\"'`´«»„“”‘’‚‛‹›]", "", t)
-    return " ".join(t.split())
-
-
-def has_cyrillic(text: str) -> bool:
-    for ch in text:
-        code = ord(ch)
-        if 0x0400 <= code <= 0x04FF:
-            return True
-    return False
-
-
-def question_signature(q: dict) -> str:
-    correct_answer_id = q.get("correct_answer")
-    correct_answer_text = ""
-    choices = q.get("choices")
-    if isinstance(choices, list) and correct_answer_id is not None:
-        for c in choices:
-            if isinstance(c, dict) and c.get("id") == correct_answer_id:
-                correct_answer_text = c.get("text", "")
-                break
-    if not normalize_text(correct_answer_text):
-        correct_answer_text = correct_answer_id
-    parts = [
-        normalize_text(q.get("prompt")),
-        normalize_text(correct_answer_text),
-        normalize_text(q.get("theory_block_id")),
-        normalize_text(q.get("type")),
-    ]
-    return hashlib.sha256("|".join(parts).encode("utf-8")).hexdigest()[:16]
-
 
-def dedupe_choice_texts_keep_correct(q: dict) -> int:
-    choices = q.get("choices")
-    if not isinstance(choices, list) or not choices:
-        return 0
-    correct_id = q.get("correct_answer")
-    groups = {}
-    for idx, c in enumerate(choices):
-        if not isinstance(c, dict):
-            continue
-        key = normalize_text(c.get("text", ""))
-        groups.setdefault(key, []).append(idx)
-    to_remove = set()
-    for _, idxs in groups.items():
-        if len(idxs) <= 1:
-            continue
-        keep_idx = idxs[0]
-        for i in idxs:
-            c = choices[i] if i < len(choices) else {}
-            if isinstance(c, dict) and c.get("id") == correct_id:
-                keep_idx = i
-                break
-        for i in idxs:
-            if i != keep_idx:
-                to_remove.add(i)
-    if not to_remove:
-        return 0
-    q["choices"] = [c for i, c in enumerate(choices) if i not in to_remove]
-    return len(to_remove)
 
-
-def renumber_question_ids(questions: List[dict]):
-    idx = 1
-    for q in questions:
-        if isinstance(q, dict):
-            q["id"] = f"q{idx}"
-            idx += 1
-
-
-def read_final_json(chapter_dir: Path):
-    for name in ("05-final.json", "04-final.json"):
-        p = chapter_dir / name
-        if p.exists():
-            return read_json(p)
-    return None
-
-
-def load_chapters(course_root: Path):
-    chapters_dir = course_root / "chapters"
-    chapter_dirs = [p for p in chapters_dir.iterdir() if p.is_dir()]
-    chapter_dirs.sort()
-    out = []
-    for idx, chapter_dir in enumerate(chapter_dirs, start=1):
-        chapter = read_final_json(chapter_dir)
-        if not chapter or not chapter.get("id"):
-            continue
-        chapter["__index"] = idx
-        out.append(chapter)
-    return out
+def load_generator_module():
+    # generate-training-pack.py is not importable by name (dash in filename), load it by path.
+    path = Path(__file__).resolve().parent / "generate-training-pack.py"
+    spec = importlib.util.spec_from_file_location("generate_training_pack", path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
 
 
-def theory_blocks(chapter: dict):
-    out = []
-    for b in chapter.get("blocks", []):
-        if not isinstance(b, dict) or b.get("type") != "theory" or not b.get("id"):
-            continue
-        out.append({"index": len(out) + 1, "id": b["id"]})
-    return out
+gen = load_generator_module()
 
 
 def load_env_local(course_root: Path) -> Dict[str, str]:
@@ -203,52 +100,7 @@ def load_env_local(course_root: Path) -> Dict[str, str]:
     return env
 
 
-def find_block_pack_file(pack_dir: Path, chapter_id: str, block_id: str, lang: str) -> Path | None:
-    idx_path = pack_dir / "index.json"
-    if idx_path.exists():
-        idx = read_json(idx_path)
-        rel = idx.get("blocks", {}).get(f"{chapter_id}::{block_id}")
-        if rel:
-            p = pack_dir / "chapters" / rel
-            if p.exists():
-                return p
-    candidates = sorted((pack_dir / "chapters").glob(f"*/{lang}.*.{block_id}.questions.json"))
-    return candidates[-1] if candidates else None
-
-
-def is_valid_question_for_block(q: dict, chapter_id: str, block_id: str) -> bool:
-    if not isinstance(q, dict):
-        return False
-    if q.get("type") != "mcq_single":
-        return False
-    if q.get("chapter_id") != chapter_id:
-        return False
-    if q.get("theory_block_id") != block_id:
-        return False
-    if not has_cyrillic(str(q.get("prompt", ""))):
-        return False
-    if not has_cyrillic(str(q.get("explanation", ""))):
-        return False
-    choices = q.get("choices")
-    if not isinstance(choices, list) or len(choices) < 2 or len(choices) > 4:
-        return False
-    allowed = {"a", "b", "c", "d"}
-    ids = []
-    for c in choices:
-        if not isinstance(c, dict):
-            return False
-        if not c.get("id") or not str(c.get("text", "")).strip():
-            return False
-        ids.append(c["id"])
-    if len(set(ids)) != len(ids):
-        return False
-    if not set(ids).issubset(allowed):
-        return False
-    return q.get("correct_answer") in ids
-
-
-def recalc_signatures_and_dedupe_block_file(cp: Path) -> int:
-    payload = read_json(cp)
+def recalc_signatures_and_dedupe_payload(payload: dict) -> int:
     questions = payload.get("questions", [])
     if not isinstance(questions, list):
         return 0
@@ -259,7 +111,7 @@ def recalc_signatures_and_dedupe_block_file(cp: Path) -> int:
         if not isinstance(q, dict):
             removed += 1
             continue
-        dedupe_choice_texts_keep_correct(q)
+        gen.dedupe_choice_texts_keep_correct(q)
         choices = q.get("choices")
         if not isinstance(choices, list) or len(choices) < 2 or len(choices) > 4:
             removed += 1
@@ -286,41 +138,102 @@ def recalc_signatures_and_dedupe_block_file(cp: Path) -> int:
         kept.append(q)
     if removed > 0:
         payload["questions"] = kept
-        renumber_question_ids(payload["questions"])
-        write_json(cp, payload)
+        gen.renumber_question_ids(payload["questions"])
     return removed
 
 
-def count_valid_for_block(course_root: Path, chapter_id: str, block_id: str, lang: str) -> int:
-    pack_dir = course_root / "training_pack"
-    cp = find_block_pack_file(pack_dir, chapter_id, block_id, lang)
-    if cp is None:
+def count_valid_for_block(engine, chapter: dict, block: dict, repaired: set) -> int:
+    """Valid questions of the block from its summary in the signature index (no question JSON parsing)."""
+    summary = engine.block_summary(chapter, block)
+    if summary is None:
         return 0
-    recalc_signatures_and_dedupe_block_file(cp)
-    payload = read_json(cp)
-    cnt = 0
-    for q in payload.get("questions", []):
-        if is_valid_question_for_block(q, chapter_id, block_id):
-            cnt += 1
-    return cnt
-
-
-def run_generator(course_root: Path, env: Dict[str, str], chapter_number: int, block_number: int, batch_size: int) -> int:
-    cmd = [
-        "python3",
-        "scripts/generate-training-pack.py",
-        "--course-root",
-        str(course_root),
-        "--chapter-number",
-        str(chapter_number),
-        "--block-number",
-        str(block_number),
-        "--questions-per-block",
-        str(batch_size),
-        "--append",
-    ]
-    proc = subprocess.run(cmd, cwd=str(course_root), env=env)
-    return proc.returncode
+    bkey = f"{chapter['id']}::{block['id']}"
+    if summary["questions"] > summary["valid"] and bkey not in repaired:
+        # Duplicates or broken questions left by older runs or hand edits: clean the file once.
+        repaired.add(bkey)
+        if recalc_signatures_and_dedupe_payload(engine.block_payload(chapter, block)) > 0:
+            engine.write_block(chapter, block)
+            summary = engine.block_summary(chapter, block)
+    return summary["valid"]
+
+
+def finish_round(engine, scheduler, progress, leases, state, fut, prepared: tuple, started_at: float, repaired: set):
+    chapter, block = state.chapter, state.block
+    block_idx = int(block["index"])
+    label = f"Глава {chapter.get('__index')}, блок {block_idx}"
+    target_valid = scheduler.target_valid
+    before = state.valid
+    result = None
+    try:
+        result = fut.result()
+    except Exception as e:
+        log_color(f"    ✗ {label}: {e}", ANSI_RED)
+        engine.drop_block_claims(chapter, block)
+        status = scheduler.record_round(state, state.valid, 0, failed=True)
+    else:
+        with leases.holding(state.key) if leases else contextlib.nullcontext(True) as owned:
+            if owned:
+                engine.finish_block(
+                    chapter,
+                    block,
+                    prepared,
+                    result,
+                    scheduler.batch_size,
+                    chapter_number_filter=int(chapter.get("__index", 0)),
+                    block_number_filter=block_idx,
+                )
+        if not owned:
+            engine.drop_block_claims(chapter, block)
+            # The lease expired and another worker took the block over: its file is no longer ours to write.
+            log_color(f"    ✗ {label}: аренду блока перехватил другой воркер, результат раунда отброшен", ANSI_YELLOW)
+            progress.record_round(
+                state.key,
+                int(chapter.get("__index", 0)),
+                block_idx,
+                engine.llm.model,
+                started_at,
+                time.time() - started_at,
+                result,
+                0,
+                state.valid,
+                "lease_lost",
+            )
+            # Back to the queue: it is picked up again (with the other worker's questions) once the lease is free.
+            scheduler.requeue(state)
+            return
+        if engine.index_dirty:
+            engine.write_index()
+        spent = sum(r["prompt_tokens"] + r["completion_tokens"] for r in result.get("token_usage") or [] if not r.get("cache_hit"))
+        block_report = engine.validate_block(chapter, block)
+        if not block_report["ok"]:
+            log_color(f"    ✗ {label}: валидация блока не пройдена", ANSI_RED)
+            summarize_validation_errors(block_report, block["id"])
+            status = scheduler.record_round(state, state.valid, spent, failed=True)
+        else:
+            status = scheduler.record_round(state, count_valid_for_block(engine, chapter, block, repaired), spent)
+    gained = state.valid - before
+    progress.record_round(
+        state.key,
+        int(chapter.get("__index", 0)),
+        block_idx,
+        engine.llm.model,
+        started_at,
+        time.time() - started_at,
+        result,
+        gained,
+        state.valid,
+        status,
+    )
+    if status == fill_scheduler.STATUS_FAILED:
+        return
+    mark, color = ("✓", ANSI_GREEN) if gained > 0 else ("·", ANSI_YELLOW)
+    log_color(f"    {mark} {label}, раунд {state.rounds}: +{gained}, всего {state.valid}", color)
+    if status == fill_scheduler.STATUS_DONE:
+        log_color(f"✅ {label}: цель достигнута за {state.rounds} раундов", ANSI_GREEN)
+    elif status == fill_scheduler.STATUS_ZERO_GAIN:
+        log_color(f"⚠ {label}: {state.zero_gain_streak} раунда подряд без прироста, блок снят ({state.valid}/{target_valid})", ANSI_YELLOW)
+    elif status == fill_scheduler.STATUS_MAX_ROUNDS:
+        log_color(f"⚠ {label}: достигнут лимит раундов ({state.valid}/{target_valid})", ANSI_YELLOW)
 
 
 def main():
@@ -329,76 +242,195 @@ def main():
     parser.add_argument("--batch-size", type=int, default=3)
     parser.add_argument("--target-valid", type=int, default=20)
     parser.add_argument("--max-rounds-per-block", type=int, default=50)
+    parser.add_argument(
+        "--max-zero-gain-rounds",
+        type=int,
+        default=fill_scheduler.DEFAULT_MAX_ZERO_GAIN,
+        help="Retire a block after this many rounds in a row without new valid questions (each such round halves its priority)",
+    )
+    parser.add_argument("--workers", type=int, default=1, help="Rounds of different blocks generated concurrently")
+    parser.add_argument(
+        "--worker",
+        action="store_true",
+        help="Lease blocks in training_pack/reports/.fill-leases.json so several fill processes can share one pack",
+    )
+    parser.add_argument(
+        "--lease-ttl-s",
+        type=float,
+        default=block_leases.DEFAULT_TTL_S,
+        help="With --worker: a block lease not renewed for this long (crashed worker) is taken over by others",
+    )
+    parser.add_argument(
+        "--status",
+        action="store_true",
+        help="Print blocks remaining, questions/hour and ETA to --target-valid for the selected scope, then exit",
+    )
+    parser.add_argument("--status-window-min", type=float, default=progress_store.DEFAULT_WINDOW_MIN, help="Rate window of --status")
     parser.add_argument("--chapter-number", type=int, default=0)
     parser.add_argument("--block-number", type=int, default=0)
+    parser.add_argument("--llm-base-url", default=None, help="LLM server URL; comma-separated URLs balance requests across servers")
+    parser.add_argument("--llm-weights", default=None, help="Comma-separated relative weights of the --llm-base-url servers")
+    parser.add_argument("--llm-routing", choices=("least-outstanding", "weighted"), default=None, help="Routing across several servers")
+    parser.add_argument("--llm-max-request-s", type=float, default=None, help="Abort an LLM request running longer than this (0 = off)")
+    parser.add_argument("--llm-ttft-s", type=float, default=None, help="Abort a streamed LLM request with no first token after this (0 = off)")
+    parser.add_argument("--llm-min-tokens-per-s", type=float, default=None, help="Abort a stream slower than this (0 = off)")
+    parser.add_argument("--llm-model", default=None)
+    parser.add_argument("--prompt-layout", choices=("prefix", "classic"), default=None)
+    parser.add_argument("--llm-cache", action="store_true", help="Serve repeated identical LLM requests from training_pack/.llm-cache")
+    parser.add_argument("--near-dup-threshold", type=float, default=0.0, help="Reject near-duplicate questions (MinHash Jaccard, e.g. 0.8)")
+    parser.add_argument("--max-request-factor", type=float, default=None, help="Cap of over-requesting by historical acceptance rate (1 = off)")
+    parser.add_argument("--decoding", choices=("free", "json_schema", "grammar"), default=None, help="Constrained decoding mode for LLM output")
+    parser.add_argument("--spec-profile", choices=("full", "compact"), default=None, help="Block INPUT serialization in prompts")
+    parser.add_argument("--exact-tokens", action="store_true", help="Count block INPUT tokens via llama.cpp /tokenize")
     args = parser.parse_args()
 
     course_root = Path(args.course_root).resolve()
-    lang = (course_root / "bundle.target").read_text(encoding="utf-8").strip()
-    env = load_env_local(course_root)
-    chapters = load_chapters(course_root)
+    os.environ.update(load_env_local(course_root))
 
     if args.block_number and not args.chapter_number:
         raise SystemExit("--block-number requires --chapter-number")
 
-    total_blocks = 0
-    completed_blocks = 0
-    failed_blocks = 0
-    current_chapter_banner = None
+    if args.status:
+        report = progress_store.status_report(
+            course_root, args.target_valid, args.chapter_number, args.block_number, args.status_window_min
+        )
+        for line in progress_store.format_status(report):
+            log(line)
+        return
 
-    for chapter in chapters:
-        chapter_idx = int(chapter.get("__index", 0))
-        if args.chapter_number and chapter_idx != args.chapter_number:
-            continue
-        if current_chapter_banner != chapter_idx:
-            current_chapter_banner = chapter_idx
-            log_color(f"═══ ГЛАВА {chapter_idx} ═══", ANSI_BOLD)
-        chapter_id = chapter["id"]
-        blocks = theory_blocks(chapter)
-        for block in blocks:
-            block_idx = int(block["index"])
-            if args.block_number and block_idx != args.block_number:
-                continue
-            total_blocks += 1
-            block_id = block["id"]
-            current = count_valid_for_block(course_root, chapter_id, block_id, lang)
-            rounds = 0
-            success = True
-            zero_gain_streak = 0
-            log_color(f"■ Блок {block_idx}: сейчас {current}, цель {args.target_valid}", ANSI_CYAN)
-            while current < args.target_valid and rounds < args.max_rounds_per_block:
-                rounds += 1
-                log_color(f"  • Раунд {rounds}: запуск генератора", ANSI_CYAN)
-                code = run_generator(course_root, env, chapter_idx, block_idx, args.batch_size)
-                if code != 0:
-                    log_color(f"    ✗ генератор завершился с кодом {code}", ANSI_RED)
-                    summarize_validation_errors(course_root, chapter_id, block_id)
-                    success = False
-                    break
-                next_count = count_valid_for_block(course_root, chapter_id, block_id, lang)
-                gained = next_count - current
-                current = next_count
-                mark = "✓" if gained > 0 else "·"
-                color = ANSI_GREEN if gained > 0 else ANSI_YELLOW
-                log_color(f"    {mark} раунд {rounds}: +{gained}, всего {current}", color)
-                if gained > 0:
-                    zero_gain_streak = 0
-                else:
-                    zero_gain_streak += 1
-                    if zero_gain_streak >= 2:
-                        log_color("    ⚠ два подряд раунда без прироста, стоп по блоку", ANSI_YELLOW)
-                        success = False
+    llm_model, llm_base_url = gen.resolve_llm_settings(course_root, args.llm_model, args.llm_base_url)
+    engine = gen.TrainingPackEngine(
+        course_root,
+        llm_model=llm_model,
+        llm_base_url=llm_base_url,
+        append=True,
+        prompt_layout=args.prompt_layout,
+        response_cache=args.llm_cache,
+        near_dup_threshold=args.near_dup_threshold,
+        max_request_factor=args.max_request_factor,
+        decoding=args.decoding,
+        spec_profile=args.spec_profile,
+        exact_tokens=args.exact_tokens,
+        llm_weights=args.llm_weights,
+        llm_routing=args.llm_routing,
+        llm_max_request_s=args.llm_max_request_s,
+        llm_ttft_s=args.llm_ttft_s,
+        llm_min_tokens_per_s=args.llm_min_tokens_per_s,
+        # Workers started in the same second must not share a run dir (journal, raw logs, progress run id).
+        run_stamp=datetime.now(timezone.utc).strftime("%Y%m%d_%H%M%S") + f"_{os.getpid()}" if args.worker else None,
+    )
+    leases = block_leases.BlockLeases(engine.pack_dir, ttl_s=args.lease_ttl_s) if args.worker else None
+
+    scheduler = fill_scheduler.FillScheduler(
+        args.target_valid, args.batch_size, args.max_rounds_per_block, max_zero_gain=args.max_zero_gain_rounds
+    )
+    system_tokens = tokens.estimate_tokens(engine.system_prompt)
+    repaired: set = set()
+    for chapter, block in engine.select(args.chapter_number, args.block_number):
+        bkey = gen.block_key(chapter["id"], block["id"])
+        rate = engine.acceptance.block_rate(engine.llm.model, bkey)
+        prompt_tokens = system_tokens + engine.block_spec(chapter, block)["spec_tokens"]
+        scheduler.add(
+            fill_scheduler.BlockState(
+                chapter,
+                block,
+                count_valid_for_block(engine, chapter, block, repaired),
+                yield_rate=rate if rate is not None else 1.0,
+                cost_tokens=fill_scheduler.round_cost_estimate(prompt_tokens, args.batch_size),
+            )
+        )
+    if engine.index_dirty:
+        engine.write_index()
+    total_blocks = len(scheduler.blocks)
+    log_color(
+        f"Очередь: блоков {total_blocks}, уже с целью {total_blocks - scheduler.queued()}, "
+        f"к догенерации {scheduler.queued()}, воркеров {args.workers}"
+        + (f", процесс-воркер {leases.worker_id} (аренда {args.lease_ttl_s:g} с)" if leases else ""),
+        ANSI_BOLD,
+    )
+
+    progress = progress_store.ProgressStore(
+        engine.pack_dir, engine.runs_dir.name, engine.llm.model, args.target_valid, args.chapter_number, args.block_number
+    )
+    started = time.monotonic()
+    workers = max(1, args.workers)
+    poll_s = max(1.0, args.lease_ttl_s / 3)
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            inflight = {}
+            while True:
+                deferred = []
+                while len(inflight) < workers:
+                    state = scheduler.pop()
+                    if state is None:
                         break
-            if current >= args.target_valid:
-                completed_blocks += 1
-                log_color(f"✅ Блок {block_idx}: цель достигнута", ANSI_GREEN)
-            else:
-                failed_blocks += 1
-                if success and rounds >= args.max_rounds_per_block:
-                    log_color(f"⚠ Блок {block_idx}: достигнут лимит раундов ({current}/{args.target_valid})", ANSI_YELLOW)
-                else:
-                    log_color(f"✗ Блок {block_idx}: не добрали ({current}/{args.target_valid})", ANSI_RED)
-
+                    chapter, block = state.chapter, state.block
+                    if leases:
+                        if not leases.acquire(state.key):
+                            deferred.append(state)
+                            continue
+                        if engine.refresh_block(chapter, block):
+                            # Another worker added questions since this one last looked at the block.
+                            status = scheduler.refresh(state, count_valid_for_block(engine, chapter, block, repaired))
+                            if status == fill_scheduler.STATUS_DONE:
+                                leases.release(state.key)
+                                log_color(
+                                    f"✅ Глава {chapter.get('__index')}, блок {block['index']}: цель достигнута другим воркером",
+                                    ANSI_GREEN,
+                                )
+                                continue
+                    tag = f"[{int(chapter.get('__index', 0)):03d}.{int(block.get('index', 0)):02d}] " if workers > 1 else ""
+                    log_color(
+                        f"■ Глава {chapter.get('__index')}, блок {block['index']}: раунд {state.rounds + 1}, "
+                        f"сейчас {state.valid}/{args.target_valid}, приоритет {scheduler.priority(state):.2f}",
+                        ANSI_CYAN,
+                    )
+                    fut, prepared = engine.submit_block(ex, chapter, block, args.batch_size, worker_tag=tag)
+                    inflight[fut] = (state, prepared, time.time())
+                for state in deferred:
+                    scheduler.requeue(state)
+                if not inflight:
+                    if not deferred:
+                        break
+                    # Every remaining block is leased by other workers: wait for a lease to free up or expire.
+                    time.sleep(min(poll_s, block_leases.IDLE_POLL_S))
+                    leases.renew()
+                    continue
+                done, _ = wait(inflight, timeout=poll_s if leases else None, return_when=FIRST_COMPLETED)
+                if leases:
+                    for bkey in leases.renew():
+                        log_color(f"    ⚠ {bkey}: аренда истекла и перешла другому воркеру", ANSI_YELLOW)
+                for fut in done:
+                    state, prepared, submitted_at = inflight.pop(fut)
+                    finish_round(engine, scheduler, progress, leases, state, fut, prepared, submitted_at, repaired)
+                    if leases:
+                        leases.release(state.key)
+    finally:
+        if leases:
+            if leases.reclaimed:
+                log_color(f"Перехвачено просроченных аренд: {leases.reclaimed}", ANSI_YELLOW)
+            leases.release_all()
+
+    progress.finish()
+    elapsed_h = max(time.monotonic() - started, 1e-9) / 3600
+    summary = scheduler.summary()
+    completed_blocks = summary.get(fill_scheduler.STATUS_DONE, 0)
+    failed_blocks = total_blocks - completed_blocks
+    log_color(
+        f"Планировщик: раундов {summary['rounds']}, добавлено валидных {summary['gained']} "
+        f"({summary['gained'] / elapsed_h:.1f} в час), токенов {summary['tokens']}, "
+        f"исключено без прироста {summary.get(fill_scheduler.STATUS_ZERO_GAIN, 0)}, "
+        f"по лимиту раундов {summary.get(fill_scheduler.STATUS_MAX_ROUNDS, 0)}, "
+        f"с ошибкой {summary.get(fill_scheduler.STATUS_FAILED, 0)}",
+        ANSI_CYAN,
+    )
+
+    engine.save_indexes()
+    engine.prompt_prefix_report()
+    engine.prompt_efficiency_report()
+    engine.decoding_report()
+    engine.token_cost_report()
+    engine.backend_report()
     summary_color = ANSI_GREEN if failed_blocks == 0 else ANSI_YELLOW
     log_color(f"Итог: блоков={total_blocks}, успешно={completed_blocks}, проблемных={failed_blocks}", summary_color)
     if failed_blocks > 0:
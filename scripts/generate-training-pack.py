@@ -5,31 +5,54 @@ import json
 import os
 import re
 import sys
-import urllib.error
-import urllib.request
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timezone
 from pathlib import Path
-from typing import Dict, List, Tuple
-
-SUPPORTED_TYPES = {"mcq_single"}
+from typing import Callable, Dict, List, Tuple
+
+SCRIPTS_DIR = Path(__file__).resolve().parent
+if str(SCRIPTS_DIR) not in sys.path:
+    sys.path.insert(0, str(SCRIPTS_DIR))
+
+import training_pack_acceptance as acceptance  # noqa: E402
+import training_pack_block_specs as block_specs  # noqa: E402
+import training_pack_course_index as course_index  # noqa: E402
+import training_pack_io as pack_io  # noqa: E402
+import training_pack_json_stream as json_stream  # noqa: E402
+import training_pack_llm_cache as llm_cache  # noqa: E402
+import training_pack_llm_client as llm_client  # noqa: E402
+import training_pack_llm_pool as llm_pool  # noqa: E402
+import training_pack_near_dupes as near_dup_index  # noqa: E402
+import training_pack_schema as pack_schema  # noqa: E402
+import training_pack_signatures as signature_index  # noqa: E402
+import training_pack_tokens as tokens  # noqa: E402
+from training_pack_signatures import normalize_text, question_signature, renumber_question_ids  # noqa: E402
+from training_pack_validation import validate_question  # noqa: E402
 
 
 def read_json(path: Path):
     return json.loads(path.read_text(encoding="utf-8"))
 
 
-def write_json(path: Path, data):
-    path.parent.mkdir(parents=True, exist_ok=True)
-    path.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+def write_json(path: Path, data, durable: bool = False):
+    pack_io.atomic_write_json(path, data, trailing_newline=False, durable_dir=durable)
 
 
 def utc_now():
     return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
 
 
+_LOG_CONTEXT = threading.local()
+
+
+def _log_prefix() -> str:
+    return getattr(_LOG_CONTEXT, "prefix", "")
+
+
 def log(message: str):
     ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    print(f"{ts}: {message}", flush=True)
+    print(f"{ts}: {_log_prefix()}{message}", flush=True)
 
 
 ANSI_YELLOW = "\033[33m"
@@ -43,27 +66,27 @@ ANSI_RESET = "\033[0m"
 
 def log_yellow(message: str):
     ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    print(f"{ANSI_YELLOW}{ts}: {message}{ANSI_RESET}", flush=True)
+    print(f"{ANSI_YELLOW}{ts}: {_log_prefix()}{message}{ANSI_RESET}", flush=True)
 
 
 def log_cyan(message: str):
     ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    print(f"{ANSI_CYAN}{ts}: {message}{ANSI_RESET}", flush=True)
+    print(f"{ANSI_CYAN}{ts}: {_log_prefix()}{message}{ANSI_RESET}", flush=True)
 
 
 def log_green(message: str):
     ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    print(f"{ANSI_GREEN}{ts}: {message}{ANSI_RESET}", flush=True)
+    print(f"{ANSI_GREEN}{ts}: {_log_prefix()}{message}{ANSI_RESET}", flush=True)
 
 
 def log_red(message: str):
     ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    print(f"{ANSI_RED}{ts}: {message}{ANSI_RESET}", flush=True)
+    print(f"{ANSI_RED}{ts}: {_log_prefix()}{message}{ANSI_RESET}", flush=True)
 
 
 def log_bold(message: str):
     ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    print(f"{ANSI_BOLD}{ts}: {message}{ANSI_RESET}", flush=True)
+    print(f"{ANSI_BOLD}{ts}: {_log_prefix()}{message}{ANSI_RESET}", flush=True)
 
 
 def _compact_tail(text: str, limit: int = 50) -> str:
@@ -73,13 +96,23 @@ def _compact_tail(text: str, limit: int = 50) -> str:
     return compact[-limit:]
 
 
-def _stream_status(prefix: str, text: str):
-    tail = _compact_tail(text, 50)
-    msg = f"{prefix} получаем ответ... {len(text)} симв ... {tail}"
+def _stream_status(prefix: str, chars: int, tail_text: str, chunks: int = 0):
+    if getattr(_LOG_CONTEXT, "quiet_stream", False):
+        return
+    tail = _compact_tail(tail_text, 50)
+    # Streaming servers send about one token per chunk.
+    msg = f"{prefix} получаем ответ... {chars} симв, ≈{chunks} ток ... {tail}"
     sys.stdout.write("\r" + ANSI_CYAN + msg + ANSI_RESET)
     sys.stdout.flush()
 
 
+def _stream_done():
+    if getattr(_LOG_CONTEXT, "quiet_stream", False):
+        return
+    sys.stdout.write("\n")
+    sys.stdout.flush()
+
+
 def short_err(err: str, limit: int = 140) -> str:
     one_line = re.sub(r"\s+", " ", str(err)).strip()
     if len(one_line) <= limit:
@@ -87,45 +120,6 @@ def short_err(err: str, limit: int = 140) -> str:
     return one_line[:limit] + "..."
 
 
-def normalize_text(v):
-    if v is None:
-        return ""
-    t = str(v).strip().lower()
-    t = re.sub(r"[\"'`´«»„“”‘’‚‛‹›]", "", t)
-    return " ".join(t.split())
-
-
-def has_cyrillic(text: str) -> bool:
-    for ch in text:
-        code = ord(ch)
-        if 0x0400 <= code <= 0x04FF:
-            return True
-    return False
-
-
-def question_signature(q):
-    correct_answer_id = q.get("correct_answer")
-    correct_answer_text = ""
-    choices = q.get("choices")
-    if isinstance(choices, list) and correct_answer_id is not None:
-        for c in choices:
-            if not isinstance(c, dict):
-                continue
-            if c.get("id") == correct_answer_id:
-                correct_answer_text = c.get("text", "")
-                break
-    if not normalize_text(correct_answer_text):
-        correct_answer_text = correct_answer_id
-
-    parts = [
-        normalize_text(q.get("prompt")),
-        normalize_text(correct_answer_text),
-        normalize_text(q.get("theory_block_id")),
-        normalize_text(q.get("type")),
-    ]
-    return hashlib.sha256("|".join(parts).encode("utf-8")).hexdigest()[:16]
-
-
 def dedupe_choice_texts_keep_correct(q: dict) -> int:
     choices = q.get("choices")
     if not isinstance(choices, list) or not choices:
@@ -179,111 +173,6 @@ def normalize_choice_ids_and_correct_answer(q: dict):
         q["correct_answer"] = letters[correct_idx]
 
 
-def read_final_json(chapter_dir: Path):
-    for name in ("05-final.json", "04-final.json"):
-        p = chapter_dir / name
-        if p.exists():
-            return read_json(p)
-    return None
-
-
-def load_chapters(course_root: Path):
-    chapters_dir = course_root / "chapters"
-    chapter_dirs = [p for p in chapters_dir.iterdir() if p.is_dir()]
-    chapter_dirs.sort()
-    out = []
-    for idx, chapter_dir in enumerate(chapter_dirs, start=1):
-        chapter = read_final_json(chapter_dir)
-        if not chapter or not chapter.get("id"):
-            continue
-        chapter["__index"] = idx
-        out.append(chapter)
-    return out
-
-
-def theory_blocks(chapter: dict):
-    out = []
-    for b in chapter.get("blocks", []):
-        if not isinstance(b, dict):
-            continue
-        if b.get("type") != "theory":
-            continue
-        bid = b.get("id")
-        theory = b.get("theory", {}) if isinstance(b.get("theory"), dict) else {}
-        if bid:
-            out.append(
-                {
-                    "index": len(out) + 1,
-                    "id": bid,
-                    "chapter_id": chapter.get("id"),
-                    "chapter_title": chapter.get("title", ""),
-                    "chapter_level": chapter.get("level", ""),
-                    "concept_id": theory.get("concept_id", ""),
-                    "title": b.get("title", ""),
-                    "content_md": theory.get("content_md", ""),
-                    "key_points": theory.get("key_points", []),
-                    "common_mistakes": theory.get("common_mistakes", []),
-                    "examples": theory.get("examples", []),
-                }
-            )
-    return out
-
-
-def validate_question(q: dict, chapter_id: str, theory_block_ids: set):
-    errors = []
-    if q.get("type") not in SUPPORTED_TYPES:
-        errors.append(f"unsupported type={q.get('type')}, only mcq_single is allowed")
-    if not normalize_text(q.get("prompt", "")):
-        errors.append("empty prompt")
-    elif not has_cyrillic(str(q.get("prompt", ""))):
-        errors.append("prompt must contain Russian text (cyrillic)")
-    if "correct_answer" not in q:
-        errors.append("missing correct_answer")
-    if not normalize_text(q.get("explanation", "")):
-        errors.append("missing explanation")
-    elif not has_cyrillic(str(q.get("explanation", ""))):
-        errors.append("explanation must contain Russian text (cyrillic)")
-    choices = q.get("choices")
-    if not isinstance(choices, list) or len(choices) < 2:
-        errors.append("mcq_single requires choices with at least 2 options")
-    else:
-        norm_choice_texts = []
-        choice_ids = []
-        for c in choices:
-            if not isinstance(c, dict):
-                errors.append("choice must be object")
-                continue
-            cid = c.get("id")
-            ctext = c.get("text")
-            if not normalize_text(cid):
-                errors.append("choice missing id")
-            if not normalize_text(ctext):
-                errors.append("choice missing text")
-            norm_choice_texts.append(normalize_text(ctext))
-            choice_ids.append(cid)
-        allowed_choice_ids = {"a", "b", "c", "d"}
-        if len(choices) > 4:
-            errors.append("mcq_single allows at most 4 choices")
-        if len(set(choice_ids)) != len(choice_ids):
-            errors.append("choice ids must be unique")
-        if not set(choice_ids).issubset(allowed_choice_ids):
-            errors.append("choice ids must be within a,b,c,d")
-        if "correct_answer" in q and q.get("correct_answer") not in choice_ids:
-            errors.append("correct_answer must reference choices[].id")
-        elif "correct_answer" in q and q.get("correct_answer") not in allowed_choice_ids:
-            errors.append("correct_answer must be one of a,b,c,d")
-        if len(set(norm_choice_texts)) != len(norm_choice_texts):
-            errors.append("duplicate choices by text are not allowed")
-    block_id = q.get("theory_block_id")
-    if not block_id:
-        errors.append("missing theory_block_id")
-    elif block_id not in theory_block_ids:
-        errors.append(f"unknown theory_block_id={block_id}")
-    if q.get("chapter_id") and q.get("chapter_id") != chapter_id:
-        errors.append(f"chapter_id mismatch: {q.get('chapter_id')} != {chapter_id}")
-    return errors
-
-
 def load_existing_pack(course_root: Path):
     pack_dir = course_root / "training_pack"
     idx_path = pack_dir / "index.json"
@@ -315,151 +204,320 @@ def load_generator_config(course_root: Path):
         return {}
 
 
-def build_prompt(system_prompt: str, spec: dict, count: int):
+PROMPT_LAYOUTS = ("prefix", "classic")
+PROMPT_CONSTRAINTS_COMMON = (
+    "Ограничения:\n"
+    "- Генерируй только type=mcq_single\n"
+    "- Каждый вопрос обязан иметь choices: ровно 4 варианта, каждый {id,text}\n"
+    "- prompt и explanation пиши по-русски\n"
+    "- text в choices пиши по-английски\n"
+)
+PROMPT_CONSTRAINTS = PROMPT_CONSTRAINTS_COMMON + "- Верни JSON массив объектов вопросов\n"
+PROMPT_CONSTRAINTS_BATCH = PROMPT_CONSTRAINTS_COMMON + (
+    "- INPUT содержит несколько теоретических блоков; вопрос проверяет только свой блок\n"
+    "- Верни JSON объект: ключ — id блока из INPUT, значение — массив объектов вопросов по этому блоку\n"
+)
+# Upper bound for the block specs packed into one batched prompt.
+BATCH_MAX_INPUT_CHARS = 12000
+# Cap of the over-request factor derived from a block's acceptance rate (1 = always ask for exactly what is missing).
+DEFAULT_MAX_REQUEST_FACTOR = 2.0
+
+
+def build_prompt(system_prompt: str, spec_json: str, count: int, layout: str = "prefix"):
+    # spec_json is the block INPUT already serialized by training_pack_block_specs.
+    if layout == "classic":
+        return (
+            f"{system_prompt}\n\n"
+            f"{PROMPT_CONSTRAINTS}"
+            f"- Сгенерируй ровно {count} вопросов\n\n"
+            f"INPUT:\n{spec_json}"
+        )
+    # System prompt + constraints are byte-identical for every request and the block spec is
+    # identical across retries, so the only varying part (count) goes last: llama.cpp can reuse
+    # the KV cache for everything before it.
     return (
         f"{system_prompt}\n\n"
-        "Ограничения:\n"
-        "- Генерируй только type=mcq_single\n"
-        "- Каждый вопрос обязан иметь choices: ровно 4 варианта, каждый {id,text}\n"
-        "- prompt и explanation пиши по-русски\n"
-        "- text в choices пиши по-английски\n"
-        "- Верни JSON массив объектов вопросов\n"
-        f"- Сгенерируй ровно {count} вопросов\n\n"
-        f"INPUT:\n{json.dumps(spec, ensure_ascii=False)}"
+        f"{PROMPT_CONSTRAINTS}\n"
+        f"INPUT:\n{spec_json}\n\n"
+        f"Сгенерируй ровно {count} вопросов."
     )
 
 
-def _openai_chat_generate(model: str, prompt: str, base_url: str):
-    base = base_url.rstrip("/")
-    api_key = os.environ.get("LOCAL_LLM_API_KEY") or os.environ.get("OPENAI_API_KEY") or ""
-    chat_body = json.dumps(
-        {
-            "model": model,
-            "messages": [{"role": "user", "content": prompt}],
-                "temperature": 0.1,
-            "stream": True,
-        }
-    ).encode("utf-8")
-    headers = {"Content-Type": "application/json"}
-    if api_key:
-        headers["Authorization"] = f"Bearer {api_key}"
-    chat_req = urllib.request.Request(
-        f"{base}/v1/chat/completions",
-        data=chat_body,
-        headers=headers,
-        method="POST",
+def build_batch_prompt(system_prompt: str, specs_json: str, counts: Dict[str, int]):
+    # Same prefix layout as build_prompt: the per-block counts are the only part that changes between attempts.
+    return (
+        f"{system_prompt}\n\n"
+        f"{PROMPT_CONSTRAINTS_BATCH}\n"
+        f"INPUT:\n{specs_json}\n\n"
+        f"Сгенерируй вопросы по блокам (id блока: количество): {json.dumps(counts, ensure_ascii=False)}."
     )
+
+
+def prompt_prefix_summary(totals: dict) -> dict:
+    prompt_chars = totals.get("prompt_chars", 0)
+    prompt_tokens = totals.get("prompt_tokens", 0)
+    cached_tokens = totals.get("cached_prompt_tokens", 0)
+    return {
+        "requests": totals.get("requests", 0),
+        "prompt_chars": prompt_chars,
+        "prefix_shared_chars": totals.get("prefix_shared_chars", 0),
+        "prefix_hit_rate_chars": round(totals.get("prefix_shared_chars", 0) / prompt_chars, 4) if prompt_chars else None,
+        "prompt_tokens": prompt_tokens,
+        "cached_prompt_tokens": cached_tokens,
+        # llama.cpp timings: prompt_n = evaluated tokens, cache_n = tokens reused from the KV cache.
+        "prefix_hit_rate_tokens": round(cached_tokens / (cached_tokens + prompt_tokens), 4) if cached_tokens + prompt_tokens else None,
+    }
+
+
+def prompt_token_count(stream_stats: dict) -> int:
+    # Server-reported size (evaluated + reused from cache) when available, otherwise ~4 characters per token.
+    if stream_stats.get("prompt_tokens") is not None:
+        return int(stream_stats["prompt_tokens"]) + int(stream_stats.get("cached_prompt_tokens") or 0)
+    return (int(stream_stats.get("prompt_chars") or 0) + 3) // 4
+
+
+def prompt_efficiency_summary(totals: dict) -> dict:
+    questions = totals.get("questions_accepted", 0)
+    prompt_tokens = totals.get("prompt_tokens_total", 0)
+    return {
+        "requests": totals.get("requests", 0),
+        "cache_hits": totals.get("cache_hits", 0),
+        "questions_accepted": questions,
+        "prompt_tokens_total": prompt_tokens,
+        "questions_per_prompt_token": round(questions / prompt_tokens, 6) if prompt_tokens else None,
+        "questions_per_1k_prompt_tokens": round(1000 * questions / prompt_tokens, 2) if prompt_tokens else None,
+        "early_stops": totals.get("early_stops", 0),
+        "tokens_saved_est": totals.get("tokens_saved_est", 0),
+    }
+
+
+def merge_prompt_stats(totals: dict, stats: dict):
+    for key, value in stats.items():
+        totals[key] = totals.get(key, 0) + value
+
+
+def add_prompt_stats(totals: dict, stream_stats: dict):
+    if not stream_stats:
+        return
+    if stream_stats.get("cache_hit"):
+        # Served from the response cache: no prompt reached the LLM.
+        totals["cache_hits"] = totals.get("cache_hits", 0) + 1
+        return
+    totals["requests"] = totals.get("requests", 0) + 1
+    totals["prompt_tokens_total"] = totals.get("prompt_tokens_total", 0) + prompt_token_count(stream_stats)
+    for key in ("prompt_chars", "prefix_shared_chars", "tokens_saved_est"):
+        totals[key] = totals.get(key, 0) + int(stream_stats.get(key) or 0)
+    if stream_stats.get("stopped_early"):
+        totals["early_stops"] = totals.get("early_stops", 0) + 1
+    # Token counters only make sense when the server reported reuse at all.
+    if stream_stats.get("cached_prompt_tokens") is not None:
+        totals["prompt_tokens"] = totals.get("prompt_tokens", 0) + int(stream_stats.get("prompt_tokens") or 0)
+        totals["cached_prompt_tokens"] = totals.get("cached_prompt_tokens", 0) + int(stream_stats["cached_prompt_tokens"])
+
+
+def add_decoding_stats(totals: dict, stream_stats: dict, items: int, structural_rejected: int, failed: bool):
+    """Per decoding mode: responses (cached ones too), items checked, items rejected for structure, responses with no usable item."""
+    mode = stream_stats.get("decoding") or llm_client.DECODING_FREE
+    prefix = f"decoding.{mode}."
+    for key, value in (("responses", 1), ("items", items), ("structural_rejected", structural_rejected), ("failed_responses", int(failed))):
+        totals[prefix + key] = totals.get(prefix + key, 0) + value
+
+
+def decoding_summary(totals: dict) -> Dict[str, dict]:
+    modes: Dict[str, dict] = {}
+    for key, value in totals.items():
+        if key.startswith("decoding."):
+            _, mode, counter = key.split(".", 2)
+            modes.setdefault(mode, {})[counter] = value
+    for counters in modes.values():
+        items = counters.get("items", 0)
+        counters["structural_rejection_rate"] = round(counters.get("structural_rejected", 0) / items, 4) if items else None
+    return modes
+
+
+def decoding_constraint(decoding: str, count: int = 0, counts: Dict[str, int] | None = None) -> llm_client.DecodingConstraint | None:
+    if decoding == llm_client.DECODING_FREE:
+        return None
+    if counts is not None:
+        return llm_client.DecodingConstraint(
+            decoding, pack_schema.batch_response_schema(counts), pack_schema.batch_response_grammar(counts)
+        )
+    return llm_client.DecodingConstraint(decoding, pack_schema.response_schema(count), pack_schema.response_grammar(count))
+
+
+def llm_api_key() -> str:
+    return os.environ.get("LOCAL_LLM_API_KEY") or os.environ.get("OPENAI_API_KEY") or ""
+
+
+def llm_generate(
+    llm: llm_client.LLMClient,
+    prompt: str,
+    response_cache: llm_cache.LLMResponseCache | None = None,
+    on_text: Callable[[str], bool | None] | None = None,
+    stats: llm_client.StreamStats | None = None,
+    constraint: llm_client.DecodingConstraint | None = None,
+):
+    cache_key = None
+    if response_cache is not None:
+        decoding = constraint.mode if constraint is not None else llm_client.DECODING_FREE
+        cache_key = response_cache.key(llm.model, llm.base_url, prompt, llm.temperature, decoding)
+        hit = response_cache.get(cache_key)
+        if hit is not None:
+            log("  ↳ LLM ответ из кэша")
+            text = hit.get("text", "")
+            if on_text is not None:
+                on_text(text)
+            return text, llm_cache.cached_stream_stats(prompt, hit.get("stats"))
+
+    # Keep only a running count and a short tail for the status line instead of re-joining the response.
+    progress = {"chars": 0, "chunks": 0, "tail": ""}
+
+    def on_chunk(chunk: str):
+        progress["chars"] += len(chunk)
+        progress["chunks"] += 1
+        progress["tail"] = (progress["tail"] + chunk)[-200:]
+        _stream_status("[LLM]", progress["chars"], progress["tail"], progress["chunks"])
+        return on_text(chunk) if on_text is not None else None
+
+    text, stats = llm.generate(prompt, on_chunk=on_chunk, stats=stats, constraint=constraint)
+    if progress["chars"]:
+        _stream_done()
+    if stats.decoding_fallback:
+        log_yellow(f"  ⚠ сервер не принял режим декодирования {', '.join(stats.decoding_fallback)}, использован {stats.decoding}")
+    # A stream cut at the target is not the full answer: an identical request later may need more items.
+    if response_cache is not None and not stats.stopped_early:
+        response_cache.put(cache_key, text, stats.as_dict())
+    return text, stats
+
+
+def request_llm_json(
+    prompt: str,
+    tag: str,
+    llm: llm_client.LLMClient,
+    response_cache: llm_cache.LLMResponseCache | None = None,
+    container: str = json_stream.CONTAINER_ARRAY,
+    on_item: Callable[[str | None, object], bool | None] | None = None,
+    expected_items: int = 0,
+    constraint: llm_client.DecodingConstraint | None = None,
+):
+    """
+    Stream one request through JSONItemStream: on_item(key, item) runs for every element as
+    soon as it is closed. If the full response is not valid JSON (truncated, trailing text),
+    the elements received so far are returned instead of an error.
+
+    on_item returns True once the caller's target is met; if the model then starts another
+    element, the stream is closed instead of waiting for the rest of the response.
+    """
+    print(f"{ANSI_MAGENTA}[LLM REQUEST][{tag}] {prompt}{ANSI_RESET}", flush=True)
+    stream = json_stream.JSONItemStream(container)
     parts: List[str] = []
-    with urllib.request.urlopen(chat_req, timeout=360) as resp:
-        for raw_line in resp:
-            line = raw_line.decode("utf-8", errors="ignore").strip()
-            if not line:
-                continue
-            if line.startswith("data:"):
-                line = line[5:].strip()
-            if line == "[DONE]":
-                break
-            try:
-                data = json.loads(line)
-            except Exception:
-                continue
-            choices = data.get("choices", [])
-            if not choices:
-                continue
-            delta = choices[0].get("delta", {})
-            chunk = delta.get("content", "")
-            if not chunk and isinstance(choices[0].get("message"), dict):
-                chunk = choices[0]["message"].get("content", "")
-            if chunk:
-                parts.append(chunk)
-                _stream_status("[LLM]", "".join(parts))
-    if parts:
-        sys.stdout.write("\n")
-        sys.stdout.flush()
-    return "".join(parts)
-
-
-def llm_generate(model: str, prompt: str, base_url: str):
-    base = base_url.rstrip("/")
-    # 1) Prefer OpenAI-compatible endpoint (llama.cpp server mode)
-    try:
-        return _openai_chat_generate(model=model, prompt=prompt, base_url=base)
-    except urllib.error.HTTPError as e:
-        if e.code not in (404, 405):
-            raise
-    except Exception:
-        pass
-    # 2) Fallback to Ollama API
-    body = json.dumps(
-        {
-            "model": model,
-            "prompt": prompt,
-            "stream": True,
-            "options": {"temperature": 0.1},
-            "keep_alive": "30m",
-        }
-    ).encode("utf-8")
-    req = urllib.request.Request(
-        f"{base}/api/generate",
-        data=body,
-        headers={"Content-Type": "application/json"},
-        method="POST",
-    )
-    try:
-        parts: List[str] = []
-        with urllib.request.urlopen(req, timeout=360) as resp:
-            for raw_line in resp:
-                line = raw_line.decode("utf-8", errors="ignore").strip()
-                if not line:
-                    continue
-                try:
-                    data = json.loads(line)
-                except Exception:
-                    continue
-                chunk = data.get("response", "")
-                if chunk:
-                    parts.append(chunk)
-                    _stream_status("[LLM]", "".join(parts))
-                if data.get("done") is True:
-                    break
-        if parts:
-            sys.stdout.write("\n")
-            sys.stdout.flush()
-        return "".join(parts)
-    except urllib.error.HTTPError:
-        raise
-
-
-def generate_for_block_llm(system_prompt: str, block: dict, count: int, model: str, base_url: str):
-    log(f"  ↳ LLM запрос: нужно {count} шт.")
-    prompt = build_prompt(system_prompt, block, count)
-    print(f"{ANSI_MAGENTA}[LLM REQUEST][{block.get('chapter_id','')}::{block.get('id','')}] {prompt}{ANSI_RESET}", flush=True)
+    state = {"target_met": False}
+
+    def on_text(text: str):
+        parts.append(text)
+        for key, item in stream.feed(text):
+            if on_item is not None and on_item(key, item):
+                state["target_met"] = True
+        # Stopping right before the closing bracket would save nothing and lose the server's
+        # final usage/timings message, so cut only when an element past the target begins.
+        return state["target_met"] and stream.in_item
+
+    stats = llm_client.StreamStats()
+    err = None
     try:
-        raw = llm_generate(model=model, prompt=prompt, base_url=base_url)
+        raw, stats = llm_generate(llm, prompt, response_cache, on_text=on_text, stats=stats, constraint=constraint)
     except Exception as e:
-        return [], "", str(e)
-    print(f"{ANSI_GREEN}[LLM RESPONSE][{block.get('chapter_id','')}::{block.get('id','')}] {raw}{ANSI_RESET}", flush=True)
-    try:
-        parsed = json.loads(raw)
-        if isinstance(parsed, list):
-            log(f"  ↳ LLM ответ: получено {len(parsed)} шт.")
-            return parsed, raw, None
-        return [], raw, "LLM response is not list"
-    except Exception as e:
-        return [], raw, str(e)
-
-
-def parse_selection(chapters: List[dict], chapter_number: int, block_number: int):
-    selected = []
-    for ch in chapters:
-        if chapter_number and ch.get("__index") != chapter_number:
-            continue
-        blocks = theory_blocks(ch)
-        if block_number:
-            blocks = [b for b in blocks if b["index"] == block_number]
-        for b in blocks:
-            selected.append((ch, b))
-    return selected
+        raw, err = "".join(parts), str(e)
+    stream_stats = stats.as_dict()
+    stream_stats["prompt_tokens_est"] = tokens.estimate_tokens(prompt)
+    print(f"{ANSI_GREEN}[LLM RESPONSE][{tag}] {raw}{ANSI_RESET}", flush=True)
+    log(
+        f"  ↳ LLM поток: ttft={stream_stats['ttft_s']}s, "
+        f"{stream_stats['completion_tokens']} ток, {stream_stats['tokens_per_s']} ток/с, "
+        f"общий префикс {stream_stats['prefix_shared_chars']}/{stream_stats['prompt_chars']} симв."
+    )
+    if stats.stopped_early:
+        # Tokens the model would still have spent: at least the element in progress, and
+        # every requested element not produced yet. A lower bound for over-generating models.
+        per_item = stream_stats["completion_tokens"] / max(1, len(stream.items))
+        saved = round(per_item * max(1, expected_items - len(stream.items)))
+        stream_stats["tokens_saved_est"] = saved
+        log_cyan(f"  ✂ поток остановлен: цель достигнута после {len(stream.items)} элементов, сэкономлено ≈{saved} ток.")
+        return stream.shaped(), raw, None, stream_stats
+    if err is None:
+        try:
+            return json.loads(raw), raw, None, stream_stats
+        except Exception as e:
+            err = str(e)
+    if not stream.items:
+        return None, raw, err, stream_stats
+    log_yellow(f"  ⚠ ответ LLM оборван или невалиден ({short_err(err)}), спасено элементов: {len(stream.items)}")
+    stream_stats["salvaged_items"] = len(stream.items)
+    stream_stats["salvage_error"] = err
+    return stream.shaped(), raw, None, stream_stats
+
+
+def generate_for_block_llm(
+    system_prompt: str,
+    block: dict,
+    count: int,
+    llm: llm_client.LLMClient,
+    prompt_layout: str = "prefix",
+    response_cache: llm_cache.LLMResponseCache | None = None,
+    on_item: Callable[[str | None, object], bool | None] | None = None,
+    decoding: str = llm_client.DECODING_FREE,
+):
+    log(f"  ↳ LLM запрос: нужно {count} шт., INPUT {block.get('spec_tokens', 0)} ток.")
+    prompt = build_prompt(system_prompt, block["spec_json"], count, prompt_layout)
+    tag = f"{block.get('chapter_id','')}::{block.get('id','')}"
+    parsed, raw, err, stream_stats = request_llm_json(
+        prompt,
+        tag,
+        llm,
+        response_cache,
+        on_item=on_item,
+        expected_items=count,
+        constraint=decoding_constraint(decoding, count=count),
+    )
+    if err:
+        return [], raw, err, stream_stats
+    if isinstance(parsed, list):
+        log(f"  ↳ LLM ответ: получено {len(parsed)} шт.")
+        return parsed, raw, None, stream_stats
+    return [], raw, "LLM response is not list", stream_stats
+
+
+def generate_for_batch_llm(
+    system_prompt: str,
+    specs: List[dict],
+    counts: Dict[str, int],
+    llm: llm_client.LLMClient,
+    response_cache: llm_cache.LLMResponseCache | None = None,
+    on_item: Callable[[str | None, object], bool | None] | None = None,
+    decoding: str = llm_client.DECODING_FREE,
+):
+    log(
+        f"  ↳ LLM запрос (пакет из {len(counts)} блоков): нужно {sum(counts.values())} шт., "
+        f"INPUT {sum(s.get('spec_tokens', 0) for s in specs)} ток."
+    )
+    prompt = build_batch_prompt(system_prompt, block_specs.join_specs([s["spec_json"] for s in specs]), counts)
+    tag = f"{specs[0].get('chapter_id', '')}::{','.join(counts)}"
+    parsed, raw, err, stream_stats = request_llm_json(
+        prompt,
+        tag,
+        llm,
+        response_cache,
+        container=json_stream.CONTAINER_OBJECT,
+        on_item=on_item,
+        expected_items=sum(counts.values()),
+        constraint=decoding_constraint(decoding, counts=counts),
+    )
+    if err:
+        return {}, raw, err, stream_stats
+    if isinstance(parsed, dict):
+        log(f"  ↳ LLM ответ: получено {sum(len(v) for v in parsed.values() if isinstance(v, list))} шт. по {len(parsed)} блокам")
+        return parsed, raw, None, stream_stats
+    return {}, raw, "LLM response is not object keyed by block id", stream_stats
 
 
 def block_key(chapter_id: str, block_id: str) -> str:
@@ -470,16 +528,64 @@ def block_rel_path(language: str, chapter_idx: int, block_idx: int, block_id: st
     return f"{chapter_idx:03d}/{language}.{block_idx:02d}.{block_id}.questions.json"
 
 
-def renumber_question_ids(questions: List[dict]):
-    idx = 1
-    for q in questions:
-        if not isinstance(q, dict):
+VALIDATOR_VERSION = "1"
+
+
+def question_check_results(payload: dict, chapter_id: str, theory_ids: set) -> List[dict]:
+    results = []
+    for q in payload.get("questions", []):
+        results.append(
+            {
+                "question_id": q.get("id", ""),
+                "theory_block_id": q.get("theory_block_id"),
+                "signature": q.get("signature") or question_signature(q),
+                "errors": validate_question(q, chapter_id, theory_ids),
+            }
+        )
+    return results
+
+
+def dedupe_check_results(results: List[dict], global_signatures: set):
+    accepted = []
+    errors = []
+    duplicates = 0
+    seen_local = set()
+    for r in results:
+        sig = r["signature"]
+        if sig in seen_local or sig in global_signatures:
+            duplicates += 1
+            continue
+        if r["errors"]:
+            errors.append({"question_id": r["question_id"], "errors": r["errors"]})
             continue
-        q["id"] = f"q{idx}"
-        idx += 1
+        seen_local.add(sig)
+        global_signatures.add(sig)
+        accepted.append(r)
+    return accepted, errors, duplicates
+
+
+def validate_block_payload(payload: dict, chapter_id: str, theory_ids: set, global_signatures: set):
+    return dedupe_check_results(question_check_results(payload, chapter_id, theory_ids), global_signatures)
+
 
+def _validation_context_hash(chapter_id: str, theory_ids: set) -> str:
+    raw = chapter_id + "|" + ",".join(sorted(theory_ids))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
 
-def validate_pack(course_root: Path, min_per_block: int) -> Tuple[bool, dict]:
+
+def load_validation_cache(pack_dir: Path) -> dict:
+    cache_path = pack_dir / "reports" / ".validation-cache.json"
+    if cache_path.exists():
+        try:
+            cache = read_json(cache_path)
+            if cache.get("validator_version") == VALIDATOR_VERSION and isinstance(cache.get("files"), dict):
+                return cache
+        except Exception:
+            pass
+    return {"validator_version": VALIDATOR_VERSION, "files": {}}
+
+
+def validate_pack(course_root: Path, min_per_block: int, course: course_index.CourseIndex | None = None) -> Tuple[bool, dict]:
     pack_dir = course_root / "training_pack"
     report = {
         "generated_at": utc_now(),
@@ -496,236 +602,1404 @@ def validate_pack(course_root: Path, min_per_block: int) -> Tuple[bool, dict]:
     idx = read_json(idx_path)
     global_signatures = set()
     block_counts: Dict[str, int] = {}
-    chapters = {ch["id"]: ch for ch in load_chapters(course_root)}
+    if course is None:
+        course = course_index.load_course_index(course_root)
     chapter_reports: Dict[str, dict] = {}
+    # Per-file results depend only on file content and the chapter's theory ids, so they are
+    # cached; the cross-file duplicate pass below always runs over the cached signatures.
+    cache = load_validation_cache(pack_dir)
+    fresh_files = {}
+    cache_hits = 0
     for block_ref, rel_path in idx.get("blocks", {}).items():
         if "::" not in block_ref:
             continue
         chapter_id, block_id = block_ref.split("::", 1)
         chapter_report = chapter_reports.get(chapter_id, {"errors": [], "accepted_questions": 0, "duplicates_removed": 0})
-        chapter = chapters.get(chapter_id)
-        theory_ids = {b["id"] for b in theory_blocks(chapter)} if chapter else set()
+        theory_ids = course.theory_block_ids(chapter_id)
         cp = pack_dir / "chapters" / rel_path
         if not cp.exists():
             chapter_report["errors"].append(f"missing chapter pack file: {cp.name}")
             report["ok"] = False
             chapter_reports[chapter_id] = chapter_report
             continue
-        payload = read_json(cp)
-        accepted = []
-        seen_local = set()
-        for q in payload.get("questions", []):
-            errs = validate_question(q, chapter_id, theory_ids)
-            sig = q.get("signature") or question_signature(q)
-            if sig in seen_local or sig in global_signatures:
-                chapter_report["duplicates_removed"] += 1
-                continue
-            if errs:
-                chapter_report["errors"].append({"question_id": q.get("id", ""), "errors": errs})
-                continue
-            q["signature"] = sig
-            seen_local.add(sig)
-            global_signatures.add(sig)
-            accepted.append(q)
-            block_counts[q.get("theory_block_id")] = block_counts.get(q.get("theory_block_id"), 0) + 1
+        raw = cp.read_bytes()
+        content_hash = hashlib.sha256(raw).hexdigest()
+        context_hash = _validation_context_hash(chapter_id, theory_ids)
+        entry = cache["files"].get(rel_path)
+        if entry and entry.get("content_hash") == content_hash and entry.get("context_hash") == context_hash:
+            cache_hits += 1
+        else:
+            payload = json.loads(raw.decode("utf-8"))
+            entry = {
+                "content_hash": content_hash,
+                "context_hash": context_hash,
+                "questions": question_check_results(payload, chapter_id, theory_ids),
+            }
+        fresh_files[rel_path] = entry
+        accepted, errors, duplicates = dedupe_check_results(entry["questions"], global_signatures)
+        chapter_report["errors"].extend(errors)
+        chapter_report["duplicates_removed"] += duplicates
+        for r in accepted:
+            block_counts[r["theory_block_id"]] = block_counts.get(r["theory_block_id"], 0) + 1
         chapter_report["accepted_questions"] += len(accepted)
-        chapter_report["duplicates_removed"] += max(0, len(payload.get("questions", [])) - len(accepted))
+        chapter_report["duplicates_removed"] += max(0, len(entry["questions"]) - len(accepted))
         if chapter_report["errors"]:
             report["ok"] = False
         chapter_reports[chapter_id] = chapter_report
     report["chapters"] = chapter_reports
+    report["cache"] = {"hits": cache_hits, "misses": len(fresh_files) - cache_hits}
     for block_id, count in sorted(block_counts.items()):
         if count < min_per_block:
             report["weak_blocks"].append({"theory_block_id": block_id, "count": count, "min_required": min_per_block})
+    write_json(pack_dir / "reports" / ".validation-cache.json", {"validator_version": VALIDATOR_VERSION, "files": fresh_files})
     write_json(pack_dir / "reports" / "validation-report.json", report)
     return report["ok"], report
 
 
-def build_pack(
-    course_root: Path,
-    min_per_block: int,
+def empty_block_payload(chapter: dict, block: dict) -> dict:
+    return {
+        "chapter_id": chapter["id"],
+        "theory_block_id": block["id"],
+        "course_version": chapter.get("schema_version", "1.0.0"),
+        "questions": [],
+        "meta": {},
+    }
+
+
+def clean_existing_questions(existing_questions: List[dict]) -> List[dict]:
+    cleaned_existing = []
+    dropped_existing = 0
+    for exq in existing_questions:
+        if not isinstance(exq, dict):
+            dropped_existing += 1
+            continue
+        qq = dict(exq)
+        removed_choice_dups = dedupe_choice_texts_keep_correct(qq)
+        if removed_choice_dups > 0:
+            log_yellow(f"  ⚠ очищены дубли вариантов в существующих вопросах: -{removed_choice_dups}")
+        if not isinstance(qq.get("choices"), list) or len(qq.get("choices")) != 4:
+            dropped_existing += 1
+            continue
+        cleaned_existing.append(qq)
+    if dropped_existing > 0:
+        log_yellow(f"  ⚠ удалено битых существующих вопросов: {dropped_existing}")
+    return cleaned_existing
+
+
+def accept_llm_questions(
+    llm_qs: List,
+    chapter_id: str,
+    block: dict,
+    existing_sigs: set,
+    accepted: List[dict],
     questions_per_block: int,
-    llm_model: str,
-    llm_base_url: str,
-    chapter_number: int,
-    block_number: int,
-    append: bool,
+    reject_reasons_questions: Dict[str, int],
+    signatures: signature_index.SignatureIndex | None = None,
+    near_dupes: near_dup_index.NearDuplicateIndex | None = None,
+    item_offset: int = 0,
+    tally: Dict[str, int] | None = None,
+) -> int:
+    """
+    Normalize and validate one block's LLM items into `accepted`; returns the number rejected.
+    tally["structural_rejected"] counts items rejected for their shape (see training_pack_schema).
+    """
+    rejected = 0
+    bkey = block_key(chapter_id, block["id"])
+    for i, q in enumerate(llm_qs, start=item_offset + 1):
+        if not isinstance(q, dict):
+            rejected += 1
+            reason = "payload item is not an object"
+            reject_reasons_questions[reason] = reject_reasons_questions.get(reason, 0) + 1
+            if tally is not None:
+                tally["structural_rejected"] = tally.get("structural_rejected", 0) + 1
+            continue
+        qq = dict(q)
+        qq["type"] = "mcq_single"
+        qq["theory_block_id"] = block["id"]
+        qq["chapter_id"] = chapter_id
+        qq["concept_id"] = qq.get("concept_id") or block.get("concept_id") or ""
+        qq["difficulty"] = max(1, min(5, int(qq.get("difficulty", 2))))
+        normalize_choice_ids_and_correct_answer(qq)
+        removed_choice_dups = dedupe_choice_texts_keep_correct(qq)
+        if removed_choice_dups > 0:
+            log_yellow(f"    ⚠ q#{i}: убраны дубли вариантов (-{removed_choice_dups})")
+        if not qq.get("id"):
+            qq["id"] = f"{chapter_id}.{block['id']}.gen.{int(datetime.now().timestamp())}.{i:03d}"
+        sig = question_signature(qq)
+        qq["signature"] = sig
+        if sig in existing_sigs:
+            rejected += 1
+            reason = "duplicate signature"
+            reject_reasons_questions[reason] = reject_reasons_questions.get(reason, 0) + 1
+            continue
+        if signatures is not None and signatures.conflict(sig, bkey):
+            rejected += 1
+            reason = "duplicate signature in another block"
+            reject_reasons_questions[reason] = reject_reasons_questions.get(reason, 0) + 1
+            continue
+        validation_errors = validate_question(qq, chapter_id, {block["id"]})
+        if validation_errors:
+            rejected += 1
+            for reason in set(validation_errors):
+                reject_reasons_questions[reason] = reject_reasons_questions.get(reason, 0) + 1
+            if tally is not None and any(pack_schema.is_structural(reason) for reason in validation_errors):
+                tally["structural_rejected"] = tally.get("structural_rejected", 0) + 1
+            continue
+        if near_dupes is not None:
+            match = near_dupes.claim(
+                qq, {"source": near_dup_index.SOURCE_GENERATED, "block_key": bkey, "question_id": qq["id"], "signature": sig}
+            )
+            if match is not None:
+                rejected += 1
+                reason = "near-duplicate question"
+                reject_reasons_questions[reason] = reject_reasons_questions.get(reason, 0) + 1
+                continue
+        accepted.append(qq)
+        existing_sigs.add(sig)
+        if len(accepted) >= questions_per_block:
+            break
+    return rejected
+
+
+def generate_block_questions(
+    system_prompt: str,
+    chapter: dict,
+    block: dict,
+    existing_sigs: set,
+    questions_per_block: int,
+    llm: llm_client.LLMClient,
+    runs_dir: Path,
+    bundle_id: str,
+    prompt_layout: str = "prefix",
+    response_cache: llm_cache.LLMResponseCache | None = None,
+    signatures: signature_index.SignatureIndex | None = None,
+    near_dupes: near_dup_index.NearDuplicateIndex | None = None,
+    request_factor: float = 1.0,
+    decoding: str = llm_client.DECODING_FREE,
 ):
-    system_prompt = load_system_prompt(course_root)
-    pack_dir = course_root / "training_pack"
-    pack_chapters_dir = pack_dir / "chapters"
-    runs_dir = pack_dir / "runs" / datetime.now(timezone.utc).strftime("%Y%m%d_%H%M%S")
-    (pack_dir / "reports").mkdir(parents=True, exist_ok=True)
-    pack_chapters_dir.mkdir(parents=True, exist_ok=True)
-    runs_dir.mkdir(parents=True, exist_ok=True)
-
-    bundle_id = (course_root / "bundle.target").read_text(encoding="utf-8").strip()
-    gen_cfg = load_generator_config(course_root)
-    gen_version = gen_cfg.get("generator_version", "training-pack-generator-v3")
-    prompt_version = gen_cfg.get("prompt_version", "en-grammar-pack-v1-mcq-single")
-
-    index, block_payloads = load_existing_pack(course_root) if append else ({"chapters": {}, "blocks": {}}, {})
-    config = {
-        "version": "1.0.0",
-        "language": bundle_id,
-        "course_id": course_root.name,
-        "generated_at": utc_now(),
-        "generator_version": gen_version,
-        "mode": "llm-only",
-        "prompt_version": prompt_version,
-        "chapters": {},
-        "blocks": dict(index.get("blocks", {})),
+    # All retry state lives in this call, so blocks can run concurrently without sharing it.
+    chapter_id = chapter["id"]
+    chapter_idx = int(chapter.get("__index", 0))
+    block_idx = int(block.get("index", 0))
+    existing_sigs = set(existing_sigs)
+    accepted = []
+    rejected_total = 0
+    reject_reasons_questions: Dict[str, int] = {}
+    zero_gain_streak = 0
+    attempt = 0
+    tokens_saved = 0
+    requested = received = 0
+    prompt_stats: Dict[str, int] = {}
+    token_usage: List[dict] = []
+
+    while len(accepted) < questions_per_block and zero_gain_streak < 2:
+        attempt += 1
+        remaining_needed = max(1, questions_per_block - len(accepted))
+        request_count = acceptance.scaled_count(remaining_needed, request_factor)
+        requested += request_count
+        sizing_note = f", запрос {request_count} (x{request_factor})" if request_count > remaining_needed else ""
+        log_cyan(f"  • Попытка {attempt}: нужно добавить {remaining_needed} (цель {questions_per_block}){sizing_note}")
+        accepted_before_attempt = len(accepted)
+        attempt_state = {"items": 0, "checked": 0, "rejected": 0, "structural_rejected": 0}
+
+        def on_item(_key, item):
+            # Validation and dedup run while the response is still streaming.
+            nonlocal received
+            attempt_state["items"] += 1
+            if len(accepted) >= questions_per_block:
+                return True
+            received += 1
+            attempt_state["checked"] += 1
+            attempt_state["rejected"] += accept_llm_questions(
+                [item],
+                chapter_id,
+                block,
+                existing_sigs,
+                accepted,
+                questions_per_block,
+                reject_reasons_questions,
+                signatures,
+                near_dupes,
+                item_offset=attempt_state["items"] - 1,
+                tally=attempt_state,
+            )
+            return len(accepted) >= questions_per_block
+
+        _, raw_text, err, stream_stats = generate_for_block_llm(
+            system_prompt, block, request_count, llm, prompt_layout, response_cache, on_item=on_item, decoding=decoding
+        )
+        add_prompt_stats(prompt_stats, stream_stats)
+        add_decoding_stats(
+            prompt_stats, stream_stats, attempt_state["checked"], attempt_state["structural_rejected"], bool(err)
+        )
+        token_usage.append(
+            dict(
+                tokens.attempt_usage(stream_stats),
+                attempt=attempt,
+                block_id=block["id"],
+                requested=request_count,
+                received=attempt_state["checked"],
+                accepted=len(accepted) - accepted_before_attempt,
+                spec_tokens=block.get("spec_tokens"),
+                spec_tokens_method=block.get("spec_tokens_method"),
+                error=short_err(err) if err else None,
+            )
+        )
+        tokens_saved += int(stream_stats.get("tokens_saved_est") or 0)
+        raw_path = runs_dir / (
+            f"{bundle_id}.{chapter_idx:03d}.{block_idx:03d}.{chapter_id}.{block['id']}.attempt{attempt:02d}.raw.json"
+        )
+        write_json(raw_path, {"attempt": attempt, "error": err, "raw_response": raw_text, "stream": stream_stats})
+        log_cyan(f"    raw-log: {raw_path.name}")
+        if err:
+            log_yellow(f"    ✗ ошибка LLM на попытке {attempt}: {short_err(err)}")
+            zero_gain_streak += 1
+            continue
+
+        gained = len(accepted) - accepted_before_attempt
+        rejected_total += attempt_state["rejected"]
+        if gained > 0:
+            zero_gain_streak = 0
+        else:
+            zero_gain_streak += 1
+        mark = "✓" if gained > 0 else "·"
+        log_cyan(f"    {mark} попытка {attempt}: +{gained}, всего {len(accepted)}, 0-подряд={zero_gain_streak}")
+
+    return {
+        "accepted": accepted,
+        "rejected_total": rejected_total,
+        "reject_reasons_questions": reject_reasons_questions,
+        "attempts": attempt,
+        "requested": requested,
+        "received": received,
+        "tokens_saved_est": tokens_saved,
+        "token_usage": token_usage,
+        "prompt_stats": dict(prompt_stats, questions_accepted=len(accepted)),
     }
 
-    selected = parse_selection(load_chapters(course_root), chapter_number=chapter_number, block_number=block_number)
-    if not selected:
-        raise SystemExit("No target theory blocks found for selected filters")
-    log_bold(f"▶ Старт генерации: блоков в работе = {len(selected)}")
-    generated_blocks = 0
 
-    for chapter, block in selected:
-        chapter_id = chapter["id"]
-        chapter_idx = int(chapter.get("__index", 0))
-        block_idx = int(block.get("index", 0))
-        bkey = block_key(chapter_id, block["id"])
-        rel = block_rel_path(bundle_id, chapter_idx, block_idx, block["id"])
-        log_bold(f"■ Глава {chapter.get('__index')}, блок {block.get('index')}: старт")
-        existing_payload = block_payloads.get(
-            bkey,
-            {
-                "chapter_id": chapter_id,
-                "theory_block_id": block["id"],
-                "course_version": chapter.get("schema_version", "1.0.0"),
-                "questions": [],
-                "meta": {},
-            },
+def generate_batch_questions(
+    system_prompt: str,
+    chapter: dict,
+    blocks: List[dict],
+    existing_sigs: Dict[str, set],
+    questions_per_block: int,
+    llm: llm_client.LLMClient,
+    runs_dir: Path,
+    bundle_id: str,
+    prompt_layout: str = "prefix",
+    response_cache: llm_cache.LLMResponseCache | None = None,
+    signatures: signature_index.SignatureIndex | None = None,
+    near_dupes: near_dup_index.NearDuplicateIndex | None = None,
+    request_factors: Dict[str, float] | None = None,
+    decoding: str = llm_client.DECODING_FREE,
+):
+    """Generate for several blocks of one chapter with shared requests; returns per-block results."""
+    if len(blocks) == 1:
+        block = blocks[0]
+        result = generate_block_questions(
+            system_prompt,
+            chapter,
+            block,
+            existing_sigs[block["id"]],
+            questions_per_block,
+            llm,
+            runs_dir,
+            bundle_id,
+            prompt_layout=prompt_layout,
+            response_cache=response_cache,
+            signatures=signatures,
+            near_dupes=near_dupes,
+            request_factor=(request_factors or {}).get(block["id"], 1.0),
+            decoding=decoding,
         )
-        existing_questions = existing_payload.get("questions", [])
-        cleaned_existing = []
-        dropped_existing = 0
-        for exq in existing_questions:
-            if not isinstance(exq, dict):
-                dropped_existing += 1
-                continue
-            qq = dict(exq)
-            removed_choice_dups = dedupe_choice_texts_keep_correct(qq)
-            if removed_choice_dups > 0:
-                log_yellow(f"  ⚠ очищены дубли вариантов в существующих вопросах: -{removed_choice_dups}")
-            if not isinstance(qq.get("choices"), list) or len(qq.get("choices")) != 4:
-                dropped_existing += 1
-                continue
-            cleaned_existing.append(qq)
-        if dropped_existing > 0:
-            log_yellow(f"  ⚠ удалено битых существующих вопросов: {dropped_existing}")
-        existing_questions = cleaned_existing
-        existing_sigs = {q.get("signature") or question_signature(q) for q in existing_questions if isinstance(q, dict)}
+        return {"blocks": {block["id"]: result}, "prompt_stats": result.pop("prompt_stats")}
+
+    chapter_id = chapter["id"]
+    chapter_idx = int(chapter.get("__index", 0))
+    specs = {b["id"]: b for b in blocks}
+    states = {
+        b["id"]: {
+            "accepted": [],
+            "rejected_total": 0,
+            "reject_reasons_questions": {},
+            "attempts": 0,
+            "requested": 0,
+            "received": 0,
+            "tokens_saved_est": 0,
+            "token_usage": [],
+            "existing_sigs": set(existing_sigs[b["id"]]),
+            "zero_gain_streak": 0,
+        }
+        for b in blocks
+    }
+    span = f"{int(blocks[0].get('index', 0)):03d}-{int(blocks[-1].get('index', 0)):03d}"
+    prompt_stats: Dict[str, int] = {}
+    attempt = 0
+
+    while True:
+        counts = {
+            bid: acceptance.scaled_count(questions_per_block - len(st["accepted"]), (request_factors or {}).get(bid, 1.0))
+            for bid, st in states.items()
+            if len(st["accepted"]) < questions_per_block and st["zero_gain_streak"] < 2
+        }
+        if not counts:
+            break
+        for bid, n in counts.items():
+            states[bid]["requested"] += n
+        attempt += 1
+        log_cyan(f"  • Пакет {span}, попытка {attempt}: " + ", ".join(f"блок {specs[bid].get('index')} +{n}" for bid, n in counts.items()))
+        before = {bid: len(states[bid]["accepted"]) for bid in counts}
+        received_before = {bid: states[bid]["received"] for bid in counts}
+        streamed = {bid: 0 for bid in counts}
+        tally = {"checked": 0, "structural_rejected": 0}
+
+        def batch_target_met():
+            return all(len(states[bid]["accepted"]) >= questions_per_block for bid in counts)
+
+        def on_item(bid, item):
+            # Items of blocks not asked for in this attempt are ignored, as are extras past the target.
+            if bid not in counts:
+                return batch_target_met()
+            st = states[bid]
+            streamed[bid] += 1
+            if len(st["accepted"]) >= questions_per_block:
+                return batch_target_met()
+            st["received"] += 1
+            tally["checked"] += 1
+            st["rejected_total"] += accept_llm_questions(
+                [item],
+                chapter_id,
+                specs[bid],
+                st["existing_sigs"],
+                st["accepted"],
+                questions_per_block,
+                st["reject_reasons_questions"],
+                signatures,
+                near_dupes,
+                item_offset=streamed[bid] - 1,
+                tally=tally,
+            )
+            return batch_target_met()
 
-        accepted = []
-        rejected_total = 0
-        reject_reasons_questions: Dict[str, int] = {}
-        zero_gain_streak = 0
-        attempt = 0
-
-        while len(accepted) < questions_per_block and zero_gain_streak < 2:
-            attempt += 1
-            remaining_needed = max(1, questions_per_block - len(accepted))
-            log_cyan(f"  • Попытка {attempt}: нужно добавить {remaining_needed} (цель {questions_per_block})")
-            llm_qs, raw_text, err = generate_for_block_llm(system_prompt, block, remaining_needed, llm_model, llm_base_url)
-            raw_path = runs_dir / (
-                f"{bundle_id}.{chapter_idx:03d}.{block_idx:03d}.{chapter_id}.{block['id']}.attempt{attempt:02d}.raw.json"
+        by_block, raw_text, err, stream_stats = generate_for_batch_llm(
+            system_prompt, [specs[bid] for bid in counts], counts, llm, response_cache, on_item=on_item, decoding=decoding
+        )
+        add_prompt_stats(prompt_stats, stream_stats)
+        add_decoding_stats(prompt_stats, stream_stats, tally["checked"], tally["structural_rejected"], bool(err))
+        saved = int(stream_stats.get("tokens_saved_est") or 0)
+        for bid, n in counts.items():
+            # A cut batch stream is shared: attribute the saving by requested share.
+            states[bid]["tokens_saved_est"] += round(saved * n / sum(counts.values()))
+        raw_path = runs_dir / f"{bundle_id}.{chapter_idx:03d}.batch{span}.{chapter_id}.attempt{attempt:02d}.raw.json"
+        write_json(
+            raw_path,
+            {"attempt": attempt, "blocks": list(counts), "error": err, "raw_response": raw_text, "stream": stream_stats},
+        )
+        log_cyan(f"    raw-log: {raw_path.name}")
+        if err:
+            log_yellow(f"    ✗ ошибка LLM на попытке {attempt}: {short_err(err)}")
+        for bid in counts:
+            st = states[bid]
+            st["attempts"] += 1
+            # Tokens of a shared request are split between its blocks by requested share.
+            st["token_usage"].append(
+                dict(
+                    tokens.attempt_usage(stream_stats, counts[bid] / sum(counts.values())),
+                    attempt=attempt,
+                    block_id=bid,
+                    batch_blocks=len(counts),
+                    requested=counts[bid],
+                    received=st["received"] - received_before[bid],
+                    accepted=len(st["accepted"]) - before[bid],
+                    spec_tokens=specs[bid].get("spec_tokens"),
+                    spec_tokens_method=specs[bid].get("spec_tokens_method"),
+                    error=short_err(err) if err else None,
+                )
             )
-            write_json(raw_path, {"attempt": attempt, "error": err, "raw_response": raw_text})
-            log_cyan(f"    raw-log: {raw_path.name}")
-            if err:
-                log_yellow(f"    ✗ ошибка LLM на попытке {attempt}: {short_err(err)}")
-                zero_gain_streak += 1
+            if err or not isinstance(by_block.get(bid), list):
+                if not err:
+                    log_yellow(f"    ✗ блок {specs[bid].get('index')}: нет массива вопросов в ответе")
+                st["zero_gain_streak"] += 1
                 continue
+            gained = len(st["accepted"]) - before[bid]
+            st["zero_gain_streak"] = 0 if gained > 0 else st["zero_gain_streak"] + 1
+            mark = "✓" if gained > 0 else "·"
+            log_cyan(
+                f"    {mark} блок {specs[bid].get('index')}, попытка {attempt}: +{gained}, "
+                f"всего {len(st['accepted'])}, 0-подряд={st['zero_gain_streak']}"
+            )
 
-            accepted_before_attempt = len(accepted)
-            rejected_attempt = 0
-            for i, q in enumerate(llm_qs, start=1):
-                if not isinstance(q, dict):
-                    rejected_attempt += 1
-                    reason = "payload item is not an object"
-                    reject_reasons_questions[reason] = reject_reasons_questions.get(reason, 0) + 1
-                    continue
-                qq = dict(q)
-                qq["type"] = "mcq_single"
-                qq["theory_block_id"] = block["id"]
-                qq["chapter_id"] = chapter_id
-                qq["concept_id"] = qq.get("concept_id") or block.get("concept_id") or ""
-                qq["difficulty"] = max(1, min(5, int(qq.get("difficulty", 2))))
-                normalize_choice_ids_and_correct_answer(qq)
-                removed_choice_dups = dedupe_choice_texts_keep_correct(qq)
-                if removed_choice_dups > 0:
-                    log_yellow(f"    ⚠ q#{i}: убраны дубли вариантов (-{removed_choice_dups})")
-                if not qq.get("id"):
-                    qq["id"] = f"{chapter_id}.{block['id']}.gen.{int(datetime.now().timestamp())}.{i:03d}"
-                sig = question_signature(qq)
-                qq["signature"] = sig
-                if sig in existing_sigs:
-                    rejected_attempt += 1
-                    reason = "duplicate signature"
-                    reject_reasons_questions[reason] = reject_reasons_questions.get(reason, 0) + 1
-                    continue
-                validation_errors = validate_question(qq, chapter_id, {block["id"]})
-                if validation_errors:
-                    rejected_attempt += 1
-                    for reason in set(validation_errors):
-                        reject_reasons_questions[reason] = reject_reasons_questions.get(reason, 0) + 1
-                    continue
-                accepted.append(qq)
-                existing_sigs.add(sig)
-                if len(accepted) >= questions_per_block:
-                    break
+    prompt_stats["questions_accepted"] = sum(len(st["accepted"]) for st in states.values())
+    results = {
+        bid: {
+            "accepted": st["accepted"],
+            "rejected_total": st["rejected_total"],
+            "reject_reasons_questions": st["reject_reasons_questions"],
+            "attempts": st["attempts"],
+            "requested": st["requested"],
+            "received": st["received"],
+            "tokens_saved_est": st["tokens_saved_est"],
+            "token_usage": st["token_usage"],
+        }
+        for bid, st in states.items()
+    }
+    return {"blocks": results, "prompt_stats": prompt_stats}
 
-            gained = len(accepted) - accepted_before_attempt
-            rejected_total += rejected_attempt
-            if gained > 0:
-                zero_gain_streak = 0
-            else:
-                zero_gain_streak += 1
-            mark = "✓" if gained > 0 else "·"
-            log_cyan(f"    {mark} попытка {attempt}: +{gained}, всего {len(accepted)}, 0-подряд={zero_gain_streak}")
-
-        if not append:
-            existing_questions = []
-        existing_questions.extend(accepted)
-        renumber_question_ids(existing_questions)
-        existing_payload["questions"] = existing_questions
-        existing_payload["meta"] = {
+
+def _generate_block_job(worker_tag: str, job, **kwargs):
+    _LOG_CONTEXT.prefix = worker_tag
+    _LOG_CONTEXT.quiet_stream = bool(worker_tag)
+    try:
+        return job(**kwargs)
+    finally:
+        _LOG_CONTEXT.prefix = ""
+        _LOG_CONTEXT.quiet_stream = False
+
+
+JOURNAL_NAME = "journal.jsonl"
+
+
+def load_journal(path: Path) -> List[dict]:
+    events = []
+    if not path.exists():
+        return events
+    for line in path.read_text(encoding="utf-8").splitlines():
+        try:
+            event = json.loads(line)
+        except Exception:
+            # A run killed mid-write leaves a truncated last line.
+            continue
+        if isinstance(event, dict):
+            events.append(event)
+    return events
+
+
+def find_resumable_run(pack_dir: Path, stamp: str | None = None) -> Path:
+    runs_root = pack_dir / "runs"
+    if stamp:
+        run_dir = runs_root / stamp
+        if not (run_dir / JOURNAL_NAME).exists():
+            raise SystemExit(f"No checkpoint journal in {run_dir}")
+        return run_dir
+    for run_dir in sorted((p for p in runs_root.iterdir() if p.is_dir()), reverse=True):
+        # Only generator runs write a start event; fill and replay runs are not resumable this way.
+        events = load_journal(run_dir / JOURNAL_NAME)
+        if any(e.get("event") == "start" for e in events) and not any(e.get("event") == "done" for e in events):
+            return run_dir
+    raise SystemExit("No interrupted run with a checkpoint journal found in training_pack/runs")
+
+
+class TrainingPackEngine:
+    """Generation state kept resident in memory: chapters, block payloads and index.
+
+    build_pack() uses it for a single run; fill-training-pack.py keeps one instance
+    across all rounds instead of spawning this script per round.
+    """
+
+    def __init__(
+        self,
+        course_root: Path,
+        llm_model: str,
+        llm_base_url: str,
+        append: bool = True,
+        llm_max_inflight: int = 0,
+        prompt_layout: str | None = None,
+        response_cache: bool = False,
+        response_cache_max_mb: int = 512,
+        run_stamp: str | None = None,
+        near_dup_threshold: float = 0.0,
+        max_request_factor: float | None = None,
+        decoding: str | None = None,
+        spec_profile: str | None = None,
+        exact_tokens: bool = False,
+        llm_weights: str | None = None,
+        llm_routing: str | None = None,
+        llm_max_request_s: float | None = None,
+        llm_ttft_s: float | None = None,
+        llm_min_tokens_per_s: float | None = None,
+    ):
+        self.course_root = course_root
+        gen_cfg = load_generator_config(course_root)
+        defaults = gen_cfg.get("defaults", {}) if isinstance(gen_cfg.get("defaults", {}), dict) else {}
+        self.prompt_layout = prompt_layout or defaults.get("prompt_layout") or "prefix"
+        if self.prompt_layout not in PROMPT_LAYOUTS:
+            raise SystemExit(f"Unknown prompt layout: {self.prompt_layout} (expected one of {', '.join(PROMPT_LAYOUTS)})")
+        self.decoding = decoding or defaults.get("decoding") or llm_client.DECODING_FREE
+        if self.decoding not in llm_client.DECODING_MODES:
+            raise SystemExit(f"Unknown decoding mode: {self.decoding} (expected one of {', '.join(llm_client.DECODING_MODES)})")
+        llm_routing = llm_routing or defaults.get("llm_routing") or llm_pool.ROUTING_LEAST_OUTSTANDING
+        if llm_routing not in llm_pool.ROUTINGS:
+            raise SystemExit(f"Unknown LLM routing: {llm_routing} (expected one of {', '.join(llm_pool.ROUTINGS)})")
+        self.stall_limits = llm_client.StallLimits(
+            total_s=float(llm_max_request_s if llm_max_request_s is not None else defaults.get("llm_max_request_s", 0)),
+            ttft_s=float(llm_ttft_s if llm_ttft_s is not None else defaults.get("llm_ttft_s", 0)),
+            min_tokens_per_s=float(
+                llm_min_tokens_per_s if llm_min_tokens_per_s is not None else defaults.get("llm_min_tokens_per_s", 0)
+            ),
+        )
+        try:
+            self.llm = llm_pool.connect(
+                llm_base_url,
+                llm_model,
+                api_key=llm_api_key(),
+                weights=llm_weights or defaults.get("llm_weights"),
+                routing=llm_routing,
+                timeout_s=360,
+                temperature=0.1,
+                max_inflight=llm_max_inflight,
+                cache_prompt=self.prompt_layout == "prefix",
+                stall_limits=self.stall_limits,
+            )
+        except ValueError as e:
+            raise SystemExit(f"Invalid --llm-weights: {e}")
+        if isinstance(self.llm, llm_pool.LLMPool):
+            health = self.llm.check_health()
+            down = [url for url, ok in health.items() if not ok]
+            if len(down) == len(health):
+                raise SystemExit(f"Ни один LLM-сервер не отвечает: {', '.join(down)}")
+            log_cyan(f"LLM-серверов: {len(health)} ({llm_routing}), недоступны: {', '.join(down) or 'нет'}")
+        if self.stall_limits.enabled:
+            limits = self.stall_limits
+            log_cyan(
+                f"Сторож запросов LLM: всего до {limits.total_s:g} с, первый токен до {limits.ttft_s:g} с, "
+                f"не медленнее {limits.min_tokens_per_s:g} ток/с (0 = без ограничения)"
+            )
+        self.response_cache = (
+            llm_cache.LLMResponseCache(llm_cache.cache_dir(course_root), response_cache_max_mb * 1024 * 1024)
+            if response_cache
+            else None
+        )
+        self.max_request_factor = float(
+            max_request_factor if max_request_factor is not None else defaults.get("max_request_factor", DEFAULT_MAX_REQUEST_FACTOR)
+        )
+        self.append = append
+        self.pack_dir = course_root / "training_pack"
+        self.pack_chapters_dir = self.pack_dir / "chapters"
+        self.runs_dir = self.pack_dir / "runs" / (run_stamp or datetime.now(timezone.utc).strftime("%Y%m%d_%H%M%S"))
+        self.journal_path = self.runs_dir / JOURNAL_NAME
+        (self.pack_dir / "reports").mkdir(parents=True, exist_ok=True)
+        self.pack_chapters_dir.mkdir(parents=True, exist_ok=True)
+        self.runs_dir.mkdir(parents=True, exist_ok=True)
+
+        self.system_prompt = load_system_prompt(course_root)
+        self.bundle_id = (course_root / "bundle.target").read_text(encoding="utf-8").strip()
+        self.course = course_index.load_course_index(course_root)
+        self.spec_profile = spec_profile or defaults.get("spec_profile") or block_specs.PROFILE_FULL
+        if self.spec_profile not in block_specs.PROFILES:
+            raise SystemExit(f"Unknown spec profile: {self.spec_profile} (expected one of {', '.join(block_specs.PROFILES)})")
+        self.block_specs = block_specs.BlockSpecCache(self.course, self.spec_profile)
+        # Exact block INPUT sizes through llama.cpp /tokenize; estimates otherwise.
+        self.token_counter = tokens.TokenCounter(self.llm) if exact_tokens else None
+        self.signatures = signature_index.load_signature_index(self.pack_dir)
+        self.acceptance = acceptance.AcceptanceStats(self.pack_dir)
+        # Opt-in: sketches the whole training pack and every chapter question_bank at startup.
+        self.near_dupes = (
+            near_dup_index.build_course_index(course_root, self.course, threshold=near_dup_threshold)
+            if near_dup_threshold > 0
+            else None
+        )
+        index, self.block_payloads = load_existing_pack(course_root) if append else ({"chapters": {}, "blocks": {}}, {})
+        self.config = {
+            "version": "1.0.0",
+            "language": self.bundle_id,
+            "course_id": course_root.name,
             "generated_at": utc_now(),
-            "source": "llm-only",
-            "questions_per_block": questions_per_block,
-            "chapter_number_filter": chapter_number or None,
-            "block_number_filter": block_number or None,
-            "append": append,
+            "generator_version": gen_cfg.get("generator_version", "training-pack-generator-v3"),
+            "mode": "llm-only",
+            "prompt_version": gen_cfg.get("prompt_version", "en-grammar-pack-v1-mcq-single"),
+            "chapters": {},
+            "blocks": dict(index.get("blocks", {})),
         }
-        write_json(pack_chapters_dir / rel, existing_payload)
-        config["blocks"][bkey] = rel
-        config["chapters"].setdefault(chapter_id, [])
-        if rel not in config["chapters"][chapter_id]:
-            config["chapters"][chapter_id].append(rel)
+        self.index_dirty = False
+        self.prompt_stats: Dict[str, int] = {}
+
+    def select(self, chapter_number: int, block_number: int):
+        return self.course.select(chapter_number=chapter_number, block_number=block_number)
+
+    def block_spec(self, chapter: dict, block: dict) -> dict:
+        spec = self.block_specs.spec(chapter, block)
+        if self.token_counter is not None:
+            spec["spec_tokens"], spec["spec_tokens_method"] = self.token_counter.count(spec["spec_json"])
+        else:
+            spec["spec_tokens"], spec["spec_tokens_method"] = spec["spec_tokens_est"], tokens.METHOD_ESTIMATE
+        return spec
+
+    def block_payload(self, chapter: dict, block: dict) -> dict:
+        bkey = block_key(chapter["id"], block["id"])
+        if bkey not in self.block_payloads:
+            self.block_payloads[bkey] = empty_block_payload(chapter, block)
+        return self.block_payloads[bkey]
+
+    def prepare_block(self, chapter: dict, block: dict):
+        existing_payload = self.block_payload(chapter, block)
+        existing_questions = clean_existing_questions(existing_payload.get("questions", []))
+        existing_sigs = {q.get("signature") or question_signature(q) for q in existing_questions if isinstance(q, dict)}
+        return existing_payload, existing_questions, existing_sigs
+
+    def _job_args(self, chapter: dict, block: dict, existing_sigs: set, questions_per_block: int) -> dict:
+        return dict(
+            system_prompt=self.system_prompt,
+            chapter=chapter,
+            block=self.block_spec(chapter, block),
+            existing_sigs=existing_sigs,
+            questions_per_block=questions_per_block,
+            llm=self.llm,
+            runs_dir=self.runs_dir,
+            bundle_id=self.bundle_id,
+            prompt_layout=self.prompt_layout,
+            response_cache=self.response_cache,
+            signatures=self.signatures,
+            near_dupes=self.near_dupes,
+            request_factor=self.request_factor(chapter, block),
+            decoding=self.decoding,
+        )
+
+    def request_factor(self, chapter: dict, block: dict) -> float:
+        return self.acceptance.request_factor(self.llm.model, block_key(chapter["id"], block["id"]), self.max_request_factor)
+
+    def batch_groups(self, selected: List[tuple], batch_blocks: int) -> List[List[tuple]]:
+        # Consecutive blocks of one chapter share a request while their specs stay small.
+        groups: List[List[tuple]] = []
+        group_chars = 0
+        for chapter, block in selected:
+            spec_chars = len(self.block_spec(chapter, block)["spec_json"])
+            if (
+                groups
+                and len(groups[-1]) < batch_blocks
+                and groups[-1][0][0]["id"] == chapter["id"]
+                and group_chars + spec_chars <= BATCH_MAX_INPUT_CHARS
+            ):
+                groups[-1].append((chapter, block))
+                group_chars += spec_chars
+                continue
+            groups.append([(chapter, block)])
+            group_chars = spec_chars
+        return groups
+
+    def _batch_job_args(self, group: List[tuple], prepared: List[tuple], questions_per_block: int) -> dict:
+        chapter = group[0][0]
+        return dict(
+            system_prompt=self.system_prompt,
+            chapter=chapter,
+            blocks=[self.block_spec(chapter, block) for _, block in group],
+            existing_sigs={block["id"]: sigs for (_, block), (_, _, sigs) in zip(group, prepared)},
+            questions_per_block=questions_per_block,
+            llm=self.llm,
+            runs_dir=self.runs_dir,
+            bundle_id=self.bundle_id,
+            prompt_layout=self.prompt_layout,
+            response_cache=self.response_cache,
+            signatures=self.signatures,
+            near_dupes=self.near_dupes,
+            request_factors={block["id"]: self.request_factor(chapter, block) for _, block in group},
+            decoding=self.decoding,
+        )
+
+    def commit_batch(self, group: List[tuple], prepared: List[tuple], batch_result: dict, questions_per_block: int, **filters):
+        merge_prompt_stats(self.prompt_stats, batch_result["prompt_stats"])
+        results = []
+        for (chapter, block), (existing_payload, existing_questions, _) in zip(group, prepared):
+            result = batch_result["blocks"][block["id"]]
+            self.commit_block(chapter, block, existing_payload, existing_questions, result, questions_per_block, **filters)
+            results.append(result)
+        return results
+
+    def commit_block(
+        self,
+        chapter: dict,
+        block: dict,
+        existing_payload: dict,
+        existing_questions: List[dict],
+        result: dict,
+        questions_per_block: int,
+        chapter_number_filter: int = 0,
+        block_number_filter: int = 0,
+    ):
+        # Single writer for block files and config: never call from worker threads.
+        chapter_id = chapter["id"]
+        bkey = block_key(chapter_id, block["id"])
+        rel = block_rel_path(self.bundle_id, int(chapter.get("__index", 0)), int(block.get("index", 0)), block["id"])
+        with pack_io.pack_lock(self.pack_dir):
+            existing_payload, existing_questions, result["accepted"] = self._reload_if_changed(
+                chapter, block, existing_payload, existing_questions, result["accepted"]
+            )
+            # Concurrent blocks can accept the same signature; the first commit keeps it.
+            result["accepted"] = [q for q in result["accepted"] if not self.signatures.conflict(q["signature"], bkey)]
+            accepted = result["accepted"]
+            if self.near_dupes is not None:
+                # Questions dropped above never reach the pack: free their near-duplicate claims.
+                self.near_dupes.settle(bkey, (q["signature"] for q in accepted))
+            if not self.append:
+                existing_questions = []
+            existing_questions.extend(accepted)
+            renumber_question_ids(existing_questions)
+            existing_payload["questions"] = existing_questions
+            existing_payload["meta"] = {
+                "generated_at": utc_now(),
+                "source": "llm-only",
+                "questions_per_block": questions_per_block,
+                "chapter_number_filter": chapter_number_filter or None,
+                "block_number_filter": block_number_filter or None,
+                "append": self.append,
+            }
+            self.block_payloads[bkey] = existing_payload
+            self._write_block_file(chapter, block)
+        self.register_block(chapter_id, bkey, rel)
+        if result.get("requested"):
+            # Replayed logs made no request: nothing to learn for request sizing.
+            self.acceptance.record(self.llm.model, bkey, result)
+        usage = result.get("token_usage") or []
+        tokens.append_usage(
+            self.runs_dir,
+            [
+                dict(
+                    record,
+                    chapter_id=chapter_id,
+                    chapter_index=chapter.get("__index"),
+                    block_index=block.get("index"),
+                    model=self.llm.model,
+                )
+                for record in usage
+            ],
+        )
+        self.journal(
+            {
+                "event": "block",
+                "block_key": bkey,
+                "chapter_id": chapter_id,
+                "block_id": block["id"],
+                "rel": rel,
+                "accepted": len(accepted),
+                "total": len(existing_questions),
+                "attempts": result.get("attempts", 0),
+            }
+        )
         status_mark = "✅" if len(accepted) > 0 else "⚪"
+        summary = (
+            f"{status_mark} Глава {chapter.get('__index')}, блок {block.get('index')}: добавлено {len(accepted)}, "
+            f"отклонено {result['rejected_total']}, всего в файле {len(existing_questions)}"
+        )
+        if usage:
+            summary += (
+                f", токенов промпт {sum(r['prompt_tokens'] for r in usage)} / "
+                f"ответ {sum(r['completion_tokens'] for r in usage)}"
+            )
+        if result.get("tokens_saved_est"):
+            summary += f", обрезка потока сэкономила ≈{result['tokens_saved_est']} ток."
         if len(accepted) > 0:
-            log_green(f"{status_mark} Глава {chapter.get('__index')}, блок {block.get('index')}: добавлено {len(accepted)}, отклонено {rejected_total}, всего в файле {len(existing_questions)}")
+            log_green(summary)
         else:
-            log_yellow(f"{status_mark} Глава {chapter.get('__index')}, блок {block.get('index')}: добавлено {len(accepted)}, отклонено {rejected_total}, всего в файле {len(existing_questions)}")
+            log_yellow(summary)
+        reject_reasons_questions = result["reject_reasons_questions"]
         if reject_reasons_questions:
             for reason, count in sorted(reject_reasons_questions.items(), key=lambda item: (-item[1], item[0])):
                 log_yellow(f"    - {count} шт.: {reason}")
-        if accepted:
-            generated_blocks += 1
+        return rel
+
+    def _reload_if_changed(self, chapter: dict, block: dict, existing_payload: dict, existing_questions: List[dict], accepted: List[dict]):
+        # Call with pack_lock held. Another writer (admin UI, a second generator) may have changed
+        # the block file since it was prepared: build on the disk version, not the stale copy.
+        path = self.block_path(chapter, block)
+        if not self.append or not path.exists():
+            return existing_payload, existing_questions, accepted
+        try:
+            disk = read_json(path)
+        except Exception:
+            return existing_payload, existing_questions, accepted
+        if not isinstance(disk, dict) or disk.get("questions") == existing_payload.get("questions"):
+            return existing_payload, existing_questions, accepted
+        disk_questions = clean_existing_questions(disk.get("questions", []))
+        disk_sigs = {q.get("signature") or question_signature(q) for q in disk_questions}
+        kept = [q for q in accepted if q.get("signature") not in disk_sigs]
+        log_yellow(f"    ⚠ файл блока изменен другим процессом, дописываем к версии с диска (дублей -{len(accepted) - len(kept)})")
+        return disk, disk_questions, kept
+
+    def drop_block_claims(self, chapter: dict, block: dict):
+        """Forget near-duplicate claims of a block whose generation failed before commit_block()."""
+        if self.near_dupes is not None:
+            self.near_dupes.settle(block_key(chapter["id"], block["id"]))
+
+    def register_block(self, chapter_id: str, bkey: str, rel: str):
+        if self.config["blocks"].get(bkey) != rel:
+            self.index_dirty = True
+        self.config["blocks"][bkey] = rel
+        self.config["chapters"].setdefault(chapter_id, [])
+        if rel not in self.config["chapters"][chapter_id]:
+            self.config["chapters"][chapter_id].append(rel)
+
+    def journal(self, event: dict):
+        # Append-only checkpoint: one line per finished block, fsynced so a killed run keeps it.
+        line = json.dumps(dict(event, ts=utc_now()), ensure_ascii=False) + "\n"
+        with self.journal_path.open("a", encoding="utf-8") as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def restore_from_journal(self, events: List[dict]) -> Dict[str, dict]:
+        """Register blocks finished in an interrupted run; returns them by block key."""
+        finished = {}
+        for event in events:
+            if event.get("event") != "block" or not event.get("block_key") or not event.get("rel"):
+                continue
+            if not (self.pack_chapters_dir / event["rel"]).exists():
+                continue
+            self.register_block(event["chapter_id"], event["block_key"], event["rel"])
+            finished[event["block_key"]] = event
+        return finished
+
+    def block_path(self, chapter: dict, block: dict) -> Path:
+        rel = block_rel_path(self.bundle_id, int(chapter.get("__index", 0)), int(block.get("index", 0)), block["id"])
+        return self.pack_chapters_dir / rel
+
+    def block_summary(self, chapter: dict, block: dict) -> dict | None:
+        """questions / valid / sha256 of the block file, kept current by every write_block()."""
+        return self.signatures.summary(self.block_path(chapter, block).relative_to(self.pack_chapters_dir).as_posix())
+
+    def refresh_block(self, chapter: dict, block: dict) -> bool:
+        """Re-read the block file if another process changed it since this one last wrote or loaded it."""
+        path = self.block_path(chapter, block)
+        rel = path.relative_to(self.pack_chapters_dir).as_posix()
+        if self.signatures.is_current(rel) or not path.exists():
+            return False
+        try:
+            payload = read_json(path)
+        except Exception:
+            return False
+        self.block_payloads[block_key(chapter["id"], block["id"])] = payload
+        self.signatures.update_file(rel, payload)
+        self.register_block(chapter["id"], block_key(chapter["id"], block["id"]), rel)
+        return True
+
+    def write_block(self, chapter: dict, block: dict):
+        with pack_io.pack_lock(self.pack_dir):
+            self._write_block_file(chapter, block)
+
+    def _write_block_file(self, chapter: dict, block: dict):
+        payload = self.block_payload(chapter, block)
+        path = self.block_path(chapter, block)
+        write_json(path, payload, durable=True)
+        self.signatures.update_file(path.relative_to(self.pack_chapters_dir).as_posix(), payload)
+
+    def run_block(self, chapter: dict, block: dict, questions_per_block: int, chapter_number_filter: int = 0, block_number_filter: int = 0):
+        prepared = self.prepare_block(chapter, block)
+        result = generate_block_questions(**self._job_args(chapter, block, prepared[2], questions_per_block))
+        return self.finish_block(
+            chapter,
+            block,
+            prepared,
+            result,
+            questions_per_block,
+            chapter_number_filter=chapter_number_filter,
+            block_number_filter=block_number_filter,
+        )
+
+    def submit_block(self, executor, chapter: dict, block: dict, questions_per_block: int, worker_tag: str = ""):
+        """Start one block on `executor`; hand the future's result to finish_block() on the main thread."""
+        prepared = self.prepare_block(chapter, block)
+        fut = executor.submit(
+            _generate_block_job,
+            worker_tag,
+            generate_block_questions,
+            **self._job_args(chapter, block, prepared[2], questions_per_block),
+        )
+        return fut, prepared
+
+    def finish_block(self, chapter: dict, block: dict, prepared: tuple, result: dict, questions_per_block: int, **filters):
+        existing_payload, existing_questions, _ = prepared
+        merge_prompt_stats(self.prompt_stats, result["prompt_stats"])
+        self.commit_block(chapter, block, existing_payload, existing_questions, result, questions_per_block, **filters)
+        return result
+
+    def run_batch(self, group: List[tuple], questions_per_block: int, chapter_number_filter: int = 0, block_number_filter: int = 0):
+        prepared = [self.prepare_block(chapter, block) for chapter, block in group]
+        batch_result = generate_batch_questions(**self._batch_job_args(group, prepared, questions_per_block))
+        return self.commit_batch(
+            group,
+            prepared,
+            batch_result,
+            questions_per_block,
+            chapter_number_filter=chapter_number_filter,
+            block_number_filter=block_number_filter,
+        )
+
+    def run_blocks_concurrently(
+        self,
+        selected: List[tuple],
+        questions_per_block: int,
+        workers: int,
+        chapter_number_filter: int = 0,
+        block_number_filter: int = 0,
+        batch_blocks: int = 1,
+    ):
+        results = []
+        first_error = None
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            futs = {}
+            for group in self.batch_groups(selected, batch_blocks):
+                chapter, block = group[0]
+                blocks_label = ", ".join(str(b.get("index")) for _, b in group)
+                log_bold(f"■ Глава {chapter.get('__index')}, блок {blocks_label}: в очереди")
+                prepared = [self.prepare_block(c, b) for c, b in group]
+                worker_tag = f"[{int(chapter.get('__index', 0)):03d}.{int(block.get('index', 0)):02d}] "
+                fut = ex.submit(
+                    _generate_block_job,
+                    worker_tag,
+                    generate_batch_questions,
+                    **self._batch_job_args(group, prepared, questions_per_block),
+                )
+                futs[fut] = (group, prepared, blocks_label)
+            for fut in as_completed(futs):
+                group, prepared, blocks_label = futs[fut]
+                try:
+                    batch_result = fut.result()
+                except Exception as e:
+                    log_red(f"✗ Глава {group[0][0].get('__index')}, блок {blocks_label}: {short_err(e)}")
+                    # Commit the blocks that did finish (the journal keeps them for --resume),
+                    # then fail the run like the single-worker path does.
+                    first_error = first_error or e
+                    for c, b in group:
+                        self.drop_block_claims(c, b)
+                    continue
+                results.extend(
+                    self.commit_batch(
+                        group,
+                        prepared,
+                        batch_result,
+                        questions_per_block,
+                        chapter_number_filter=chapter_number_filter,
+                        block_number_filter=block_number_filter,
+                    )
+                )
+        if first_error is not None:
+            raise first_error
+        return results
+
+    def prompt_prefix_report(self) -> dict:
+        summary = dict(prompt_prefix_summary(self.prompt_stats), layout=self.prompt_layout, llama_cpp=self.llm.llamacpp)
+        write_json(self.runs_dir / "prompt-prefix.json", summary)
+        hit_chars = summary["prefix_hit_rate_chars"]
+        hit_tokens = summary["prefix_hit_rate_tokens"]
+        log_cyan(
+            f"Префикс промпта ({self.prompt_layout}): запросов {summary['requests']}, "
+            f"общий префикс {hit_chars if hit_chars is not None else '-'} по символам, "
+            f"KV-кэш {hit_tokens if hit_tokens is not None else '-'} по токенам"
+        )
+        return summary
+
+    def prompt_efficiency_report(self) -> dict:
+        summary = prompt_efficiency_summary(self.prompt_stats)
+        per_1k = summary["questions_per_1k_prompt_tokens"]
+        log_cyan(
+            f"Эффективность промптов: принято {summary['questions_accepted']} вопросов за {summary['requests']} запросов, "
+            f"{per_1k if per_1k is not None else '-'} вопросов на 1000 токенов промпта, "
+            f"обрезано потоков {summary['early_stops']} (≈{summary['tokens_saved_est']} ток.)"
+        )
+        return summary
+
+    def decoding_report(self) -> dict:
+        modes = decoding_summary(self.prompt_stats)
+        report = {"requested": self.decoding, "unsupported": sorted(self.llm.unsupported_decoding), "modes": modes}
+        for mode, counters in sorted(modes.items()):
+            rate = counters["structural_rejection_rate"]
+            log_cyan(
+                f"Декодирование {mode}: ответов {counters.get('responses', 0)}, проверено {counters.get('items', 0)}, "
+                f"отказов по структуре {counters.get('structural_rejected', 0)} ({rate if rate is not None else '-'}), "
+                f"ответов без вопросов {counters.get('failed_responses', 0)}"
+            )
+        return report
+
+    def backend_report(self) -> List[dict]:
+        if not isinstance(self.llm, llm_pool.LLMPool):
+            return []
+        report = self.llm.report()
+        for backend in report:
+            log_cyan(
+                f"LLM {backend['base_url']} (вес {backend['weight']:g}): запросов {backend['requests']}, "
+                f"ошибок {backend['failures']}, исключений {backend['ejections']}, "
+                f"токенов ответа {backend['completion_tokens']}, занят {backend['busy_s']:.1f} с, "
+                f"зависаний {backend['stalls']}, пауз {backend['pauses']}"
+                + (" — исключен" if backend["ejected"] else "")
+                + (" — на паузе" if backend["paused"] else "")
+            )
+        return report
+
+    def token_cost_report(self) -> dict:
+        """Rebuild reports/token-costs.json from all runs; returns this run's totals."""
+        report = tokens.write_cost_report(self.pack_dir)
+        run = tokens.build_cost_report(tokens.iter_run_usage(self.runs_dir))
+        summary = {k: run[k] for k in ("attempts", "cache_hits", "prompt_tokens", "completion_tokens", "accepted", "estimate_ratio")}
+        summary["tokens_per_accepted"] = (
+            round((run["prompt_tokens"] + run["completion_tokens"]) / run["accepted"], 1) if run["accepted"] else None
+        )
+        log_cyan(
+            f"Токены прогона: промпт {summary['prompt_tokens']}, ответ {summary['completion_tokens']}, "
+            f"на принятый вопрос {summary['tokens_per_accepted'] if summary['tokens_per_accepted'] is not None else '-'}; "
+            f"отчет по главам: {tokens.cost_report_path(self.pack_dir).relative_to(self.course_root)} "
+            f"(всего {report['attempts']} попыток)"
+        )
+        return summary
+
+    def spec_size_report(self, selected: List[tuple]) -> dict:
+        report = self.block_specs.size_report(selected)
+        log_cyan(
+            f"INPUT блоков ({report['profile']}): {report['blocks']} блоков, ≈{report['spec_tokens_est_total']} ток., "
+            f"в среднем {report['spec_tokens_est_mean']}, максимум {report['spec_tokens_est_max']}, "
+            f"пересериализовано глав {report['chapters_reserialized']}"
+        )
+        return report
+
+    def write_index(self):
+        path = self.pack_dir / "index.json"
+        with pack_io.pack_lock(self.pack_dir):
+            if self.append and path.exists():
+                # Keep blocks registered by other writers since this process loaded the index.
+                try:
+                    disk_blocks = read_json(path).get("blocks", {})
+                except Exception:
+                    disk_blocks = {}
+                if isinstance(disk_blocks, dict):
+                    for bkey, rel in disk_blocks.items():
+                        self.config["blocks"].setdefault(bkey, rel)
+            write_json(path, self.config, durable=True)
+            self._save_indexes()
+        self.index_dirty = False
+
+    def save_indexes(self):
+        with pack_io.pack_lock(self.pack_dir):
+            self._save_indexes()
+
+    def _save_indexes(self):
+        # Call with pack_lock held.
+        self.signatures.save()
+        self.acceptance.save()
+        self.block_specs.save()
+
+    def validate_block(self, chapter: dict, block: dict) -> dict:
+        payload = self.block_payload(chapter, block)
+        theory_ids = self.course.theory_block_ids(chapter["id"])
+        accepted, errors, duplicates = validate_block_payload(payload, chapter["id"], theory_ids, set())
+        return {"ok": not errors, "accepted_questions": len(accepted), "duplicates_removed": duplicates, "errors": errors}
+
+    def validate_pack(self, min_per_block: int):
+        return validate_pack(course_root=self.course_root, min_per_block=min_per_block, course=self.course)
+
+
+def build_pack(
+    course_root: Path,
+    min_per_block: int,
+    questions_per_block: int,
+    llm_model: str,
+    llm_base_url: str,
+    chapter_number: int,
+    block_number: int,
+    append: bool,
+    workers: int = 1,
+    llm_max_inflight: int = 0,
+    prompt_layout: str | None = None,
+    batch_blocks: int = 1,
+    response_cache: bool = False,
+    response_cache_max_mb: int = 512,
+    resume: str | None = None,
+    near_dup_threshold: float = 0.0,
+    max_request_factor: float | None = None,
+    decoding: str | None = None,
+    spec_profile: str | None = None,
+    exact_tokens: bool = False,
+    llm_weights: str | None = None,
+    llm_routing: str | None = None,
+    llm_max_request_s: float | None = None,
+    llm_ttft_s: float | None = None,
+    llm_min_tokens_per_s: float | None = None,
+):
+    events: List[dict] = []
+    run_stamp = None
+    if resume is not None:
+        # Selection and write mode come from the interrupted run, not from this command line.
+        run_dir = find_resumable_run(course_root / "training_pack", resume or None)
+        events = load_journal(run_dir / JOURNAL_NAME)
+        start = next((e for e in events if e.get("event") == "start"), {})
+        chapter_number = int(start.get("chapter_number", chapter_number) or 0)
+        block_number = int(start.get("block_number", block_number) or 0)
+        questions_per_block = int(start.get("questions_per_block", questions_per_block))
+        append = bool(start.get("append", append))
+        run_stamp = run_dir.name
+    engine = TrainingPackEngine(
+        course_root,
+        llm_model=llm_model,
+        llm_base_url=llm_base_url,
+        append=append,
+        llm_max_inflight=llm_max_inflight,
+        prompt_layout=prompt_layout,
+        response_cache=response_cache,
+        response_cache_max_mb=response_cache_max_mb,
+        run_stamp=run_stamp,
+        near_dup_threshold=near_dup_threshold,
+        max_request_factor=max_request_factor,
+        decoding=decoding,
+        spec_profile=spec_profile,
+        exact_tokens=exact_tokens,
+        llm_weights=llm_weights,
+        llm_routing=llm_routing,
+        llm_max_request_s=llm_max_request_s,
+        llm_ttft_s=llm_ttft_s,
+        llm_min_tokens_per_s=llm_min_tokens_per_s,
+    )
+    selected = engine.select(chapter_number=chapter_number, block_number=block_number)
+    if not selected:
+        raise SystemExit("No target theory blocks found for selected filters")
+    finished = engine.restore_from_journal(events)
+    if resume is not None:
+        selected = [(c, b) for c, b in selected if block_key(c["id"], b["id"]) not in finished]
+        engine.write_index()
+        engine.journal({"event": "resume", "finished_blocks": len(finished), "remaining_blocks": len(selected)})
+        log_bold(f"▶ Продолжение прогона {run_stamp}: готово блоков {len(finished)}, осталось {len(selected)}")
+    else:
+        engine.journal(
+            {
+                "event": "start",
+                "chapter_number": chapter_number,
+                "block_number": block_number,
+                "questions_per_block": questions_per_block,
+                "append": append,
+            }
+        )
+    attempts_before = engine.acceptance.attempts_per_run(engine.llm.model, [block_key(c["id"], b["id"]) for c, b in selected])
+    batch_blocks = max(1, int(batch_blocks or 1))
+    workers = max(1, min(int(workers or 1), len(selected) or 1))
+    log_bold(f"▶ Старт генерации: блоков в работе = {len(selected)}, воркеров = {workers}, блоков в запросе до {batch_blocks}")
+
+    if not selected:
+        results = []
+    elif workers == 1 and batch_blocks > 1:
+        results = []
+        for group in engine.batch_groups(selected, batch_blocks):
+            chapter = group[0][0]
+            log_bold(f"■ Глава {chapter.get('__index')}, блок {', '.join(str(b.get('index')) for _, b in group)}: старт")
+            results.extend(
+                engine.run_batch(group, questions_per_block, chapter_number_filter=chapter_number, block_number_filter=block_number)
+            )
+    elif workers == 1:
+        results = []
+        for chapter, block in selected:
+            log_bold(f"■ Глава {chapter.get('__index')}, блок {block.get('index')}: старт")
+            results.append(
+                engine.run_block(
+                    chapter,
+                    block,
+                    questions_per_block,
+                    chapter_number_filter=chapter_number,
+                    block_number_filter=block_number,
+                )
+            )
+    else:
+        results = engine.run_blocks_concurrently(
+            selected,
+            questions_per_block,
+            workers,
+            chapter_number_filter=chapter_number,
+            block_number_filter=block_number,
+            batch_blocks=batch_blocks,
+        )
+    generated_blocks = sum(1 for r in results if r["accepted"]) + sum(1 for e in finished.values() if e.get("accepted"))
+    prompt_prefix = engine.prompt_prefix_report()
+    prompt_efficiency = engine.prompt_efficiency_report()
+    decoding_report = engine.decoding_report()
+    spec_sizes = engine.spec_size_report(selected)
+    token_costs = engine.token_cost_report()
+    backends = engine.backend_report()
+    request_sizing = {
+        "max_request_factor": engine.max_request_factor,
+        "blocks": len(results),
+        "attempts_per_block_before": attempts_before,
+        "attempts_per_block": round(sum(r["attempts"] for r in results) / len(results), 3) if results else None,
+        "requested": sum(r.get("requested", 0) for r in results),
+        "received": sum(r.get("received", 0) for r in results),
+        "accepted": sum(len(r["accepted"]) for r in results),
+    }
+    log_cyan(
+        f"Размер запросов (до x{engine.max_request_factor}): попыток на блок {request_sizing['attempts_per_block']} "
+        f"(раньше {attempts_before if attempts_before is not None else '-'}), запрошено {request_sizing['requested']}, "
+        f"получено {request_sizing['received']}, принято {request_sizing['accepted']}"
+    )
 
     if generated_blocks == 0:
+        # Keep what the failed attempts taught request sizing before giving up.
+        engine.save_indexes()
         raise SystemExit("No questions were generated. Check training_pack/runs/*/*.raw.json and your LLM endpoint/model.")
 
-    write_json(pack_dir / "index.json", config)
-    ok, report = validate_pack(course_root=course_root, min_per_block=min_per_block)
-    write_json(pack_dir / "reports" / "build-report.json", {"ok": ok, "generated_at": utc_now(), "mode": "llm-only", "validation": report})
+    engine.write_index()
+    engine.journal({"event": "done"})
+    ok, report = engine.validate_pack(min_per_block=min_per_block)
+    write_json(
+        engine.pack_dir / "reports" / "build-report.json",
+        {
+            "ok": ok,
+            "generated_at": utc_now(),
+            "mode": "llm-only",
+            "prompt_prefix": prompt_prefix,
+            "prompt_efficiency": prompt_efficiency,
+            "request_sizing": request_sizing,
+            "decoding": decoding_report,
+            "block_specs": spec_sizes,
+            "tokens": token_costs,
+            "llm_backends": backends,
+            "llm_cache": engine.response_cache.stats() if engine.response_cache is not None else None,
+            "validation": report,
+        },
+    )
     return ok, report
 
 
+RAW_LOG_RE = re.compile(
+    r"^(?P<bundle>[^.]+)\.(?P<chapter>\d{3})\.(?:\d{3}|(?P<batch>batch\d{3}-\d{3}))\.(?P<rest>.+?)(?:\.attempt\d+)?\.raw\.json$"
+)
+
+
+def raw_log_items(path: Path, data: dict) -> Tuple[List[Tuple[str, str, list]], str | None]:
+    """Split one raw log into (chapter_id, block_id, items) entries, or return a skip reason."""
+    m = RAW_LOG_RE.match(path.name)
+    if not m:
+        return [], "unrecognized file name"
+    raw = data.get("raw_response") if isinstance(data, dict) else None
+    if not raw:
+        return [], "empty response"
+    try:
+        parsed = json.loads(raw)
+    except Exception:
+        # Truncated or commented responses still carry the elements that were closed.
+        container = json_stream.CONTAINER_OBJECT if m.group("batch") else json_stream.CONTAINER_ARRAY
+        parsed = json_stream.salvage(raw, container)
+        if parsed is None:
+            return [], "response is not JSON"
+    if m.group("batch"):
+        chapter_id = m.group("rest")
+        if not isinstance(parsed, dict):
+            return [], "batch response is not object"
+        return [(chapter_id, bid, items) for bid, items in parsed.items() if isinstance(items, list)], None
+    # Chapter ids contain dots, block ids do not.
+    chapter_id, _, block_id = m.group("rest").rpartition(".")
+    if not isinstance(parsed, list):
+        return [], "response is not list"
+    return [(chapter_id, block_id, parsed)], None
+
+
+def replay_pack(
+    course_root: Path,
+    min_per_block: int,
+    questions_per_block: int,
+    chapter_number: int,
+    block_number: int,
+    run_stamps: List[str],
+    near_dup_threshold: float = 0.0,
+):
+    """Re-ingest raw LLM logs from training_pack/runs through the current validation, without LLM calls."""
+    llm_model, llm_base_url = resolve_llm_settings(course_root)
+    engine = TrainingPackEngine(
+        course_root, llm_model=llm_model, llm_base_url=llm_base_url, append=True, near_dup_threshold=near_dup_threshold
+    )
+    runs_root = engine.pack_dir / "runs"
+    run_dirs = [runs_root / stamp for stamp in run_stamps] if run_stamps else sorted(p for p in runs_root.iterdir() if p.is_dir())
+    run_dirs = [p for p in run_dirs if p != engine.runs_dir]
+    missing = [p.name for p in run_dirs if not p.is_dir()]
+    if missing:
+        raise SystemExit(f"Run directories not found: {', '.join(missing)}")
+
+    stats = {"run_dirs": len(run_dirs), "raw_logs": 0, "skipped": {}, "unknown_blocks": 0, "accepted": 0, "rejected": 0}
+    states: Dict[str, dict] = {}
+    for run_dir in run_dirs:
+        for path in sorted(run_dir.glob("*.raw.json")):
+            stats["raw_logs"] += 1
+            try:
+                data = read_json(path)
+            except Exception:
+                data = None
+            entries, skip_reason = raw_log_items(path, data)
+            if skip_reason:
+                stats["skipped"][skip_reason] = stats["skipped"].get(skip_reason, 0) + 1
+                continue
+            for chapter_id, block_id, items in entries:
+                found = engine.course.block_by_key(block_key(chapter_id, block_id))
+                if found is None:
+                    stats["unknown_blocks"] += 1
+                    continue
+                chapter, block = found
+                if chapter_number and chapter["__index"] != chapter_number:
+                    continue
+                if block_number and block["index"] != block_number:
+                    continue
+                bkey = block_key(chapter_id, block_id)
+                if bkey not in states:
+                    payload, questions, sigs = engine.prepare_block(chapter, block)
+                    states[bkey] = {
+                        "chapter": chapter,
+                        "block": block,
+                        "payload": payload,
+                        "questions": questions,
+                        "sigs": sigs,
+                        "result": {"accepted": [], "rejected_total": 0, "reject_reasons_questions": {}, "attempts": 0},
+                    }
+                st = states[bkey]
+                result = st["result"]
+                result["attempts"] += 1
+                result["rejected_total"] += accept_llm_questions(
+                    items,
+                    chapter_id,
+                    block,
+                    st["sigs"],
+                    result["accepted"],
+                    sys.maxsize,
+                    result["reject_reasons_questions"],
+                    engine.signatures,
+                    engine.near_dupes,
+                )
+
+    for st in states.values():
+        result = st["result"]
+        stats["accepted"] += len(result["accepted"])
+        stats["rejected"] += result["rejected_total"]
+        if result["accepted"]:
+            engine.commit_block(
+                st["chapter"],
+                st["block"],
+                st["payload"],
+                st["questions"],
+                result,
+                questions_per_block,
+                chapter_number_filter=chapter_number,
+                block_number_filter=block_number,
+            )
+    log_bold(
+        f"▶ Replay: логов {stats['raw_logs']} из {stats['run_dirs']} прогонов, принято {stats['accepted']}, "
+        f"отклонено {stats['rejected']}, пропущено {sum(stats['skipped'].values())}"
+    )
+    if not any(engine.runs_dir.iterdir()):
+        engine.runs_dir.rmdir()
+
+    engine.write_index()
+    ok, report = engine.validate_pack(min_per_block=min_per_block)
+    write_json(
+        engine.pack_dir / "reports" / "build-report.json",
+        {"ok": ok, "generated_at": utc_now(), "mode": "replay", "replay": stats, "validation": report},
+    )
+    return ok, report
+
+
+def resolve_llm_settings(course_root: Path, llm_model: str | None = None, llm_base_url: str | None = None):
+    cfg = load_generator_config(course_root)
+    defaults = cfg.get("defaults", {}) if isinstance(cfg.get("defaults", {}), dict) else {}
+    model = llm_model or os.environ.get("TRAINING_PACK_MODEL") or defaults.get("llm_model", "qwen2.5:14b-instruct")
+    base_url = (
+        llm_base_url
+        or os.environ.get("LLM_BASE_URL")
+        or os.environ.get("OLLAMA_URL")
+        or defaults.get("llm_base_url")
+        or defaults.get("ollama_url")
+        or "http://127.0.0.1:8090"
+    )
+    return model, base_url
+
+
 def main():
     parser = argparse.ArgumentParser(description="Build English training pack with LLM only (mcq_single)")
     parser.add_argument("--course-root", default=".")
@@ -734,9 +2008,83 @@ def main():
     parser.add_argument("--chapter-number", type=int, default=0)
     parser.add_argument("--block-number", type=int, default=0)
     parser.add_argument("--append", action="store_true")
-    parser.add_argument("--llm-base-url", default=None, help="Base URL for llama.cpp/OpenAI-compatible or Ollama server")
+    parser.add_argument(
+        "--llm-base-url",
+        default=None,
+        help="Base URL for llama.cpp/OpenAI-compatible or Ollama server; comma-separated URLs balance requests across several servers",
+    )
+    parser.add_argument("--llm-weights", default=None, help="Comma-separated relative weights of the --llm-base-url servers (default: equal)")
+    parser.add_argument(
+        "--llm-routing",
+        choices=llm_pool.ROUTINGS,
+        default=None,
+        help="How requests are spread over several servers: least-outstanding (default) or weighted round-robin",
+    )
+    parser.add_argument("--llm-max-request-s", type=float, default=None, help="Abort an LLM request running longer than this (0 = off)")
+    parser.add_argument("--llm-ttft-s", type=float, default=None, help="Abort a streamed LLM request with no first token after this (0 = off)")
+    parser.add_argument(
+        "--llm-min-tokens-per-s",
+        type=float,
+        default=None,
+        help=f"Abort a stream slower than this after its first {llm_client.RATE_GRACE_S:g}s (0 = off)",
+    )
     parser.add_argument("--ollama-url", default=None, help="Deprecated alias for --llm-base-url")
     parser.add_argument("--llm-model", default=None)
+    parser.add_argument("--workers", type=int, default=None, help="Number of theory blocks generated concurrently")
+    parser.add_argument("--llm-max-inflight", type=int, default=None, help="Max concurrent LLM requests (0 = no limit)")
+    parser.add_argument(
+        "--prompt-layout",
+        choices=PROMPT_LAYOUTS,
+        default=None,
+        help="prefix: stable prompt prefix for llama.cpp KV cache reuse (default); classic: previous layout",
+    )
+    parser.add_argument("--batch-blocks", type=int, default=None, help="Pack up to N blocks of one chapter into one LLM request")
+    parser.add_argument("--llm-cache", action="store_true", help="Serve repeated identical LLM requests from training_pack/.llm-cache")
+    parser.add_argument("--llm-cache-max-mb", type=int, default=None, help="Size limit of the LLM response cache (LRU eviction)")
+    parser.add_argument(
+        "--near-dup-threshold",
+        type=float,
+        default=None,
+        help="Reject questions whose prompt and answer are this similar (MinHash Jaccard, e.g. 0.8) to any pack or question_bank question; 0 = off",
+    )
+    parser.add_argument(
+        "--max-request-factor",
+        type=float,
+        default=None,
+        help=f"Over-request up to this factor from the block's historical acceptance rate (default {DEFAULT_MAX_REQUEST_FACTOR}, 1 = off)",
+    )
+    parser.add_argument(
+        "--decoding",
+        choices=llm_client.DECODING_MODES,
+        default=None,
+        help="Constrain LLM output: json_schema (llama.cpp json_schema / OpenAI response_format / Ollama format) or grammar (llama.cpp GBNF); falls back automatically if the server refuses",
+    )
+    parser.add_argument(
+        "--spec-profile",
+        choices=block_specs.PROFILES,
+        default=None,
+        help="Block INPUT in prompts: full (as stored, default) or compact (no internal ids/tags, no JSON whitespace)",
+    )
+    parser.add_argument(
+        "--exact-tokens",
+        action="store_true",
+        help="Count block INPUT tokens with the llama.cpp /tokenize endpoint instead of estimating",
+    )
+    parser.add_argument(
+        "--replay-runs",
+        nargs="*",
+        metavar="STAMP",
+        default=None,
+        help="Re-validate raw logs from training_pack/runs/<STAMP> (all runs if none given) without LLM calls",
+    )
+    parser.add_argument(
+        "--resume",
+        nargs="?",
+        const="",
+        default=None,
+        metavar="STAMP",
+        help="Continue an interrupted run from its checkpoint journal (latest unfinished run if no STAMP)",
+    )
     args = parser.parse_args()
 
     course_root = Path(args.course_root).resolve()
@@ -744,27 +2092,54 @@ def main():
     defaults = cfg.get("defaults", {}) if isinstance(cfg.get("defaults", {}), dict) else {}
     min_per_block = args.min_per_block if args.min_per_block is not None else int(defaults.get("min_per_block", 3))
     questions_per_block = args.questions_per_block if args.questions_per_block is not None else int(defaults.get("questions_per_block", 3))
-    llm_model = args.llm_model or os.environ.get("TRAINING_PACK_MODEL") or defaults.get("llm_model", "qwen2.5:14b-instruct")
-    llm_base_url = (
-        args.llm_base_url
-        or args.ollama_url
-        or os.environ.get("LLM_BASE_URL")
-        or os.environ.get("OLLAMA_URL")
-        or defaults.get("llm_base_url")
-        or defaults.get("ollama_url")
-        or "http://127.0.0.1:8090"
+    workers = args.workers if args.workers is not None else int(defaults.get("workers", 1))
+    llm_max_inflight = args.llm_max_inflight if args.llm_max_inflight is not None else int(defaults.get("llm_max_inflight", 0))
+    batch_blocks = args.batch_blocks if args.batch_blocks is not None else int(defaults.get("batch_blocks", 1))
+    llm_model, llm_base_url = resolve_llm_settings(course_root, args.llm_model, args.llm_base_url or args.ollama_url)
+    response_cache = args.llm_cache or bool(defaults.get("llm_cache", False))
+    response_cache_max_mb = args.llm_cache_max_mb if args.llm_cache_max_mb is not None else int(defaults.get("llm_cache_max_mb", 512))
+    near_dup_threshold = (
+        args.near_dup_threshold if args.near_dup_threshold is not None else float(defaults.get("near_dup_threshold", 0))
     )
 
-    ok, report = build_pack(
-        course_root=course_root,
-        min_per_block=min_per_block,
-        questions_per_block=questions_per_block,
-        llm_model=llm_model,
-        llm_base_url=llm_base_url,
-        chapter_number=args.chapter_number,
-        block_number=args.block_number,
-        append=args.append,
-    )
+    if args.replay_runs is not None:
+        ok, report = replay_pack(
+            course_root=course_root,
+            min_per_block=min_per_block,
+            questions_per_block=questions_per_block,
+            chapter_number=args.chapter_number,
+            block_number=args.block_number,
+            run_stamps=args.replay_runs,
+            near_dup_threshold=near_dup_threshold,
+        )
+    else:
+        ok, report = build_pack(
+            course_root=course_root,
+            min_per_block=min_per_block,
+            questions_per_block=questions_per_block,
+            llm_model=llm_model,
+            llm_base_url=llm_base_url,
+            chapter_number=args.chapter_number,
+            block_number=args.block_number,
+            append=args.append,
+            workers=workers,
+            llm_max_inflight=llm_max_inflight,
+            prompt_layout=args.prompt_layout,
+            batch_blocks=batch_blocks,
+            response_cache=response_cache,
+            response_cache_max_mb=response_cache_max_mb,
+            resume=args.resume,
+            near_dup_threshold=near_dup_threshold,
+            max_request_factor=args.max_request_factor,
+            decoding=args.decoding,
+            spec_profile=args.spec_profile,
+            exact_tokens=args.exact_tokens or bool(defaults.get("exact_tokens", False)),
+            llm_weights=args.llm_weights,
+            llm_routing=args.llm_routing,
+            llm_max_request_s=args.llm_max_request_s,
+            llm_ttft_s=args.llm_ttft_s,
+            llm_min_tokens_per_s=args.llm_min_tokens_per_s,
+        )
     weak = report.get("weak_blocks", [])
     if weak:
         log_yellow("⚠ Блоки ниже min-per-block:")
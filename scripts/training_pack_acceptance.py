@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Per-block, per-model acceptance history for request sizing.
+
+Each finished block adds how many questions were requested from the LLM, how many items came
+back, how many were accepted, how many attempts it took and why items were rejected. The
+generator turns the acceptance rate into an over-request factor, so a block whose outputs are
+often rejected asks for more questions up front and converges in one attempt instead of
+several retries. Stored in training_pack/reports/.acceptance-stats.json; a save merges this
+process's additions into the file on disk, so concurrent generators do not overwrite each other.
+"""
+from __future__ import annotations
+
+import json
+import math
+import threading
+from pathlib import Path
+from typing import Dict
+
+import training_pack_io as pack_io
+
+STATS_VERSION = 1
+COUNTERS = ("runs", "attempts", "requested", "received", "accepted")
+# Pseudo-observations of the model-wide rate mixed into a block's own rate, so one unlucky
+# attempt on a block with little history does not triple its next request.
+PRIOR_WEIGHT = 10
+
+
+def scaled_count(needed: int, factor: float) -> int:
+    return max(needed, math.ceil(needed * factor - 1e-9)) if needed > 0 else needed
+
+
+def stats_path(pack_dir: Path) -> Path:
+    return pack_dir / "reports" / ".acceptance-stats.json"
+
+
+def _empty() -> dict:
+    return {"version": STATS_VERSION, "models": {}}
+
+
+def _read(path: Path) -> dict:
+    try:
+        data = json.loads(path.read_text(encoding="utf-8"))
+    except Exception:
+        return _empty()
+    if not isinstance(data, dict) or data.get("version") != STATS_VERSION:
+        return _empty()
+    return data
+
+
+def _add_entry(target: dict, delta: dict):
+    for key in COUNTERS:
+        target[key] = target.get(key, 0) + delta.get(key, 0)
+    reasons = target.setdefault("reject_reasons", {})
+    for reason, count in delta.get("reject_reasons", {}).items():
+        reasons[reason] = reasons.get(reason, 0) + count
+
+
+def _merge(data: dict, delta: dict):
+    for model, blocks in delta.items():
+        model_blocks = data["models"].setdefault(model, {})
+        for bkey, entry in blocks.items():
+            _add_entry(model_blocks.setdefault(bkey, {}), entry)
+
+
+class AcceptanceStats:
+    def __init__(self, pack_dir: Path):
+        self.pack_dir = pack_dir
+        self.path = stats_path(pack_dir)
+        self.data = _read(self.path)
+        self._delta: Dict[str, Dict[str, dict]] = {}
+        self._lock = threading.Lock()
+
+    def entry(self, model: str, bkey: str) -> dict:
+        return self.data["models"].get(model, {}).get(bkey, {})
+
+    def model_rate(self, model: str) -> float | None:
+        received = accepted = 0
+        for entry in self.data["models"].get(model, {}).values():
+            received += entry.get("received", 0)
+            accepted += entry.get("accepted", 0)
+        return accepted / received if received else None
+
+    def block_rate(self, model: str, bkey: str) -> float | None:
+        prior = self.model_rate(model)
+        entry = self.entry(model, bkey)
+        received, accepted = entry.get("received", 0), entry.get("accepted", 0)
+        if prior is None:
+            return accepted / received if received else None
+        return (accepted + PRIOR_WEIGHT * prior) / (received + PRIOR_WEIGHT)
+
+    def request_factor(self, model: str, bkey: str, max_factor: float) -> float:
+        """Over-request factor 1/acceptance rate, capped at max_factor (1.0 without history)."""
+        rate = self.block_rate(model, bkey)
+        if max_factor <= 1 or not rate:
+            return 1.0
+        return round(min(max_factor, max(1.0, 1 / rate)), 3)
+
+    def attempts_per_run(self, model: str, bkeys) -> float | None:
+        runs = attempts = 0
+        for bkey in bkeys:
+            entry = self.entry(model, bkey)
+            runs += entry.get("runs", 0)
+            attempts += entry.get("attempts", 0)
+        return round(attempts / runs, 3) if runs else None
+
+    def record(self, model: str, bkey: str, result: dict):
+        delta = {
+            "runs": 1,
+            "attempts": int(result.get("attempts", 0)),
+            "requested": int(result.get("requested", 0)),
+            "received": int(result.get("received", 0)),
+            "accepted": len(result.get("accepted", [])),
+            "reject_reasons": dict(result.get("reject_reasons_questions", {})),
+        }
+        with self._lock:
+            _add_entry(self.data["models"].setdefault(model, {}).setdefault(bkey, {}), delta)
+            _add_entry(self._delta.setdefault(model, {}).setdefault(bkey, {}), delta)
+
+    def save(self):
+        # Call with pack_lock held: re-read the file and add only what this process recorded.
+        with self._lock:
+            if not self._delta:
+                return
+            data = _read(self.path)
+            _merge(data, self._delta)
+            pack_io.atomic_write_json(self.path, data)
+            self.data = data
+            self._delta = {}
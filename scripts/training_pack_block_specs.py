@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+Pre-serialized theory block specs for training pack prompts.
+
+Every attempt used to json.dumps the full theory block (content_md, examples, key_points) into
+the prompt. The serialized INPUT of each block is kept in training_pack/reports/.block-specs.json
+next to the course index, per chapter and spec profile, with its size and a token estimate
+(training_pack_tokens.estimate_tokens);
+a chapter is re-serialized only when its sha256 in the course index changes. Prompts are then
+assembled by concatenating cached strings, and a warm cache means chapter files are not read
+at all.
+
+Profiles:
+  full     the block as stored in the chapter, serialized exactly as before (prompt bytes,
+           KV cache prefixes and response cache keys stay the same);
+  compact  without fields the model does not need (block index, example ids and tags) and
+           without JSON whitespace.
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import threading
+from pathlib import Path
+from typing import Dict, List
+
+import training_pack_course_index as course_index
+import training_pack_io as pack_io
+import training_pack_tokens as tokens
+
+# 2: token estimates from training_pack_tokens.estimate_tokens.
+SPECS_VERSION = 2
+PROFILE_FULL = "full"
+PROFILE_COMPACT = "compact"
+PROFILES = (PROFILE_FULL, PROFILE_COMPACT)
+
+_COMPACT_DROP = ("index",)
+_COMPACT_EXAMPLE_FIELDS = ("text", "translation", "notes")
+
+
+def specs_path(course_root: Path) -> Path:
+    return course_root / "training_pack" / "reports" / ".block-specs.json"
+
+
+def trim_spec(spec: dict, profile: str) -> dict:
+    if profile == PROFILE_FULL:
+        return spec
+    out = {k: v for k, v in spec.items() if k not in _COMPACT_DROP}
+    out["examples"] = [
+        {k: ex[k] for k in _COMPACT_EXAMPLE_FIELDS if ex.get(k)} if isinstance(ex, dict) else ex
+        for ex in spec.get("examples", [])
+    ]
+    return out
+
+
+def serialize_spec(spec: dict, profile: str) -> str:
+    if profile == PROFILE_FULL:
+        return json.dumps(spec, ensure_ascii=False)
+    return json.dumps(trim_spec(spec, profile), ensure_ascii=False, separators=(",", ":"))
+
+
+def join_specs(texts: List[str]) -> str:
+    """JSON array of serialized specs; for the full profile the same bytes as dumping the list of dicts."""
+    return "[" + ", ".join(texts) + "]"
+
+
+def _empty() -> dict:
+    return {"version": SPECS_VERSION, "chapters": {}}
+
+
+def _read(path: Path) -> dict:
+    try:
+        data = json.loads(path.read_text(encoding="utf-8"))
+    except Exception:
+        return _empty()
+    if not isinstance(data, dict) or data.get("version") != SPECS_VERSION or not isinstance(data.get("chapters"), dict):
+        return _empty()
+    return data
+
+
+class BlockSpecCache:
+    def __init__(self, course: course_index.CourseIndex, profile: str = PROFILE_FULL):
+        if profile not in PROFILES:
+            raise ValueError(f"unknown spec profile: {profile}")
+        self.course = course
+        self.profile = profile
+        self.path = specs_path(course.course_root)
+        self.data = _read(self.path)
+        self.reserialized = 0
+        self._dirty = False
+        self._lock = threading.Lock()
+
+    def _chapter(self, chapter_id: str) -> Dict[str, dict]:
+        content_hash = self.course.chapter_hash(chapter_id)
+        with self._lock:
+            cached = self.data["chapters"].get(chapter_id)
+            if not cached or cached.get("sha256") != content_hash:
+                cached = {"sha256": content_hash, "profiles": {}}
+                self.data["chapters"][chapter_id] = cached
+            blocks = cached["profiles"].get(self.profile)
+            if blocks is not None:
+                return blocks
+            path = self.course.chapter_path(chapter_id)
+            chapter = course_index.read_json(path) if path is not None else {}
+            blocks = {}
+            for spec in course_index.theory_blocks(chapter):
+                text = serialize_spec(spec, self.profile)
+                blocks[spec["id"]] = {"json": text, "chars": len(text), "tokens_est": tokens.estimate_tokens(text)}
+            cached["profiles"][self.profile] = blocks
+            self.reserialized += 1
+            self._dirty = True
+            return blocks
+
+    def entry(self, chapter_id: str, block_id: str) -> dict | None:
+        return self._chapter(chapter_id).get(block_id)
+
+    def spec(self, chapter: dict, block: dict) -> dict:
+        """Block metadata from the course index plus its serialized prompt INPUT."""
+        entry = self.entry(chapter["id"], block["id"]) or {}
+        return {
+            "index": block.get("index"),
+            "id": block["id"],
+            "chapter_id": chapter["id"],
+            "concept_id": block.get("concept_id", ""),
+            "title": block.get("title", ""),
+            "spec_json": entry.get("json", "{}"),
+            "spec_tokens_est": entry.get("tokens_est", 0),
+        }
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            # Chapters that left the course are dropped together with their specs.
+            known = {c["id"] for c in self.course.chapters()}
+            self.data["chapters"] = {cid: v for cid, v in self.data["chapters"].items() if cid in known}
+            pack_io.atomic_write_json(self.path, self.data)
+            self._dirty = False
+
+    def size_report(self, pairs) -> dict:
+        tokens = [self.spec(chapter, block)["spec_tokens_est"] for chapter, block in pairs]
+        return {
+            "profile": self.profile,
+            "blocks": len(tokens),
+            "spec_tokens_est_total": sum(tokens),
+            "spec_tokens_est_mean": round(sum(tokens) / len(tokens), 1) if tokens else None,
+            "spec_tokens_est_max": max(tokens, default=None),
+            "chapters_reserialized": self.reserialized,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build training_pack/reports/.block-specs.json and show prompt INPUT sizes")
+    parser.add_argument("--course-root", default=".")
+    parser.add_argument("--profile", choices=PROFILES, default=PROFILE_FULL)
+    parser.add_argument("--chapter-number", type=int, default=0)
+    args = parser.parse_args()
+    course = course_index.load_course_index(Path(args.course_root).resolve())
+    cache = BlockSpecCache(course, args.profile)
+    for chapter in course.chapters():
+        if args.chapter_number and chapter["__index"] != args.chapter_number:
+            continue
+        sizes = [cache.spec(chapter, b)["spec_tokens_est"] for b in course.theory_blocks(chapter["id"])]
+        if sizes:
+            print(f"{chapter['__index']:03d} {chapter['id']}: blocks={len(sizes)}, ≈{sum(sizes)} tok (max {max(sizes)})")
+    cache.save()
+    report = cache.size_report(course.select(args.chapter_number))
+    print(
+        f"block specs ({report['profile']}): blocks={report['blocks']}, ≈{report['spec_tokens_est_total']} tok, "
+        f"mean {report['spec_tokens_est_mean']}, max {report['spec_tokens_est_max']}, "
+        f"re-serialized chapters={report['chapters_reserialized']} -> {cache.path}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+"""
+Compiled course index for training pack tooling.
+
+Keeps a compact summary of chapters/*/05-final.json (chapter number -> id, path, mtime,
+hash, theory block metadata, concept ids) in training_pack/reports/.course-index.json.
+A chapter file is re-parsed only when its mtime/size changed and its sha256 differs,
+so lookups by chapter/block number or "chapter_id::block_id" no longer scan 16 MB of JSON.
+Full theory block specs are read lazily, one chapter file at a time.
+"""
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import training_pack_io as pack_io
+
+INDEX_VERSION = 1
+FINAL_NAMES = ("05-final.json", "04-final.json")
+
+
+def read_json(path: Path):
+    return json.loads(path.read_text(encoding="utf-8"))
+
+
+def index_path(course_root: Path) -> Path:
+    return course_root / "training_pack" / "reports" / ".course-index.json"
+
+
+def read_final_json(chapter_dir: Path):
+    for name in FINAL_NAMES:
+        p = chapter_dir / name
+        if p.exists():
+            return read_json(p)
+    return None
+
+
+def theory_blocks(chapter: dict) -> List[dict]:
+    out = []
+    for b in chapter.get("blocks", []):
+        if not isinstance(b, dict):
+            continue
+        if b.get("type") != "theory":
+            continue
+        bid = b.get("id")
+        theory = b.get("theory", {}) if isinstance(b.get("theory"), dict) else {}
+        if bid:
+            out.append(
+                {
+                    "index": len(out) + 1,
+                    "id": bid,
+                    "chapter_id": chapter.get("id"),
+                    "chapter_title": chapter.get("title", ""),
+                    "chapter_level": chapter.get("level", ""),
+                    "concept_id": theory.get("concept_id", ""),
+                    "title": b.get("title", ""),
+                    "content_md": theory.get("content_md", ""),
+                    "key_points": theory.get("key_points", []),
+                    "common_mistakes": theory.get("common_mistakes", []),
+                    "examples": theory.get("examples", []),
+                }
+            )
+    return out
+
+
+def _final_file(chapter_dir: Path) -> Path | None:
+    for name in FINAL_NAMES:
+        p = chapter_dir / name
+        if p.exists():
+            return p
+    return None
+
+
+def _compile_entry(course_root: Path, final_file: Path, raw: bytes, content_hash: str) -> dict | None:
+    chapter = json.loads(raw.decode("utf-8"))
+    if not chapter or not chapter.get("id"):
+        return None
+    blocks = [
+        {"index": b["index"], "id": b["id"], "title": b["title"], "concept_id": b["concept_id"]}
+        for b in theory_blocks(chapter)
+    ]
+    stat = final_file.stat()
+    return {
+        "path": final_file.relative_to(course_root).as_posix(),
+        "mtime_ns": stat.st_mtime_ns,
+        "size": stat.st_size,
+        "sha256": content_hash,
+        "id": chapter["id"],
+        "title": chapter.get("title", ""),
+        "level": chapter.get("level", ""),
+        "schema_version": chapter.get("schema_version", "1.0.0"),
+        "concept_ids": sorted({b["concept_id"] for b in blocks if b["concept_id"]}),
+        "theory_blocks": blocks,
+    }
+
+
+def compile_course_index(course_root: Path, previous: dict | None = None) -> Tuple[dict, int]:
+    old_by_path = {}
+    if previous and previous.get("version") == INDEX_VERSION:
+        old_by_path = {e["path"]: e for e in previous.get("chapters", []) if isinstance(e, dict) and e.get("path")}
+    chapters_dir = course_root / "chapters"
+    chapter_dirs = sorted(p for p in chapters_dir.iterdir() if p.is_dir())
+    entries = []
+    reparsed = 0
+    for idx, chapter_dir in enumerate(chapter_dirs, start=1):
+        final_file = _final_file(chapter_dir)
+        if final_file is None:
+            continue
+        rel = final_file.relative_to(course_root).as_posix()
+        stat = final_file.stat()
+        old = old_by_path.get(rel)
+        if old and old.get("mtime_ns") == stat.st_mtime_ns and old.get("size") == stat.st_size:
+            entry = dict(old)
+        else:
+            raw = final_file.read_bytes()
+            content_hash = hashlib.sha256(raw).hexdigest()
+            if old and old.get("sha256") == content_hash:
+                entry = dict(old, mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+            else:
+                entry = _compile_entry(course_root, final_file, raw, content_hash)
+                reparsed += 1
+                if entry is None:
+                    continue
+        entry["index"] = idx
+        entries.append(entry)
+    return {"version": INDEX_VERSION, "chapters": entries}, reparsed
+
+
+class CourseIndex:
+    def __init__(self, course_root: Path, data: dict):
+        self.course_root = course_root
+        self.data = data
+        self._chapters: List[dict] = []
+        self._by_number: Dict[int, dict] = {}
+        self._by_id: Dict[str, dict] = {}
+        self._blocks_by_key: Dict[str, Tuple[dict, dict]] = {}
+        self._entries_by_id: Dict[str, dict] = {}
+        self._specs: Dict[str, Dict[str, dict]] = {}
+        for entry in data.get("chapters", []):
+            chapter = {
+                "id": entry["id"],
+                "__index": entry["index"],
+                "title": entry.get("title", ""),
+                "level": entry.get("level", ""),
+                "schema_version": entry.get("schema_version", "1.0.0"),
+            }
+            self._chapters.append(chapter)
+            self._by_number[entry["index"]] = chapter
+            self._by_id[entry["id"]] = chapter
+            self._entries_by_id[entry["id"]] = entry
+            for b in entry.get("theory_blocks", []):
+                self._blocks_by_key[f"{entry['id']}::{b['id']}"] = (chapter, b)
+
+    def chapters(self) -> List[dict]:
+        return list(self._chapters)
+
+    def chapter(self, chapter_number: int) -> dict | None:
+        return self._by_number.get(int(chapter_number))
+
+    def chapter_by_id(self, chapter_id: str) -> dict | None:
+        return self._by_id.get(chapter_id)
+
+    def chapter_path(self, chapter_id: str) -> Path | None:
+        entry = self._entries_by_id.get(chapter_id)
+        return self.course_root / entry["path"] if entry else None
+
+    def chapter_hash(self, chapter_id: str) -> str | None:
+        entry = self._entries_by_id.get(chapter_id)
+        return entry.get("sha256") if entry else None
+
+    def concept_ids(self, chapter_id: str) -> List[str]:
+        entry = self._entries_by_id.get(chapter_id)
+        return list(entry.get("concept_ids", [])) if entry else []
+
+    def theory_blocks(self, chapter_id: str) -> List[dict]:
+        entry = self._entries_by_id.get(chapter_id)
+        return list(entry.get("theory_blocks", [])) if entry else []
+
+    def theory_block_ids(self, chapter_id: str) -> set:
+        return {b["id"] for b in self.theory_blocks(chapter_id)}
+
+    def block(self, chapter_number: int, block_number: int) -> Tuple[dict, dict] | None:
+        chapter = self.chapter(chapter_number)
+        if chapter is None:
+            return None
+        for b in self.theory_blocks(chapter["id"]):
+            if int(b["index"]) == int(block_number):
+                return chapter, b
+        return None
+
+    def block_by_key(self, key: str) -> Tuple[dict, dict] | None:
+        return self._blocks_by_key.get(key)
+
+    def select(self, chapter_number: int = 0, block_number: int = 0) -> List[Tuple[dict, dict]]:
+        selected = []
+        for chapter in self._chapters:
+            if chapter_number and chapter["__index"] != chapter_number:
+                continue
+            for b in self.theory_blocks(chapter["id"]):
+                if block_number and b["index"] != block_number:
+                    continue
+                selected.append((chapter, b))
+        return selected
+
+    def block_spec(self, chapter_id: str, block_id: str) -> dict | None:
+        if chapter_id not in self._specs:
+            path = self.chapter_path(chapter_id)
+            chapter = read_json(path) if path is not None else {}
+            self._specs[chapter_id] = {b["id"]: b for b in theory_blocks(chapter)}
+        return self._specs[chapter_id].get(block_id)
+
+
+def load_course_index(course_root: Path, rebuild: bool = False) -> CourseIndex:
+    path = index_path(course_root)
+    previous = None
+    if path.exists() and not rebuild:
+        try:
+            previous = read_json(path)
+        except Exception:
+            previous = None
+    data, reparsed = compile_course_index(course_root, previous)
+    if data != previous:
+        pack_io.atomic_write_json(path, data)
+    return CourseIndex(course_root, data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compile training_pack/reports/.course-index.json")
+    parser.add_argument("--course-root", default=".")
+    parser.add_argument("--rebuild", action="store_true", help="Ignore the existing index and re-parse every chapter")
+    args = parser.parse_args()
+    course_root = Path(args.course_root).resolve()
+    path = index_path(course_root)
+    previous = None if args.rebuild or not path.exists() else read_json(path)
+    data, reparsed = compile_course_index(course_root, previous)
+    pack_io.atomic_write_json(path, data)
+    blocks = sum(len(e.get("theory_blocks", [])) for e in data["chapters"])
+    print(f"course index: chapters={len(data['chapters'])}, theory_blocks={blocks}, reparsed={reparsed} -> {path}")
+
+
+if __name__ == "__main__":
+    main()
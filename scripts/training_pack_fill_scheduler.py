@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+Round scheduler for fill-training-pack.py.
+
+The fill loop used to walk blocks in directory order and stay on one block until it reached
+--target-valid, so a few stubborn blocks could take the whole night while later blocks stayed
+at zero. FillScheduler keeps every selected block in one priority queue and hands out the
+round with the most valid questions expected per token:
+
+  priority = min(deficit, batch) * yield / cost * (1 + deficit / target) * 0.5 ** zero_gain_streak
+
+  yield  valid questions gained per requested question, an exponential moving average over this
+         run's rounds, seeded from the block's acceptance history (training_pack_acceptance);
+  cost   prompt + completion tokens of a round, a moving average of the block's token usage,
+         seeded from its prompt size;
+  the deficit term puts the emptiest blocks first, and every round in a row without gain halves
+  the block's priority until it is retired after max_zero_gain such rounds.
+"""
+from __future__ import annotations
+
+import heapq
+import itertools
+from typing import Dict, List
+
+# Weight of the latest round in the moving averages.
+RECENT_WEIGHT = 0.5
+DEMOTION = 0.5
+DEFAULT_MAX_ZERO_GAIN = 4
+# Rough completion size of one mcq_single question (RU prompt/explanation, 4 choices).
+QUESTION_TOKENS_EST = 120
+
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_MAX_ROUNDS = "max_rounds"
+STATUS_ZERO_GAIN = "zero_gain"
+STATUS_FAILED = "failed"
+
+
+class BlockState:
+    def __init__(self, chapter: dict, block: dict, valid: int, yield_rate: float, cost_tokens: float):
+        self.chapter = chapter
+        self.block = block
+        self.valid = valid
+        self.start_valid = valid
+        self.yield_rate = yield_rate
+        self.cost_tokens = max(1.0, cost_tokens)
+        self.rounds = 0
+        self.zero_gain_streak = 0
+        self.tokens_spent = 0
+        self.status = STATUS_QUEUED
+
+    @property
+    def key(self) -> str:
+        return f"{self.chapter['id']}::{self.block['id']}"
+
+    @property
+    def gained(self) -> int:
+        return self.valid - self.start_valid
+
+
+def round_cost_estimate(prompt_tokens: int, batch_size: int) -> float:
+    return prompt_tokens + batch_size * QUESTION_TOKENS_EST
+
+
+class FillScheduler:
+    def __init__(self, target_valid: int, batch_size: int, max_rounds_per_block: int, max_zero_gain: int = DEFAULT_MAX_ZERO_GAIN):
+        self.target_valid = target_valid
+        self.batch_size = batch_size
+        self.max_rounds_per_block = max_rounds_per_block
+        self.max_zero_gain = max(1, max_zero_gain)
+        self.blocks: List[BlockState] = []
+        self._heap: List[tuple] = []
+        self._seq = itertools.count()
+
+    def add(self, state: BlockState):
+        self.blocks.append(state)
+        if state.valid >= self.target_valid:
+            state.status = STATUS_DONE
+        else:
+            self._push(state)
+
+    def priority(self, state: BlockState) -> float:
+        deficit = max(0, self.target_valid - state.valid)
+        expected = min(deficit, self.batch_size) * state.yield_rate
+        urgency = 1 + deficit / self.target_valid if self.target_valid else 1
+        # Valid questions expected per 1000 tokens.
+        return expected * urgency * 1000 / state.cost_tokens * DEMOTION**state.zero_gain_streak
+
+    def _push(self, state: BlockState):
+        state.status = STATUS_QUEUED
+        # Ties go to the block that was added (directory order) or requeued first.
+        heapq.heappush(self._heap, (-self.priority(state), next(self._seq), state))
+
+    def pop(self) -> BlockState | None:
+        if not self._heap:
+            return None
+        _, _, state = heapq.heappop(self._heap)
+        state.status = STATUS_RUNNING
+        return state
+
+    def requeue(self, state: BlockState):
+        """Put back a popped block that was not run (leased by another worker)."""
+        self._push(state)
+
+    def refresh(self, state: BlockState, valid: int) -> str:
+        """Take over a valid count changed outside this scheduler (another worker's rounds) for a popped block."""
+        state.start_valid += valid - state.valid
+        state.valid = valid
+        if valid >= self.target_valid:
+            state.status = STATUS_DONE
+        return state.status
+
+    def record_round(self, state: BlockState, valid: int, tokens_spent: int, failed: bool = False) -> str:
+        """Account a finished round and requeue the block unless it is done; returns its status."""
+        gained = valid - state.valid
+        state.rounds += 1
+        state.valid = valid
+        if failed:
+            state.status = STATUS_FAILED
+            return state.status
+        state.yield_rate += RECENT_WEIGHT * (max(0, gained) / self.batch_size - state.yield_rate)
+        if tokens_spent > 0:
+            state.tokens_spent += tokens_spent
+            state.cost_tokens += RECENT_WEIGHT * (tokens_spent - state.cost_tokens)
+        state.zero_gain_streak = 0 if gained > 0 else state.zero_gain_streak + 1
+        if state.valid >= self.target_valid:
+            state.status = STATUS_DONE
+        elif state.zero_gain_streak >= self.max_zero_gain:
+            state.status = STATUS_ZERO_GAIN
+        elif state.rounds >= self.max_rounds_per_block:
+            state.status = STATUS_MAX_ROUNDS
+        else:
+            self._push(state)
+        return state.status
+
+    def queued(self) -> int:
+        return len(self._heap)
+
+    def summary(self) -> Dict[str, int]:
+        counts: Dict[str, int] = {}
+        for state in self.blocks:
+            counts[state.status] = counts.get(state.status, 0) + 1
+        counts["blocks"] = len(self.blocks)
+        counts["rounds"] = sum(s.rounds for s in self.blocks)
+        counts["gained"] = sum(s.gained for s in self.blocks)
+        counts["tokens"] = sum(s.tokens_spent for s in self.blocks)
+        return counts
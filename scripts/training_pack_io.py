@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Crash-safe file writes and advisory locking for training pack files.
+
+atomic_write_* write to a temp file in the target directory, fsync it and rename it over
+the target, so readers (the admin server, a second generator) see either the old or the new
+file, never a truncated one. pack_lock() is an exclusive advisory lock on
+training_pack/.lock for read-modify-write sequences across processes; it is a no-op where
+fcntl is unavailable.
+"""
+from __future__ import annotations
+
+import contextlib
+import json
+import os
+import tempfile
+import threading
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows
+    fcntl = None
+
+LOCK_NAME = ".lock"
+
+# Read once at import: os.umask() can only be queried by setting it, which is not thread-safe.
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+_THREAD_LOCKS: dict = {}
+_THREAD_LOCKS_GUARD = threading.Lock()
+
+
+def fsync_dir(path: Path):
+    # Makes the rename itself durable; not supported on every platform/filesystem.
+    try:
+        fd = os.open(str(path), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _target_mode(path: Path) -> int:
+    # mkstemp creates 0600 files; keep the mode a plain write_text would have produced.
+    try:
+        return path.stat().st_mode & 0o777
+    except OSError:
+        return 0o666 & ~_UMASK
+
+
+def atomic_write_bytes(path: Path, data: bytes, durable_dir: bool = False):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    mode = _target_mode(path)
+    fd, tmp = tempfile.mkstemp(prefix=f".{path.name}.", suffix=".tmp", dir=str(path.parent))
+    try:
+        os.chmod(tmp, mode)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.unlink(tmp)
+        raise
+    if durable_dir:
+        fsync_dir(path.parent)
+
+
+def atomic_write_text(path: Path, text: str, durable_dir: bool = False):
+    atomic_write_bytes(path, text.encode("utf-8"), durable_dir=durable_dir)
+
+
+def atomic_write_json(path: Path, data, trailing_newline: bool = True, durable_dir: bool = False):
+    text = json.dumps(data, ensure_ascii=False, indent=2) + ("\n" if trailing_newline else "")
+    atomic_write_text(path, text, durable_dir=durable_dir)
+
+
+@contextlib.contextmanager
+def file_lock(lock_path: Path):
+    """Exclusive advisory lock held on lock_path; also serializes threads of this process."""
+    key = str(lock_path.resolve())
+    with _THREAD_LOCKS_GUARD:
+        thread_lock = _THREAD_LOCKS.setdefault(key, threading.Lock())
+    with thread_lock:
+        if fcntl is None:
+            yield
+            return
+        lock_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(lock_path, "a+") as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def pack_lock(pack_dir: Path):
+    return file_lock(pack_dir / LOCK_NAME)
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+Incremental extraction of question items from streamed LLM JSON.
+
+The generator expects either a JSON array of questions or, for batched requests, an object
+{"<block id>": [questions...]}. JSONItemStream is fed response chunks as they arrive and
+returns every array element as soon as it is closed, so validation can run while the model
+is still generating. Elements that closed before a truncated or malformed tail (timeout,
+trailing comment, unbalanced bracket) are kept; text before the first bracket (```json
+fences, a sentence of prose) and after the closing one is ignored.
+"""
+from __future__ import annotations
+
+import json
+from typing import Any, Dict, List, Tuple
+
+CONTAINER_ARRAY = "array"
+CONTAINER_OBJECT = "object"
+_OPENERS = {CONTAINER_ARRAY: "[", CONTAINER_OBJECT: "{"}
+_WHITESPACE = " \t\r\n"
+
+
+class JSONItemStream:
+    """Feed text chunks, get back (key, item) pairs; key is the block id in object mode, else None."""
+
+    def __init__(self, container: str = CONTAINER_ARRAY):
+        if container not in _OPENERS:
+            raise ValueError(f"unknown container: {container}")
+        self.container = container
+        # Elements live in the top-level array, or in the arrays one level inside the object.
+        self._item_depth = 1 if container == CONTAINER_ARRAY else 2
+        self.items: List[Tuple[str | None, Any]] = []
+        self.malformed = 0
+        self.started = False
+        self.complete = False
+        self.failed = False
+        self._buf = ""
+        self._pos = 0
+        self._stack: List[str] = []
+        self._in_string = False
+        self._escape = False
+        self._item_start: int | None = None
+        self._string_start: int | None = None
+        self._last_string: str | None = None
+        self._key: str | None = None
+
+    @property
+    def done(self) -> bool:
+        return self.complete or self.failed
+
+    @property
+    def in_item(self) -> bool:
+        """An element has started but is not closed yet."""
+        return self._item_start is not None
+
+    def _at_item_level(self) -> bool:
+        if len(self._stack) != self._item_depth or self._stack[-1] != "[":
+            return False
+        return self.container == CONTAINER_ARRAY or self._stack[0] == "{"
+
+    def _emit(self, text: str, out: list):
+        text = text.strip()
+        if not text:
+            return
+        try:
+            item = json.loads(text)
+        except Exception:
+            self.malformed += 1
+            return
+        pair = (self._key if self.container == CONTAINER_OBJECT else None, item)
+        self.items.append(pair)
+        out.append(pair)
+
+    def feed(self, chunk: str) -> List[Tuple[str | None, Any]]:
+        out: List[Tuple[str | None, Any]] = []
+        if self.done or not chunk:
+            return out
+        self._buf += chunk
+        buf = self._buf
+        i = self._pos
+        n = len(buf)
+        while i < n:
+            ch = buf[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    if self._string_start is not None:
+                        try:
+                            self._last_string = json.loads(buf[self._string_start : i + 1])
+                        except Exception:
+                            self._last_string = None
+                        self._string_start = None
+                i += 1
+                continue
+            if not self.started:
+                if ch in "[{":
+                    if ch != _OPENERS[self.container]:
+                        self.failed = True
+                        break
+                    self.started = True
+                    self._stack.append(ch)
+                i += 1
+                continue
+            at_item_level = self._at_item_level()
+            if at_item_level and self._item_start is None and ch not in _WHITESPACE and ch not in ",]":
+                self._item_start = i
+            if ch == '"':
+                self._in_string = True
+                if len(self._stack) == 1 and self.container == CONTAINER_OBJECT:
+                    self._string_start = i
+            elif ch in "[{":
+                if ch == "[" and len(self._stack) == 1 and self.container == CONTAINER_OBJECT:
+                    self._key = self._last_string
+                self._stack.append(ch)
+            elif ch in "]}":
+                if at_item_level and ch == "]" and self._item_start is not None:
+                    # Last primitive element before the closing bracket.
+                    self._emit(buf[self._item_start : i], out)
+                    self._item_start = None
+                if not self._stack or (ch == "]") != (self._stack[-1] == "["):
+                    self.failed = True
+                    break
+                self._stack.pop()
+                if self._at_item_level() and self._item_start is not None:
+                    # An object/array element just closed: hand it out without waiting for the comma.
+                    self._emit(buf[self._item_start : i + 1], out)
+                    self._item_start = None
+                if not self._stack:
+                    self.complete = True
+                    i += 1
+                    break
+            elif ch == "," and at_item_level:
+                if self._item_start is not None:
+                    self._emit(buf[self._item_start : i], out)
+                    self._item_start = None
+            i += 1
+        # Drop consumed text, keeping only a partially received element or key.
+        keep = min(p for p in (self._item_start, self._string_start, i) if p is not None)
+        self._buf = buf[keep:]
+        self._pos = i - keep
+        if self._item_start is not None:
+            self._item_start -= keep
+        if self._string_start is not None:
+            self._string_start -= keep
+        return out
+
+    def shaped(self):
+        """Items collected so far in the shape the caller expects (list, or dict of lists)."""
+        if self.container == CONTAINER_ARRAY:
+            return [item for _, item in self.items]
+        grouped: Dict[str, list] = {}
+        for key, item in self.items:
+            if key is not None:
+                grouped.setdefault(key, []).append(item)
+        return grouped
+
+
+def salvage(text: str, container: str = CONTAINER_ARRAY):
+    """Complete elements of a possibly truncated/malformed response, or None if there are none."""
+    stream = JSONItemStream(container)
+    stream.feed(text)
+    return stream.shaped() if stream.items else None
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Block leases for several fill-training-pack.py processes sharing one training pack.
+
+With --worker, every fill round first leases its block in training_pack/reports/.fill-leases.json
+(guarded by the advisory lock training_pack/.fill-leases.lock, so processes on one host or on
+hosts sharing a filesystem with working flock see one queue). A lease names its worker and
+expires after ttl_s; the worker renews its leases while rounds run, so a crashed or killed
+worker's blocks are taken over by others once the lease expires. A round's result is committed
+only inside holding(), which re-checks ownership under the lease lock, so two workers never
+write the same block file.
+"""
+from __future__ import annotations
+
+import contextlib
+import json
+import os
+import socket
+import time
+from pathlib import Path
+from typing import Dict, Iterator, List
+
+import training_pack_io as pack_io
+
+LEASES_VERSION = 1
+DEFAULT_TTL_S = 600.0
+# How often a worker with nothing to run re-checks leases held by others.
+IDLE_POLL_S = 5.0
+
+
+def leases_path(pack_dir: Path) -> Path:
+    return pack_dir / "reports" / ".fill-leases.json"
+
+
+def lock_path(pack_dir: Path) -> Path:
+    return pack_dir / ".fill-leases.lock"
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _read(path: Path) -> Dict[str, dict]:
+    try:
+        data = json.loads(path.read_text(encoding="utf-8"))
+    except Exception:
+        return {}
+    if not isinstance(data, dict) or data.get("version") != LEASES_VERSION or not isinstance(data.get("leases"), dict):
+        return {}
+    return data["leases"]
+
+
+class BlockLeases:
+    def __init__(self, pack_dir: Path, worker_id: str | None = None, ttl_s: float = DEFAULT_TTL_S):
+        self.pack_dir = pack_dir
+        self.path = leases_path(pack_dir)
+        self.worker_id = worker_id or default_worker_id()
+        self.ttl_s = ttl_s
+        self.held: set = set()
+        self.reclaimed = 0
+
+    @contextlib.contextmanager
+    def _locked(self) -> Iterator[Dict[str, dict]]:
+        with pack_io.file_lock(lock_path(self.pack_dir)):
+            leases = _read(self.path)
+            before = json.dumps(leases, sort_keys=True)
+            yield leases
+            if json.dumps(leases, sort_keys=True) != before:
+                pack_io.atomic_write_json(self.path, {"version": LEASES_VERSION, "leases": leases})
+
+    def _grant(self, leases: Dict[str, dict], bkey: str, now: float):
+        entry = leases.get(bkey) or {}
+        leases[bkey] = {
+            "worker": self.worker_id,
+            "acquired_at": entry.get("acquired_at", now) if entry.get("worker") == self.worker_id else now,
+            "expires_at": now + self.ttl_s,
+        }
+
+    def acquire(self, bkey: str) -> bool:
+        with self._locked() as leases:
+            now = time.time()
+            entry = leases.get(bkey)
+            if entry and entry.get("worker") != self.worker_id:
+                if entry.get("expires_at", 0) > now:
+                    return False
+                # The owner stopped renewing (crashed, killed, wedged): take the block over.
+                self.reclaimed += 1
+            self._grant(leases, bkey, now)
+        self.held.add(bkey)
+        return True
+
+    def renew(self) -> List[str]:
+        """Extend every held lease; returns the blocks lost to other workers after an expiry."""
+        if not self.held:
+            return []
+        lost = []
+        with self._locked() as leases:
+            now = time.time()
+            for bkey in sorted(self.held):
+                entry = leases.get(bkey)
+                if entry and entry.get("worker") != self.worker_id:
+                    lost.append(bkey)
+                    continue
+                self._grant(leases, bkey, now)
+        self.held.difference_update(lost)
+        return lost
+
+    @contextlib.contextmanager
+    def holding(self, bkey: str) -> Iterator[bool]:
+        """Yield whether this worker still owns `bkey`; the lease lock is held for the whole block."""
+        with self._locked() as leases:
+            entry = leases.get(bkey)
+            owned = bool(entry) and entry.get("worker") == self.worker_id
+            if owned:
+                self._grant(leases, bkey, time.time())
+            else:
+                self.held.discard(bkey)
+            yield owned
+
+    def release(self, bkey: str):
+        with self._locked() as leases:
+            entry = leases.get(bkey)
+            if entry and entry.get("worker") == self.worker_id:
+                del leases[bkey]
+        self.held.discard(bkey)
+
+    def release_all(self):
+        if not self.held:
+            return
+        with self._locked() as leases:
+            for bkey in self.held:
+                entry = leases.get(bkey)
+                if entry and entry.get("worker") == self.worker_id:
+                    del leases[bkey]
+        self.held.clear()
+
+    def active(self) -> Dict[str, dict]:
+        """Unexpired leases of all workers."""
+        now = time.time()
+        return {k: v for k, v in _read(self.path).items() if v.get("expires_at", 0) > now}
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Content-addressed cache of LLM responses for training pack generation.
+
+The key is sha256(model, base_url, prompt, temperature). An entry keeps every response
+produced for that key in order: the n-th identical request of a run gets the n-th stored
+response, so a rerun replays the same retry sequence and only requests past it reach the LLM.
+Entries live in training_pack/.llm-cache/<aa>/<key>.json; the least recently used ones are
+evicted once the directory grows beyond max_bytes.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict
+
+import training_pack_io as pack_io
+import training_pack_llm_client as llm_client
+
+CACHE_VERSION = 1
+
+
+def cache_dir(course_root: Path) -> Path:
+    return course_root / "training_pack" / ".llm-cache"
+
+
+class LLMResponseCache:
+    def __init__(self, root: Path, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._served: Dict[str, int] = {}
+        # key -> file size, least recently used first (file mtime is the LRU clock across runs).
+        self._sizes: "OrderedDict[str, int]" = OrderedDict()
+        self._total = 0
+        entries = []
+        if root.exists():
+            for path in root.glob("*/*.json"):
+                st = path.stat()
+                entries.append((st.st_mtime_ns, path.stem, st.st_size))
+        for _, key, size in sorted(entries):
+            self._sizes[key] = size
+            self._total += size
+
+    @staticmethod
+    def key(model: str, base_url: str, prompt: str, temperature: float, decoding: str = llm_client.DECODING_FREE) -> str:
+        parts = [CACHE_VERSION, model, base_url.rstrip("/"), prompt, temperature]
+        if decoding != llm_client.DECODING_FREE:
+            # Constrained answers differ from free ones; unconstrained keys stay as they were.
+            parts.append(decoding)
+        raw = json.dumps(parts, ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.root / key[:2] / f"{key}.json"
+
+    def _read(self, key: str) -> list:
+        try:
+            data = json.loads(self._path(key).read_text(encoding="utf-8"))
+        except Exception:
+            return []
+        responses = data.get("responses") if isinstance(data, dict) else None
+        return responses if isinstance(responses, list) else []
+
+    def get(self, key: str) -> dict | None:
+        with self._lock:
+            n = self._served.get(key, 0)
+            self._served[key] = n + 1
+            responses = self._read(key) if key in self._sizes else []
+            if n >= len(responses):
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._sizes.move_to_end(key)
+            try:
+                os.utime(self._path(key))
+            except OSError:
+                pass
+            return responses[n]
+
+    def put(self, key: str, text: str, stats: dict):
+        with self._lock:
+            responses = self._read(key) if key in self._sizes else []
+            responses.append({"text": text, "stats": stats, "stored_at": time.time()})
+            body = json.dumps({"responses": responses}, ensure_ascii=False).encode("utf-8")
+            pack_io.atomic_write_bytes(self._path(key), body)
+            self._total += len(body) - self._sizes.pop(key, 0)
+            self._sizes[key] = len(body)
+            self._evict()
+
+    def _evict(self):
+        while self._total > self.max_bytes and len(self._sizes) > 1:
+            key, size = self._sizes.popitem(last=False)
+            self._total -= size
+            self.evictions += 1
+            try:
+                self._path(key).unlink()
+            except OSError:
+                pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._sizes),
+                "bytes": self._total,
+                "max_bytes": self.max_bytes,
+            }
+
+
+def cached_stream_stats(prompt: str, stored: dict | None) -> llm_client.StreamStats:
+    stored = stored if isinstance(stored, dict) else {}
+    now = time.perf_counter()
+    stats = llm_client.StreamStats(started_at=now, finished_at=now, prompt_chars=len(prompt), cache_hit=True)
+    stats.chars = int(stored.get("chars") or 0)
+    stats.completion_tokens = stored.get("completion_tokens")
+    stats.decoding = stored.get("decoding") or llm_client.DECODING_FREE
+    return stats
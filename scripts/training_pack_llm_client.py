@@ -0,0 +1,648 @@
+#!/usr/bin/env python3
+"""
+Pooled LLM client for training pack generation (llama.cpp/OpenAI-compatible or Ollama).
+
+One LLMClient per base URL keeps idle keep-alive HTTP connections for reuse and decides
+once per process whether the server speaks /v1/chat/completions or Ollama /api/generate,
+instead of probing the OpenAI endpoint before every request. A request can carry a
+DecodingConstraint (JSON schema and/or GBNF grammar); a mode the server rejects is dropped
+for the rest of the process and the request is retried with the next one.
+
+The socket timeout only fires on inactivity, so a server trickling a token every few seconds
+could hold a request for many minutes. With StallLimits every socket read is bounded by the
+time left to the nearest threshold (whole request, first token, minimum tokens/sec) and a
+request that crosses one is aborted with StreamStalled; stats.stall records which one.
+"""
+from __future__ import annotations
+
+import http.client
+import json
+import os
+import threading
+import time
+import urllib.error
+import urllib.parse
+from collections import deque
+from dataclasses import dataclass, field, fields, replace
+from typing import Callable, Dict, List, Tuple
+
+BACKEND_OPENAI = "openai-compatible"
+BACKEND_OLLAMA = "ollama"
+
+DECODING_FREE = "free"
+DECODING_SCHEMA = "json_schema"
+DECODING_GRAMMAR = "grammar"
+DECODING_MODES = (DECODING_FREE, DECODING_SCHEMA, DECODING_GRAMMAR)
+# Each mode falls back to the next one when the server rejects it.
+_DECODING_FALLBACK = {DECODING_GRAMMAR: DECODING_SCHEMA, DECODING_SCHEMA: DECODING_FREE}
+# Status codes of a server refusing an unknown/invalid request field rather than failing.
+_UNSUPPORTED_STATUS = (400, 422, 501)
+
+# Errors that mean a reused keep-alive socket was closed by the server while idle.
+_STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError, ConnectionAbortedError)
+
+STALL_TOTAL = "total"
+STALL_TTFT = "ttft"
+STALL_SLOW = "slow"
+# Tokens/sec is judged only after this much streaming: the first tokens come in bursts.
+RATE_GRACE_S = 10.0
+
+
+class UnsupportedDecoding(Exception):
+    """The backend has no way to send this decoding mode; try the next one."""
+
+
+class StreamStalled(Exception):
+    """The watchdog aborted a request that crossed a StallLimits threshold."""
+
+    def __init__(self, reason: str, message: str):
+        super().__init__(message)
+        self.reason = reason
+
+
+@dataclass(frozen=True)
+class StallLimits:
+    """Per-request watchdog thresholds; 0 turns a check off."""
+
+    total_s: float = 0.0
+    ttft_s: float = 0.0
+    min_tokens_per_s: float = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.total_s or self.ttft_s or self.min_tokens_per_s)
+
+
+@dataclass
+class DecodingConstraint:
+    mode: str = DECODING_FREE
+    schema: dict | None = None
+    grammar: str | None = None
+
+
+@dataclass
+class StreamStats:
+    started_at: float = 0.0
+    first_chunk_at: float | None = None
+    finished_at: float | None = None
+    chars: int = 0
+    chunks: int = 0
+    completion_tokens: int | None = None
+    prompt_chars: int = 0
+    prefix_shared_chars: int = 0
+    prompt_tokens: int | None = None
+    cached_prompt_tokens: int | None = None
+    cache_hit: bool = False
+    stopped_early: bool = False
+    decoding: str = DECODING_FREE
+    decoding_fallback: List[str] = field(default_factory=list)
+    backend: str = ""
+    stall: str | None = None
+
+    def on_chunk(self, chunk: str):
+        if self.first_chunk_at is None:
+            self.first_chunk_at = time.perf_counter()
+        self.chars += len(chunk)
+        self.chunks += 1
+
+    def reset(self):
+        """Forget an attempt that streamed nothing, so a retry on another server starts clean."""
+        fresh = StreamStats()
+        for f in fields(self):
+            setattr(self, f.name, getattr(fresh, f.name))
+
+    @property
+    def ttft_s(self) -> float | None:
+        if self.first_chunk_at is None:
+            return None
+        return self.first_chunk_at - self.started_at
+
+    @property
+    def tokens(self) -> int:
+        # Streaming servers send roughly one token per chunk; prefer the server's own count.
+        return self.completion_tokens if self.completion_tokens is not None else self.chunks
+
+    @property
+    def tokens_per_s(self) -> float | None:
+        # Non-streamed responses have no first-chunk time, so the rate includes prefill.
+        if self.finished_at is None or not self.tokens:
+            return None
+        start = self.first_chunk_at if self.first_chunk_at is not None else self.started_at
+        elapsed = self.finished_at - start
+        return self.tokens / elapsed if elapsed > 0 else None
+
+    def as_dict(self) -> dict:
+        total = (self.finished_at - self.started_at) if self.finished_at is not None else None
+        return {
+            "ttft_s": round(self.ttft_s, 3) if self.ttft_s is not None else None,
+            "total_s": round(total, 3) if total is not None else None,
+            "chars": self.chars,
+            "completion_tokens": self.tokens,
+            "tokens_per_s": round(self.tokens_per_s, 2) if self.tokens_per_s is not None else None,
+            "prompt_chars": self.prompt_chars,
+            "prefix_shared_chars": self.prefix_shared_chars,
+            "prompt_tokens": self.prompt_tokens,
+            "cached_prompt_tokens": self.cached_prompt_tokens,
+            "cache_hit": self.cache_hit,
+            "stopped_early": self.stopped_early,
+            "decoding": self.decoding,
+            "decoding_fallback": list(self.decoding_fallback),
+            "backend": self.backend,
+            "stall": self.stall,
+        }
+
+
+class _Watchdog:
+    """Enforces StallLimits on one request: bounds each socket read by the time left to the nearest limit."""
+
+    def __init__(self, limits: StallLimits, stats: StreamStats, idle_timeout_s: float, streaming: bool):
+        self.limits = limits
+        self.stats = stats
+        self.idle_timeout_s = idle_timeout_s
+        self.streaming = streaming
+        self.sock = None
+
+    def _deadline(self) -> Tuple[float, str] | None:
+        """Earliest moment a limit is crossed if no further chunk arrives, and which limit."""
+        stats, limits = self.stats, self.limits
+        candidates = []
+        if limits.total_s:
+            candidates.append((stats.started_at + limits.total_s, STALL_TOTAL))
+        if self.streaming and stats.first_chunk_at is None and limits.ttft_s:
+            candidates.append((stats.started_at + limits.ttft_s, STALL_TTFT))
+        if self.streaming and stats.first_chunk_at is not None and limits.min_tokens_per_s:
+            # chunks / elapsed drops below the minimum once elapsed exceeds chunks / minimum.
+            wait_s = max(RATE_GRACE_S, stats.chunks / limits.min_tokens_per_s)
+            candidates.append((stats.first_chunk_at + wait_s, STALL_SLOW))
+        return min(candidates) if candidates else None
+
+    def _stalled(self, reason: str) -> StreamStalled:
+        stats, limits = self.stats, self.limits
+        self.stats.stall = reason
+        elapsed = time.perf_counter() - stats.started_at
+        if reason == STALL_TTFT:
+            message = f"stalled: no first token in {limits.ttft_s:g}s"
+        elif reason == STALL_SLOW:
+            rate = stats.chunks / max(1e-9, time.perf_counter() - stats.first_chunk_at)
+            message = f"stalled: {rate:.2f} tok/s < {limits.min_tokens_per_s:g} tok/s after {stats.chunks} tokens"
+        else:
+            message = f"stalled: request exceeded {limits.total_s:g}s ({stats.chunks} tokens in {elapsed:.0f}s)"
+        return StreamStalled(reason, message)
+
+    def check(self):
+        deadline = self._deadline()
+        if deadline is not None and time.perf_counter() >= deadline[0]:
+            raise self._stalled(deadline[1])
+
+    def call(self, read: Callable):
+        """Run one blocking read of the response with the socket timeout cut to the nearest limit."""
+        deadline = self._deadline()
+        if self.sock is not None:
+            left = deadline[0] - time.perf_counter() if deadline is not None else self.idle_timeout_s
+            self.sock.settimeout(max(0.01, min(self.idle_timeout_s, left)))
+        try:
+            return read()
+        except TimeoutError:
+            if deadline is not None and time.perf_counter() >= deadline[0]:
+                raise self._stalled(deadline[1]) from None
+            raise
+
+
+class PrefixTracker:
+    """Client-side estimate of prompt-prefix reuse: longest common prefix with recent prompts."""
+
+    def __init__(self, history: int = 8):
+        self._recent = deque(maxlen=history)
+        self._lock = threading.Lock()
+
+    def observe(self, prompt: str) -> int:
+        with self._lock:
+            recent = list(self._recent)
+            self._recent.append(prompt)
+        return max((len(os.path.commonprefix([p, prompt])) for p in recent), default=0)
+
+
+class LLMClient:
+    """
+    on_chunk passed to generate() may return True to stop the stream: the connection is then
+    closed instead of read to the end (llama.cpp and Ollama stop generating for a closed client)
+    and stats.stopped_early is set.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        model: str,
+        api_key: str = "",
+        timeout_s: float = 360,
+        temperature: float = 0.1,
+        stream: bool = True,
+        max_idle_connections: int = 8,
+        max_inflight: int = 0,
+        cache_prompt: bool = False,
+        stall_limits: StallLimits | None = None,
+    ):
+        parsed = urllib.parse.urlsplit(base_url.rstrip("/"))
+        self.base_url = base_url.rstrip("/")
+        self.scheme = parsed.scheme or "http"
+        self.host = parsed.hostname or "127.0.0.1"
+        self.port = parsed.port
+        self.path_prefix = parsed.path.rstrip("/")
+        self.model = model
+        self.api_key = api_key
+        self.timeout_s = timeout_s
+        self.temperature = temperature
+        self.stream = stream
+        self.max_idle_connections = max_idle_connections
+        self.cache_prompt = cache_prompt
+        self.stall_limits = stall_limits if stall_limits is not None and stall_limits.enabled else None
+        self.backend: str | None = None
+        self.llamacpp: bool | None = None
+        self.prefix_tracker = PrefixTracker()
+        self.unsupported_decoding: set = set()
+        self._inflight = threading.BoundedSemaphore(max_inflight) if max_inflight > 0 else None
+        self._idle: List[http.client.HTTPConnection] = []
+        self._lock = threading.Lock()
+
+    # -- connection pool -------------------------------------------------
+
+    def _new_connection(self) -> http.client.HTTPConnection:
+        cls = http.client.HTTPSConnection if self.scheme == "https" else http.client.HTTPConnection
+        return cls(self.host, self.port, timeout=self.timeout_s)
+
+    def _acquire(self) -> Tuple[http.client.HTTPConnection, bool]:
+        with self._lock:
+            if self._idle:
+                return self._idle.pop(), True
+        return self._new_connection(), False
+
+    def _release(self, conn: http.client.HTTPConnection, reusable: bool):
+        if reusable and conn.sock is not None:
+            # A watchdog may have shortened it for the last read.
+            conn.sock.settimeout(self.timeout_s)
+        if reusable:
+            with self._lock:
+                if len(self._idle) < self.max_idle_connections:
+                    self._idle.append(conn)
+                    return
+        conn.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+    def _post(self, path: str, payload: dict, headers: Dict[str, str], watchdog: _Watchdog | None = None):
+        body = json.dumps(payload).encode("utf-8")
+        url_path = self.path_prefix + path
+        while True:
+            conn, reused = self._acquire()
+            try:
+                conn.request("POST", url_path, body=body, headers=headers)
+                if watchdog is not None:
+                    # The connection drops its socket for a Connection: close response; the response keeps reading it.
+                    watchdog.sock = conn.sock
+                    resp = watchdog.call(conn.getresponse)
+                else:
+                    resp = conn.getresponse()
+            except _STALE_CONNECTION_ERRORS:
+                conn.close()
+                if reused:
+                    continue
+                raise
+            except Exception:
+                conn.close()
+                raise
+            if resp.status >= 400:
+                resp.read()
+                self._release(conn, not resp.will_close)
+                raise urllib.error.HTTPError(self.base_url + path, resp.status, resp.reason, resp.headers, None)
+            return conn, resp
+
+    def _get_json(self, path: str):
+        conn, _ = self._acquire()
+        try:
+            conn.request("GET", self.path_prefix + path)
+            resp = conn.getresponse()
+            body = resp.read()
+        except Exception:
+            conn.close()
+            raise
+        self._release(conn, not resp.will_close)
+        if resp.status >= 400:
+            raise urllib.error.HTTPError(self.base_url + path, resp.status, resp.reason, resp.headers, None)
+        return json.loads(body.decode("utf-8"))
+
+    def ping(self, timeout_s: float = 3) -> bool:
+        """Server answers at all (any status below 500, as llm-benchmark's wait_http_ok); llama.cpp /health is 503 while loading."""
+        conn = self._new_connection()
+        conn.timeout = timeout_s
+        try:
+            conn.request("GET", self.path_prefix + "/health")
+            resp = conn.getresponse()
+            resp.read()
+            return 200 <= resp.status < 500
+        except Exception:
+            return False
+        finally:
+            conn.close()
+
+    def tokenize(self, text: str) -> int | None:
+        """Exact prompt token count from llama.cpp /tokenize, or None if the server has no such endpoint."""
+        if not self.is_llamacpp():
+            return None
+        try:
+            conn, resp = self._post("/tokenize", {"content": text}, self._headers())
+        except urllib.error.HTTPError as e:
+            if e.code in (404, 405, 501):
+                return None
+            raise
+        try:
+            body = resp.read()
+        except Exception:
+            conn.close()
+            raise
+        self._release(conn, not resp.will_close)
+        data = json.loads(body.decode("utf-8"))
+        tokens = data.get("tokens") if isinstance(data, dict) else None
+        return len(tokens) if isinstance(tokens, list) else None
+
+    def is_llamacpp(self) -> bool:
+        # llama.cpp server exposes /props with its slot/generation settings; other servers 404.
+        if self.llamacpp is None:
+            try:
+                props = self._get_json("/props")
+                self.llamacpp = isinstance(props, dict) and ("default_generation_settings" in props or "total_slots" in props)
+            except Exception:
+                self.llamacpp = False
+        return self.llamacpp
+
+    def _finish(self, conn: http.client.HTTPConnection, resp: http.client.HTTPResponse, complete: bool):
+        # A connection goes back to the pool only if its response was read to the end.
+        if complete:
+            resp.read()
+        else:
+            # Close the socket even when the response owns it (Connection: close): the server stops generating.
+            resp.close()
+        self._release(conn, complete and not resp.will_close)
+
+    @staticmethod
+    def _iter_lines(resp: http.client.HTTPResponse, watchdog: _Watchdog | None):
+        while True:
+            raw_line = watchdog.call(resp.readline) if watchdog is not None else resp.readline()
+            if not raw_line:
+                return
+            line = raw_line.decode("utf-8", errors="ignore").strip()
+            if line:
+                yield line
+
+    # -- backends ----------------------------------------------------------
+
+    def _headers(self) -> Dict[str, str]:
+        headers = {"Content-Type": "application/json"}
+        if self.api_key:
+            headers["Authorization"] = f"Bearer {self.api_key}"
+        return headers
+
+    def _openai_generate(
+        self,
+        prompt: str,
+        on_chunk: Callable[[str], bool | None] | None,
+        stats: StreamStats,
+        constraint: DecodingConstraint,
+        watchdog: _Watchdog | None = None,
+    ) -> str:
+        payload = {
+            "model": self.model,
+            "messages": [{"role": "user", "content": prompt}],
+            "temperature": self.temperature,
+            "stream": self.stream,
+        }
+        if self.cache_prompt and self.is_llamacpp():
+            # Let llama.cpp reuse the KV cache of the longest matching prompt prefix in the slot.
+            payload["cache_prompt"] = True
+        if constraint.mode == DECODING_GRAMMAR:
+            if not self.is_llamacpp() or not constraint.grammar:
+                raise UnsupportedDecoding(constraint.mode)
+            payload["grammar"] = constraint.grammar
+        elif constraint.mode == DECODING_SCHEMA:
+            if not constraint.schema:
+                raise UnsupportedDecoding(constraint.mode)
+            if self.is_llamacpp():
+                # llama.cpp compiles the schema to a grammar itself and, unlike OpenAI strict
+                # mode, accepts an array at the root.
+                payload["json_schema"] = constraint.schema
+            else:
+                payload["response_format"] = {
+                    "type": "json_schema",
+                    "json_schema": {"name": "training_pack_questions", "schema": constraint.schema},
+                }
+        conn, resp = self._post("/v1/chat/completions", payload, self._headers(), watchdog)
+        complete = False
+        try:
+            if not self.stream:
+                data = json.loads((watchdog.call(resp.read) if watchdog is not None else resp.read()).decode("utf-8"))
+                complete = True
+                text = data.get("choices", [{}])[0].get("message", {}).get("content", "")
+                stats.chars, stats.chunks = len(text), 1
+                stats.completion_tokens = (data.get("usage") or {}).get("completion_tokens")
+                self._read_timings(data, stats)
+                return text
+            parts: List[str] = []
+            for line in self._iter_lines(resp, watchdog):
+                if line.startswith("data:"):
+                    line = line[5:].strip()
+                if line == "[DONE]":
+                    break
+                try:
+                    data = json.loads(line)
+                except Exception:
+                    continue
+                if isinstance(data.get("usage"), dict) and data["usage"].get("completion_tokens") is not None:
+                    stats.completion_tokens = int(data["usage"]["completion_tokens"])
+                elif isinstance(data.get("timings"), dict) and data["timings"].get("predicted_n") is not None:
+                    stats.completion_tokens = int(data["timings"]["predicted_n"])
+                self._read_timings(data, stats)
+                choices = data.get("choices", [])
+                if not choices:
+                    continue
+                delta = choices[0].get("delta", {})
+                chunk = delta.get("content", "")
+                if not chunk and isinstance(choices[0].get("message"), dict):
+                    chunk = choices[0]["message"].get("content", "")
+                if chunk:
+                    parts.append(chunk)
+                    stats.on_chunk(chunk)
+                    if watchdog is not None:
+                        watchdog.check()
+                    if on_chunk is not None and on_chunk(chunk):
+                        stats.stopped_early = True
+                        return "".join(parts)
+            complete = True
+            return "".join(parts)
+        finally:
+            self._finish(conn, resp, complete)
+
+    @staticmethod
+    def _read_timings(data: dict, stats: StreamStats):
+        timings = data.get("timings")
+        if isinstance(timings, dict):
+            if timings.get("prompt_n") is not None:
+                stats.prompt_tokens = int(timings["prompt_n"])
+            if timings.get("cache_n") is not None:
+                stats.cached_prompt_tokens = int(timings["cache_n"])
+
+    def _ollama_generate(
+        self,
+        prompt: str,
+        on_chunk: Callable[[str], bool | None] | None,
+        stats: StreamStats,
+        constraint: DecodingConstraint,
+        watchdog: _Watchdog | None = None,
+    ) -> str:
+        payload = {
+            "model": self.model,
+            "prompt": prompt,
+            "stream": self.stream,
+            "options": {"temperature": self.temperature},
+            "keep_alive": "30m",
+        }
+        if constraint.mode == DECODING_GRAMMAR or (constraint.mode == DECODING_SCHEMA and not constraint.schema):
+            raise UnsupportedDecoding(constraint.mode)
+        if constraint.mode == DECODING_SCHEMA:
+            # Ollama >= 0.5 accepts a JSON schema as structured output format.
+            payload["format"] = constraint.schema
+        conn, resp = self._post("/api/generate", payload, {"Content-Type": "application/json"}, watchdog)
+        complete = False
+        try:
+            if not self.stream:
+                data = json.loads((watchdog.call(resp.read) if watchdog is not None else resp.read()).decode("utf-8"))
+                complete = True
+                text = data.get("response", "")
+                stats.chars, stats.chunks = len(text), 1
+                stats.completion_tokens = data.get("eval_count")
+                return text
+            parts: List[str] = []
+            for line in self._iter_lines(resp, watchdog):
+                try:
+                    data = json.loads(line)
+                except Exception:
+                    continue
+                chunk = data.get("response", "")
+                if chunk:
+                    parts.append(chunk)
+                    stats.on_chunk(chunk)
+                    if watchdog is not None:
+                        watchdog.check()
+                    if on_chunk is not None and on_chunk(chunk):
+                        stats.stopped_early = True
+                        return "".join(parts)
+                if data.get("done") is True:
+                    if data.get("eval_count") is not None:
+                        stats.completion_tokens = int(data["eval_count"])
+                    if data.get("prompt_eval_count") is not None:
+                        stats.prompt_tokens = int(data["prompt_eval_count"])
+                    break
+            complete = True
+            return "".join(parts)
+        finally:
+            self._finish(conn, resp, complete)
+
+    def generate(
+        self,
+        prompt: str,
+        on_chunk: Callable[[str], bool | None] | None = None,
+        stats: StreamStats | None = None,
+        constraint: DecodingConstraint | None = None,
+    ) -> Tuple[str, StreamStats]:
+        # Pass `stats` to keep timings of a request that raises midway (timeout, dropped connection).
+        if self._inflight is not None:
+            self._inflight.acquire()
+        stats = stats if stats is not None else StreamStats()
+        stats.started_at, stats.prompt_chars = time.perf_counter(), len(prompt)
+        stats.backend = self.base_url
+        stats.prefix_shared_chars = self.prefix_tracker.observe(prompt)
+        watchdog = _Watchdog(self.stall_limits, stats, self.timeout_s, self.stream) if self.stall_limits is not None else None
+        try:
+            return self._generate_constrained(prompt, on_chunk, stats, constraint or DecodingConstraint(), watchdog), stats
+        finally:
+            stats.finished_at = time.perf_counter()
+            if self._inflight is not None:
+                self._inflight.release()
+
+    def _generate_constrained(
+        self,
+        prompt: str,
+        on_chunk: Callable[[str], bool | None] | None,
+        stats: StreamStats,
+        constraint: DecodingConstraint,
+        watchdog: _Watchdog | None = None,
+    ) -> str:
+        mode = constraint.mode
+        while mode in self.unsupported_decoding:
+            mode = _DECODING_FALLBACK.get(mode, DECODING_FREE)
+        failed: List[str] = []
+        while True:
+            stats.decoding = mode
+            try:
+                text = self._generate(prompt, on_chunk, stats, replace(constraint, mode=mode), watchdog)
+            except (UnsupportedDecoding, urllib.error.HTTPError) as e:
+                refused = isinstance(e, UnsupportedDecoding) or e.code in _UNSUPPORTED_STATUS
+                if mode == DECODING_FREE or not refused:
+                    raise
+                # A rejection is remembered only once a fallback succeeds: a 400 for an
+                # oversized prompt would fail the unconstrained retry just the same.
+                failed.append(mode)
+                stats.decoding_fallback.append(mode)
+                mode = _DECODING_FALLBACK.get(mode, DECODING_FREE)
+                continue
+            self.unsupported_decoding.update(failed)
+            return text
+
+    def _generate(
+        self,
+        prompt: str,
+        on_chunk: Callable[[str], bool | None] | None,
+        stats: StreamStats,
+        constraint: DecodingConstraint,
+        watchdog: _Watchdog | None = None,
+    ) -> str:
+        if self.backend == BACKEND_OPENAI:
+            return self._openai_generate(prompt, on_chunk, stats, constraint, watchdog)
+        if self.backend == BACKEND_OLLAMA:
+            return self._ollama_generate(prompt, on_chunk, stats, constraint, watchdog)
+        # Backend not known yet: prefer the OpenAI-compatible endpoint (llama.cpp server mode)
+        # and remember the answer for the rest of the process.
+        try:
+            text = self._openai_generate(prompt, on_chunk, stats, constraint, watchdog)
+            self.backend = BACKEND_OPENAI
+            return text
+        except (UnsupportedDecoding, StreamStalled):
+            raise
+        except urllib.error.HTTPError as e:
+            if e.code not in (404, 405):
+                raise
+            text = self._ollama_generate(prompt, on_chunk, stats, constraint, watchdog)
+            self.backend = BACKEND_OLLAMA
+            return text
+        except (ConnectionError, http.client.HTTPException):
+            # Only a refused/dropped connection before any output says "not this endpoint";
+            # once chunks reached on_chunk, a second stream would mix into the first.
+            if stats.chunks:
+                raise
+            return self._ollama_generate(prompt, on_chunk, stats, constraint, watchdog)
+
+
+_CLIENTS: Dict[tuple, LLMClient] = {}
+_CLIENTS_LOCK = threading.Lock()
+
+
+def get_client(base_url: str, model: str, api_key: str = "", **kwargs) -> LLMClient:
+    key = (base_url.rstrip("/"), model, api_key, tuple(sorted(kwargs.items())))
+    with _CLIENTS_LOCK:
+        client = _CLIENTS.get(key)
+        if client is None:
+            client = LLMClient(base_url, model, api_key=api_key, **kwargs)
+            _CLIENTS[key] = client
+        return client
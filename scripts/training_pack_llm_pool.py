@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+"""
+Load balancing of training pack LLM requests across several servers.
+
+`--llm-base-url` may list several llama.cpp/Ollama servers separated by commas (one per
+core group/NUMA node). LLMPool routes each request to one of their LLMClients:
+
+  least-outstanding  the backend with the fewest requests in flight relative to its weight;
+  weighted           smooth weighted round-robin.
+
+A backend that fails twice in a row (connection error, timeout, HTTP 5xx) is ejected for a
+cooldown that doubles on every failed re-check, up to 5 minutes; when it runs out, the next
+request probes /health first (any status below 500 counts as alive, like llm-benchmark's
+wait_http_ok). A request that failed before its first streamed chunk is retried on another
+backend.
+
+Stalls (requests aborted by the StallLimits watchdog) do not eject a backend, since a slow
+server still answers /health. Instead a circuit breaker pauses dispatch to a backend after
+3 stalls within 10 minutes, for 1 minute doubling on every trip up to 5 minutes; a stall
+before the first token is retried on another backend. When every backend is paused, requests
+wait for the first pause to end instead of failing. With a single URL and no stall limits
+connect() returns the plain LLMClient.
+"""
+from __future__ import annotations
+
+import http.client
+import socket
+import threading
+import time
+import urllib.error
+from collections import deque
+from typing import Callable, Dict, List, Tuple
+
+import training_pack_llm_client as llm_client
+
+ROUTING_LEAST_OUTSTANDING = "least-outstanding"
+ROUTING_WEIGHTED = "weighted"
+ROUTINGS = (ROUTING_LEAST_OUTSTANDING, ROUTING_WEIGHTED)
+
+EJECT_AFTER_FAILURES = 2
+EJECT_COOLDOWN_S = 10.0
+EJECT_COOLDOWN_MAX_S = 300.0
+
+STALL_BREAKER_STALLS = 3
+STALL_BREAKER_WINDOW_S = 600.0
+STALL_PAUSE_S = 60.0
+
+# Errors that say the server (not the request) is at fault.
+_BACKEND_ERRORS = (OSError, http.client.HTTPException, socket.timeout)
+
+
+def parse_base_urls(value: str) -> List[str]:
+    return [u.strip().rstrip("/") for u in str(value or "").split(",") if u.strip()]
+
+
+def parse_weights(value: str | None, count: int) -> List[float]:
+    if not value:
+        return [1.0] * count
+    weights = [float(w) for w in str(value).split(",") if w.strip()]
+    if len(weights) != count or any(w <= 0 for w in weights):
+        raise ValueError(f"expected {count} positive weights, got {value!r}")
+    return weights
+
+
+def is_backend_failure(error: Exception) -> bool:
+    if isinstance(error, urllib.error.HTTPError):
+        return error.code >= 500
+    return isinstance(error, _BACKEND_ERRORS)
+
+
+class Backend:
+    def __init__(self, client: llm_client.LLMClient, weight: float):
+        self.client = client
+        self.weight = weight
+        self.inflight = 0
+        self.current_weight = 0.0
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+        self.cooldown_s = EJECT_COOLDOWN_S
+        self.requests = 0
+        self.failures = 0
+        self.ejections = 0
+        self.completion_tokens = 0
+        self.busy_s = 0.0
+        self.stalls = 0
+        self.recent_stalls: deque = deque()
+        self.paused_until = 0.0
+        self.pause_s = STALL_PAUSE_S
+        self.pauses = 0
+
+    @property
+    def base_url(self) -> str:
+        return self.client.base_url
+
+    def report(self) -> dict:
+        return {
+            "base_url": self.base_url,
+            "weight": self.weight,
+            "requests": self.requests,
+            "failures": self.failures,
+            "ejections": self.ejections,
+            "ejected": self.ejected_until > time.monotonic(),
+            "stalls": self.stalls,
+            "pauses": self.pauses,
+            "paused": self.paused_until > time.monotonic(),
+            "completion_tokens": self.completion_tokens,
+            "busy_s": round(self.busy_s, 3),
+        }
+
+
+class LLMPool:
+    """LLMClient-compatible front for several servers running the same model."""
+
+    def __init__(self, clients: List[llm_client.LLMClient], weights: List[float], routing: str = ROUTING_LEAST_OUTSTANDING):
+        if routing not in ROUTINGS:
+            raise ValueError(f"unknown routing: {routing}")
+        self.backends = [Backend(c, w) for c, w in zip(clients, weights)]
+        self.routing = routing
+        self.model = clients[0].model
+        self.temperature = clients[0].temperature
+        # One logical endpoint for response cache keys, whichever server answered.
+        self.base_url = ",".join(c.base_url for c in clients)
+        self._lock = threading.Lock()
+
+    @property
+    def llamacpp(self) -> bool | None:
+        values = [b.client.llamacpp for b in self.backends if b.client.llamacpp is not None]
+        return any(values) if values else None
+
+    @property
+    def unsupported_decoding(self) -> set:
+        return set().union(*(b.client.unsupported_decoding for b in self.backends))
+
+    def is_llamacpp(self) -> bool:
+        return any(b.client.is_llamacpp() for b in self.backends)
+
+    def check_health(self) -> Dict[str, bool]:
+        """Probe every backend now; the ones that do not answer start ejected."""
+        status = {}
+        for backend in self.backends:
+            ok = backend.client.ping()
+            status[backend.base_url] = ok
+            if not ok:
+                with self._lock:
+                    self._eject(backend)
+        return status
+
+    # -- routing -------------------------------------------------------------
+
+    def _eject(self, backend: Backend):
+        backend.ejections += 1
+        backend.ejected_until = time.monotonic() + backend.cooldown_s
+        backend.cooldown_s = min(EJECT_COOLDOWN_MAX_S, backend.cooldown_s * 2)
+
+    def _record_stall(self, backend: Backend):
+        now = time.monotonic()
+        backend.stalls += 1
+        backend.recent_stalls.append(now)
+        while backend.recent_stalls and backend.recent_stalls[0] < now - STALL_BREAKER_WINDOW_S:
+            backend.recent_stalls.popleft()
+        if len(backend.recent_stalls) >= STALL_BREAKER_STALLS:
+            backend.recent_stalls.clear()
+            backend.pauses += 1
+            backend.paused_until = now + backend.pause_s
+            backend.pause_s = min(EJECT_COOLDOWN_MAX_S, backend.pause_s * 2)
+
+    def _pick(self, exclude: set) -> Backend | None:
+        with self._lock:
+            now = time.monotonic()
+            live = [b for b in self.backends if b not in exclude and b.ejected_until <= now and b.paused_until <= now]
+            if not live:
+                return None
+            if self.routing == ROUTING_WEIGHTED:
+                total = sum(b.weight for b in live)
+                for b in live:
+                    b.current_weight += b.weight
+                chosen = max(live, key=lambda b: b.current_weight)
+                chosen.current_weight -= total
+            else:
+                chosen = min(live, key=lambda b: ((b.inflight + 1) / b.weight, b.requests))
+            chosen.inflight += 1
+            return chosen
+
+    def _acquire(self, exclude: set) -> Backend:
+        while True:
+            backend = self._pick(exclude)
+            if backend is None:
+                now = time.monotonic()
+                paused = [b.paused_until for b in self.backends if b not in exclude and b.ejected_until <= now < b.paused_until]
+                if paused:
+                    # Only stalled-out backends are left: hold the request until the first pause ends.
+                    time.sleep(min(paused) - now)
+                    continue
+                raise RuntimeError("no healthy LLM backend: " + ", ".join(b.base_url for b in self.backends))
+            if backend.consecutive_failures < EJECT_AFTER_FAILURES:
+                return backend
+            # Back from ejection: re-admit only if the server answers again.
+            if backend.client.ping():
+                with self._lock:
+                    backend.consecutive_failures = 0
+                    backend.cooldown_s = EJECT_COOLDOWN_S
+                return backend
+            with self._lock:
+                backend.inflight -= 1
+                self._eject(backend)
+
+    def _release(self, backend: Backend, stats: llm_client.StreamStats, error: Exception | None):
+        with self._lock:
+            backend.inflight -= 1
+            backend.requests += 1
+            if stats.finished_at is not None:
+                backend.busy_s += stats.finished_at - stats.started_at
+            if error is None:
+                backend.consecutive_failures = 0
+                backend.cooldown_s = EJECT_COOLDOWN_S
+                backend.pause_s = STALL_PAUSE_S
+                backend.completion_tokens += stats.tokens
+                return
+            if isinstance(error, llm_client.StreamStalled):
+                self._record_stall(backend)
+                return
+            if not is_backend_failure(error):
+                return
+            backend.failures += 1
+            backend.consecutive_failures += 1
+            if backend.consecutive_failures >= EJECT_AFTER_FAILURES:
+                self._eject(backend)
+
+    # -- LLMClient interface -------------------------------------------------
+
+    def generate(
+        self,
+        prompt: str,
+        on_chunk: Callable[[str], bool | None] | None = None,
+        stats: llm_client.StreamStats | None = None,
+        constraint: llm_client.DecodingConstraint | None = None,
+    ) -> Tuple[str, llm_client.StreamStats]:
+        stats = stats if stats is not None else llm_client.StreamStats()
+        tried: set = set()
+        while True:
+            backend = self._acquire(tried)
+            tried.add(backend)
+            chunks_before = stats.chunks
+            try:
+                text, stats = backend.client.generate(prompt, on_chunk=on_chunk, stats=stats, constraint=constraint)
+            except Exception as e:
+                self._release(backend, stats, e)
+                # Nothing reached the caller yet: the request can go to another server.
+                retryable = is_backend_failure(e) or isinstance(e, llm_client.StreamStalled)
+                if retryable and stats.chunks == chunks_before and len(tried) < len(self.backends):
+                    # _release has already charged this backend for its span; the retry keeps
+                    # the caller's object but must not report the failed attempt's stall or timing.
+                    stats.reset()
+                    continue
+                raise
+            self._release(backend, stats, None)
+            return text, stats
+
+    def tokenize(self, text: str) -> int | None:
+        """None only if no backend is llama.cpp; raises while all llama.cpp backends are out of rotation."""
+        llamacpp = [b for b in self.backends if b.client.is_llamacpp()]
+        if not llamacpp:
+            return None
+        now = time.monotonic()
+        for backend in llamacpp:
+            if backend.ejected_until <= now and backend.paused_until <= now:
+                return backend.client.tokenize(text)
+        raise RuntimeError("no llama.cpp backend in rotation for /tokenize")
+
+    def close(self):
+        for backend in self.backends:
+            backend.client.close()
+
+    def report(self) -> List[dict]:
+        with self._lock:
+            return [b.report() for b in self.backends]
+
+
+def connect(
+    base_url: str,
+    model: str,
+    api_key: str = "",
+    weights: str | None = None,
+    routing: str = ROUTING_LEAST_OUTSTANDING,
+    **kwargs,
+):
+    """LLMClient for one URL, LLMPool for a comma-separated list or when stall limits are set."""
+    urls = parse_base_urls(base_url)
+    stall_limits = kwargs.get("stall_limits")
+    if len(urls) <= 1 and not (stall_limits is not None and stall_limits.enabled):
+        return llm_client.get_client(base_url, model, api_key=api_key, **kwargs)
+    clients = [llm_client.get_client(url, model, api_key=api_key, **kwargs) for url in urls]
+    return LLMPool(clients, parse_weights(weights, len(urls)), routing)
@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+"""
+Near-duplicate question detection for the training pack and chapter question banks.
+
+question_signature only matches normalized text exactly, so a reworded prompt with the same
+answer ("Выберите правильный вариант" vs "Выберите верный вариант") passes as a new question.
+Here a question's prompt and its answer side (correct answer + choice texts) are each cut into
+character shingles and reduced to MinHash sketches; LSH banding over the sketches yields
+candidate pairs without comparing every pair, and a candidate is confirmed when the estimated
+Jaccard similarity of both sides reaches the threshold.
+
+Used by generate-training-pack.py (--near-dup-threshold) as an acceptance filter, and as a
+batch tool:
+
+  python3 scripts/training_pack_near_dupes.py --course-root .           # report
+  python3 scripts/training_pack_near_dupes.py --course-root . --apply   # drop training_pack near-duplicates
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import threading
+import zlib
+from datetime import datetime, timezone
+from operator import eq
+from pathlib import Path
+from typing import Dict, Iterable, List, Tuple
+
+import training_pack_course_index as course_index
+import training_pack_io as pack_io
+from training_pack_signatures import normalize_text, question_signature, renumber_question_ids
+
+NUM_PERM = 64
+BANDS = 16
+SHINGLE_SIZE = 5
+DEFAULT_THRESHOLD = 0.8
+_EMPTY = 1 << 32
+
+SOURCE_PACK = "training_pack"
+SOURCE_BANK = "question_bank"
+SOURCE_GENERATED = "generated"
+
+
+def question_parts(q: dict) -> Tuple[str, str]:
+    """(prompt, answer side) — the answer side is the correct answer plus the sorted choice texts."""
+    answer = q.get("correct_answer")
+    choice_texts = []
+    choices = q.get("choices")
+    if isinstance(choices, list):
+        for c in choices:
+            if not isinstance(c, dict):
+                continue
+            choice_texts.append(normalize_text(c.get("text")))
+            if c.get("id") == answer:
+                answer = c.get("text", answer)
+    if isinstance(answer, (list, dict)):
+        answer = json.dumps(answer, ensure_ascii=False, sort_keys=True)
+    answer_side = " | ".join([normalize_text(answer)] + sorted(choice_texts))
+    return normalize_text(q.get("prompt")), answer_side
+
+
+def _shingle_hashes(text: str, size: int = SHINGLE_SIZE):
+    if len(text) <= size:
+        yield zlib.crc32(text.encode("utf-8"))
+        return
+    for i in range(len(text) - size + 1):
+        yield zlib.crc32(text[i : i + size].encode("utf-8"))
+
+
+class MinHasher:
+    """
+    One-permutation MinHash: each shingle hash picks a bin by its low bits and the bin keeps the
+    minimum of the remaining bits, so a sketch costs one pass over the shingles instead of one
+    pass per permutation. Empty bins borrow the next non-empty bin (rotation densification).
+    """
+
+    def __init__(self, num_perm: int = NUM_PERM):
+        if num_perm & (num_perm - 1):
+            raise ValueError("num_perm must be a power of two")
+        self.num_perm = num_perm
+        self._mask = num_perm - 1
+        self._shift = num_perm.bit_length() - 1
+
+    def sketch(self, text: str) -> Tuple[int, ...]:
+        k = self.num_perm
+        mins = [_EMPTY] * k
+        for h in _shingle_hashes(text):
+            b = h & self._mask
+            v = h >> self._shift
+            if v < mins[b]:
+                mins[b] = v
+        if _EMPTY in mins:
+            dense = list(mins)
+            for j in range(k):
+                if mins[j] == _EMPTY:
+                    d = 1
+                    while mins[(j + d) % k] == _EMPTY:
+                        d += 1
+                    dense[j] = mins[(j + d) % k] + d * _EMPTY
+            mins = dense
+        return tuple(mins)
+
+
+def similarity(s1: Tuple[int, ...], s2: Tuple[int, ...]) -> float:
+    """
+    Estimated Jaccard similarity, taken as the minimum over the prompt and answer halves:
+    templated prompts ("Расставьте слова в правильном порядке:") are near-identical across
+    unrelated questions, so a near-duplicate has to match on both sides.
+    """
+    half = len(s1) // 2
+    prompt_sim = sum(map(eq, s1[:half], s2[:half])) / half
+    answer_sim = sum(map(eq, s1[half:], s2[half:])) / (len(s1) - half)
+    return min(prompt_sim, answer_sim)
+
+
+class NearDuplicateIndex:
+    """MinHash sketches with LSH buckets; safe to query from worker threads while adding."""
+
+    def __init__(self, num_perm: int = NUM_PERM, bands: int = BANDS, threshold: float = DEFAULT_THRESHOLD):
+        self.hasher = MinHasher(num_perm // 2)
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.items: List[Tuple[Tuple[int, ...], dict]] = []
+        self._buckets: Dict[tuple, List[int]] = {}
+        self.threshold = threshold
+        # block key -> signature -> item id of generated questions claimed but not yet committed.
+        self._pending: Dict[str, Dict[str, int]] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def _band_keys(self, sketch: Tuple[int, ...]):
+        for band in range(self.bands):
+            yield (band,) + sketch[band * self.rows : (band + 1) * self.rows]
+
+    def sketch(self, q: dict) -> Tuple[int, ...]:
+        prompt, answer_side = question_parts(q)
+        return self.hasher.sketch(prompt) + self.hasher.sketch(answer_side)
+
+    def _add_locked(self, sketch: Tuple[int, ...], meta: dict) -> int:
+        item_id = len(self.items)
+        self.items.append((sketch, meta))
+        for key in self._band_keys(sketch):
+            self._buckets.setdefault(key, []).append(item_id)
+        return item_id
+
+    def _remove_locked(self, item_id: int):
+        sketch, _ = self.items[item_id]
+        for key in self._band_keys(sketch):
+            bucket = self._buckets.get(key)
+            if bucket and item_id in bucket:
+                bucket.remove(item_id)
+                if not bucket:
+                    del self._buckets[key]
+        self.items[item_id] = (sketch, None)
+
+    def _candidates_locked(self, sketch: Tuple[int, ...]) -> List[int]:
+        # Bands [0, bands/2) cover the prompt half, the rest the answer half. A templated prompt
+        # collides in every prompt band, so a candidate must collide in both halves.
+        prompt_hits, answer_hits = set(), set()
+        half = self.bands // 2
+        for key in self._band_keys(sketch):
+            (prompt_hits if key[0] < half else answer_hits).update(self._buckets.get(key, ()))
+        return list(prompt_hits & answer_hits)
+
+    def _find_near_locked(self, sketch: Tuple[int, ...]) -> List[Tuple[float, dict]]:
+        matches = []
+        for item_id in self._candidates_locked(sketch):
+            other, meta = self.items[item_id]
+            sim = similarity(sketch, other)
+            if sim >= self.threshold:
+                matches.append((sim, meta))
+        return sorted(matches, key=lambda m: -m[0])
+
+    def add(self, q: dict, meta: dict) -> int:
+        sketch = self.sketch(q)
+        with self._lock:
+            return self._add_locked(sketch, meta)
+
+    def candidates(self, sketch: Tuple[int, ...]) -> List[int]:
+        with self._lock:
+            return self._candidates_locked(sketch)
+
+    def find_near(self, q: dict) -> List[Tuple[float, dict]]:
+        sketch = self.sketch(q)
+        with self._lock:
+            return self._find_near_locked(sketch)
+
+    def claim(self, q: dict, meta: dict) -> Tuple[float, dict] | None:
+        """Add q unless it is a near-duplicate of an indexed question; returns the best match if so."""
+        sketch = self.sketch(q)
+        with self._lock:
+            # Check and add under one lock so concurrent blocks cannot both accept the same rewording.
+            matches = self._find_near_locked(sketch)
+            if matches:
+                return matches[0]
+            item_id = self._add_locked(sketch, meta)
+            if meta.get("source") == SOURCE_GENERATED:
+                self._pending.setdefault(meta["block_key"], {})[meta["signature"]] = item_id
+        return None
+
+    def settle(self, block_key: str, committed_signatures: Iterable[str] = ()) -> int:
+        """Keep the claims of `block_key` that reached the pack and drop the rest; returns how many were dropped."""
+        committed = set(committed_signatures)
+        with self._lock:
+            pending = self._pending.pop(block_key, {})
+            dropped = [item_id for sig, item_id in pending.items() if sig not in committed]
+            for item_id in dropped:
+                self._remove_locked(item_id)
+        return len(dropped)
+
+
+def iter_pack_questions(pack_dir: Path) -> Iterable[Tuple[dict, dict]]:
+    chapters_dir = pack_dir / "chapters"
+    for path in sorted(chapters_dir.glob("*/*.questions.json")) if chapters_dir.exists() else []:
+        try:
+            payload = json.loads(path.read_text(encoding="utf-8"))
+        except Exception:
+            continue
+        rel = path.relative_to(chapters_dir).as_posix()
+        bkey = f"{payload.get('chapter_id', '')}::{payload.get('theory_block_id', '')}"
+        for q in payload.get("questions", []):
+            if isinstance(q, dict):
+                yield q, {
+                    "source": SOURCE_PACK,
+                    "file": rel,
+                    "block_key": bkey,
+                    "question_id": str(q.get("id", "")),
+                    "signature": q.get("signature") or question_signature(q),
+                }
+
+
+def iter_bank_questions(course_root: Path, course: course_index.CourseIndex) -> Iterable[Tuple[dict, dict]]:
+    for chapter in course.chapters():
+        path = course.chapter_path(chapter["id"])
+        try:
+            data = json.loads(path.read_text(encoding="utf-8"))
+        except Exception:
+            continue
+        bank = data.get("question_bank", {}) if isinstance(data.get("question_bank"), dict) else {}
+        rel = path.relative_to(course_root).as_posix()
+        for q in bank.get("questions", []):
+            if isinstance(q, dict):
+                bkey = f"{chapter['id']}::{q.get('theory_block_id', '')}"
+                yield q, {"source": SOURCE_BANK, "file": rel, "block_key": bkey, "question_id": str(q.get("id", ""))}
+
+
+def build_course_index(
+    course_root: Path,
+    course: course_index.CourseIndex | None = None,
+    include_bank: bool = True,
+    threshold: float = DEFAULT_THRESHOLD,
+) -> NearDuplicateIndex:
+    course = course or course_index.load_course_index(course_root)
+    index = NearDuplicateIndex(threshold=threshold)
+    for q, meta in iter_pack_questions(course_root / "training_pack"):
+        index.add(q, meta)
+    if include_bank:
+        for q, meta in iter_bank_questions(course_root, course):
+            index.add(q, meta)
+    return index
+
+
+def find_clusters(index: NearDuplicateIndex) -> List[List[Tuple[int, float]]]:
+    """Groups of near-duplicate items (union-find over confirmed LSH candidate pairs)."""
+    parent = list(range(len(index.items)))
+    best: Dict[int, float] = {}
+
+    def find(x: int) -> int:
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    for item_id, (sketch, meta) in enumerate(index.items):
+        if meta is None:
+            continue
+        for other in index.candidates(sketch):
+            if other <= item_id:
+                continue
+            sim = similarity(sketch, index.items[other][0])
+            if sim < index.threshold:
+                continue
+            best[item_id] = max(best.get(item_id, 0.0), sim)
+            best[other] = max(best.get(other, 0.0), sim)
+            ra, rb = find(item_id), find(other)
+            if ra != rb:
+                parent[max(ra, rb)] = min(ra, rb)
+    groups: Dict[int, List[Tuple[int, float]]] = {}
+    for item_id in best:
+        groups.setdefault(find(item_id), []).append((item_id, best[item_id]))
+    return [sorted(g) for _, g in sorted(groups.items())]
+
+
+def removals_for_cluster(index: NearDuplicateIndex, cluster: List[Tuple[int, float]]) -> List[dict]:
+    # question_bank is curated content and is never touched; it wins over any training_pack copy.
+    # Otherwise the first training_pack item (file order) is kept.
+    metas = [index.items[item_id][1] for item_id, _ in cluster]
+    pack_items = [m for m in metas if m["source"] == SOURCE_PACK]
+    if len(pack_items) == len(metas):
+        return pack_items[1:]
+    return pack_items
+
+
+def apply_removals(pack_dir: Path, removals: List[dict]) -> int:
+    # Match by signature, not by id: the scan ran without the lock, and a concurrent generator
+    # or fill may have renumbered the file's question ids since. Questions with one signature
+    # share a sketch, hence a cluster, whose kept copy is the first in file order: dropping the
+    # last n occurrences of a signature leaves it in place.
+    by_file: Dict[str, Dict[str, int]] = {}
+    for meta in removals:
+        counts = by_file.setdefault(meta["file"], {})
+        counts[meta["signature"]] = counts.get(meta["signature"], 0) + 1
+    removed = 0
+    with pack_io.pack_lock(pack_dir):
+        for rel, counts in sorted(by_file.items()):
+            path = pack_dir / "chapters" / rel
+            payload = json.loads(path.read_text(encoding="utf-8"))
+            questions = payload.get("questions", [])
+            kept = []
+            for q in reversed(questions):
+                sig = (q.get("signature") or question_signature(q)) if isinstance(q, dict) else None
+                if counts.get(sig, 0) > 0:
+                    counts[sig] -= 1
+                    continue
+                kept.append(q)
+            kept.reverse()
+            removed += len(questions) - len(kept)
+            renumber_question_ids(kept)
+            payload["questions"] = kept
+            pack_io.atomic_write_json(path, payload, trailing_newline=False, durable_dir=True)
+    return removed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Find near-duplicate questions (MinHash/LSH) in training_pack and question_bank")
+    parser.add_argument("--course-root", default=".")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="Estimated Jaccard similarity of prompt+answer shingles")
+    parser.add_argument("--pack-only", action="store_true", help="Ignore chapter question_bank questions")
+    parser.add_argument("--apply", action="store_true", help="Remove training_pack near-duplicates (question_bank is never modified)")
+    args = parser.parse_args()
+
+    course_root = Path(args.course_root).resolve()
+    pack_dir = course_root / "training_pack"
+    index = build_course_index(course_root, include_bank=not args.pack_only, threshold=args.threshold)
+    clusters = find_clusters(index)
+    removals = [meta for cluster in clusters for meta in removals_for_cluster(index, cluster)]
+
+    report = {
+        "generated_at": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "threshold": args.threshold,
+        "questions": len(index),
+        "clusters": [
+            [dict(index.items[item_id][1], similarity=round(sim, 3)) for item_id, sim in cluster] for cluster in clusters
+        ],
+        "training_pack_removals": len(removals),
+    }
+    report_path = pack_dir / "reports" / "near-duplicates.json"
+    pack_io.atomic_write_json(report_path, report)
+    print(
+        f"near-duplicates: questions={len(index)}, clusters={len(clusters)}, "
+        f"training_pack removals={len(removals)} (threshold={args.threshold}) -> {report_path}"
+    )
+    if args.apply and removals:
+        removed = apply_removals(pack_dir, removals)
+        print(f"removed from training_pack: {removed}")
+
+
+if __name__ == "__main__":
+    main()
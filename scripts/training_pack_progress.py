@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+"""
+Fill-run progress store (stdlib sqlite3) for fill-training-pack.py.
+
+training_pack/reports/.fill-progress.sqlite keeps one row per fill run and one per finished
+round: block, model, backend, prompt/completion tokens, latency, requested/received/accepted/
+rejected items with reject reasons, requests aborted by the stall watchdog, gain and status. Rows are written by the fill main thread
+only, one short transaction per round, so a killed run loses at most the round in flight.
+
+status_report() answers "how far are we": blocks and questions remaining to --target-valid
+for a chapter/block scope (current counts from the signature index summary, no question JSON
+parsing), valid questions per hour over the last N minutes of rounds and the ETA at that rate.
+"""
+from __future__ import annotations
+
+import json
+import sqlite3
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List
+
+import training_pack_course_index as course_index
+import training_pack_signatures as signature_index
+
+SCHEMA_VERSION = 2
+DEFAULT_WINDOW_MIN = 60
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT PRIMARY KEY,
+    started_at REAL NOT NULL,
+    finished_at REAL,
+    model TEXT,
+    target_valid INTEGER,
+    chapter_number INTEGER,
+    block_number INTEGER
+);
+CREATE TABLE IF NOT EXISTS rounds (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_id TEXT NOT NULL,
+    block_key TEXT NOT NULL,
+    chapter_index INTEGER,
+    block_index INTEGER,
+    model TEXT,
+    backend TEXT,
+    started_at REAL NOT NULL,
+    latency_s REAL,
+    attempts INTEGER,
+    prompt_tokens INTEGER,
+    completion_tokens INTEGER,
+    requested INTEGER,
+    received INTEGER,
+    accepted INTEGER,
+    rejected INTEGER,
+    reject_reasons TEXT,
+    llm_errors INTEGER,
+    stalls INTEGER,
+    gained INTEGER,
+    valid_after INTEGER,
+    status TEXT
+);
+CREATE INDEX IF NOT EXISTS rounds_started ON rounds (started_at);
+CREATE INDEX IF NOT EXISTS rounds_block ON rounds (block_key);
+"""
+
+
+def db_path(pack_dir: Path) -> Path:
+    return pack_dir / "reports" / ".fill-progress.sqlite"
+
+
+def connect(pack_dir: Path) -> sqlite3.Connection:
+    path = db_path(pack_dir)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(path, timeout=30)
+    conn.row_factory = sqlite3.Row
+    # Several fill processes may share one pack: WAL lets readers (--status) run alongside.
+    conn.execute("PRAGMA journal_mode=WAL")
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version not in (0, 1, SCHEMA_VERSION):
+        raise SystemExit(f"{path}: unknown progress schema version {version}")
+    conn.executescript(_SCHEMA)
+    if version == 1:
+        conn.execute("ALTER TABLE rounds ADD COLUMN stalls INTEGER")
+    conn.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+    return conn
+
+
+class ProgressStore:
+    def __init__(self, pack_dir: Path, run_id: str, model: str, target_valid: int, chapter_number: int = 0, block_number: int = 0):
+        self.conn = connect(pack_dir)
+        self.run_id = run_id
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO runs (run_id, started_at, model, target_valid, chapter_number, block_number) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (run_id, time.time(), model, target_valid, chapter_number, block_number),
+            )
+
+    def record_round(
+        self,
+        block_key: str,
+        chapter_index: int,
+        block_index: int,
+        model: str,
+        started_at: float,
+        latency_s: float,
+        result: dict | None,
+        gained: int,
+        valid_after: int,
+        status: str,
+    ):
+        result = result or {}
+        usage = [r for r in result.get("token_usage") or [] if not r.get("cache_hit")]
+        backends = sorted({r["backend"] for r in result.get("token_usage") or [] if r.get("backend")})
+        with self.conn:
+            self.conn.execute(
+                "INSERT INTO rounds (run_id, block_key, chapter_index, block_index, model, backend, started_at, latency_s, "
+                "attempts, prompt_tokens, completion_tokens, requested, received, accepted, rejected, reject_reasons, "
+                "llm_errors, stalls, gained, valid_after, status) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    self.run_id,
+                    block_key,
+                    chapter_index,
+                    block_index,
+                    model,
+                    ",".join(backends) or None,
+                    started_at,
+                    round(latency_s, 3),
+                    int(result.get("attempts", 0)),
+                    sum(r["prompt_tokens"] for r in usage),
+                    sum(r["completion_tokens"] for r in usage),
+                    int(result.get("requested", 0)),
+                    int(result.get("received", 0)),
+                    len(result.get("accepted", [])),
+                    int(result.get("rejected_total", 0)),
+                    json.dumps(result.get("reject_reasons_questions") or {}, ensure_ascii=False),
+                    sum(1 for r in result.get("token_usage") or [] if r.get("error")),
+                    sum(1 for r in result.get("token_usage") or [] if r.get("stall")),
+                    gained,
+                    valid_after,
+                    status,
+                ),
+            )
+
+    def finish(self):
+        with self.conn:
+            self.conn.execute("UPDATE runs SET finished_at = ? WHERE run_id = ?", (time.time(), self.run_id))
+        self.conn.close()
+
+
+def _window_rows(conn: sqlite3.Connection, since: float, block_keys: set) -> List[sqlite3.Row]:
+    rows = conn.execute("SELECT * FROM rounds WHERE started_at + COALESCE(latency_s, 0) >= ?", (since,)).fetchall()
+    return [r for r in rows if r["block_key"] in block_keys]
+
+
+def busy_seconds(intervals: Iterable[tuple]) -> float:
+    """Length of the union of (start, end) intervals: concurrent rounds count once, pauses between runs not at all."""
+    total = 0.0
+    cur_start = cur_end = None
+    for start, end in sorted(intervals):
+        if cur_end is None or start > cur_end:
+            if cur_end is not None:
+                total += cur_end - cur_start
+            cur_start, cur_end = start, end
+        else:
+            cur_end = max(cur_end, end)
+    if cur_end is not None:
+        total += cur_end - cur_start
+    return total
+
+
+def scope_counts(course_root: Path, chapter_number: int = 0, block_number: int = 0) -> Dict[str, int]:
+    """block key -> valid questions for the selected blocks, from the signature index summary."""
+    course = course_index.load_course_index(course_root)
+    index = signature_index.load_signature_index(course_root / "training_pack")
+    valid = {entry.get("block_key"): entry.get("valid", 0) for entry in index.files.values() if entry.get("block_key")}
+    return {f"{c['id']}::{b['id']}": valid.get(f"{c['id']}::{b['id']}", 0) for c, b in course.select(chapter_number, block_number)}
+
+
+def status_report(
+    course_root: Path, target_valid: int, chapter_number: int = 0, block_number: int = 0, window_min: float = DEFAULT_WINDOW_MIN
+) -> dict:
+    counts = scope_counts(course_root, chapter_number, block_number)
+    remaining = {k: target_valid - v for k, v in counts.items() if v < target_valid}
+    deficit = sum(remaining.values())
+    conn = connect(course_root / "training_pack")
+    try:
+        now = time.time()
+        rows = _window_rows(conn, now - window_min * 60, set(counts))
+        last_run = conn.execute("SELECT * FROM runs ORDER BY started_at DESC LIMIT 1").fetchone()
+    finally:
+        conn.close()
+    gained = sum(max(0, r["gained"] or 0) for r in rows)
+    span_s = busy_seconds((r["started_at"], r["started_at"] + (r["latency_s"] or 0)) for r in rows)
+    per_hour = gained / (span_s / 3600) if span_s > 0 else None
+    reasons: Dict[str, int] = {}
+    for r in rows:
+        for reason, n in json.loads(r["reject_reasons"] or "{}").items():
+            reasons[reason] = reasons.get(reason, 0) + n
+    return {
+        "scope": {"chapter_number": chapter_number or None, "block_number": block_number or None, "target_valid": target_valid},
+        "blocks": len(counts),
+        "blocks_remaining": len(remaining),
+        "questions_remaining": deficit,
+        "window_min": window_min,
+        "rounds": len(rows),
+        "gained": gained,
+        "questions_per_hour": round(per_hour, 1) if per_hour is not None else None,
+        "eta_hours": round(deficit / per_hour, 2) if per_hour else (0.0 if deficit == 0 else None),
+        "mean_latency_s": round(sum(r["latency_s"] or 0 for r in rows) / len(rows), 2) if rows else None,
+        "tokens": sum((r["prompt_tokens"] or 0) + (r["completion_tokens"] or 0) for r in rows),
+        "failed_rounds": sum(1 for r in rows if r["status"] == "failed"),
+        "llm_errors": sum(r["llm_errors"] or 0 for r in rows),
+        "stalls": sum(r["stalls"] or 0 for r in rows),
+        "top_reject_reasons": sorted(reasons.items(), key=lambda item: (-item[1], item[0]))[:5],
+        "last_run": dict(last_run) if last_run is not None else None,
+        "weakest_blocks": sorted(((k, counts[k]) for k in remaining), key=lambda item: (item[1], item[0]))[:5],
+    }
+
+
+def format_status(report: dict) -> Iterable[str]:
+    rate = report["questions_per_hour"]
+    eta = report["eta_hours"]
+    yield (
+        f"Блоков: {report['blocks']}, не добрано {report['blocks_remaining']} "
+        f"(не хватает {report['questions_remaining']} вопросов до {report['scope']['target_valid']})"
+    )
+    yield (
+        f"За последние {report['window_min']:g} мин: раундов {report['rounds']}, +{report['gained']} валидных, "
+        f"{rate if rate is not None else '-'} в час, средняя задержка {report['mean_latency_s'] if report['mean_latency_s'] is not None else '-'} с, "
+        f"токенов {report['tokens']}, раундов с ошибкой {report['failed_rounds']}, ошибок LLM {report['llm_errors']}, "
+        f"зависших запросов {report['stalls']}"
+    )
+    run = report["last_run"]
+    if run is not None:
+        state = "завершен" if run["finished_at"] is not None else "идет или прерван"
+        yield f"Последний прогон {run['run_id']} ({run['model']}, цель {run['target_valid']}): {state}"
+    if eta is None:
+        yield "ETA: нет данных о скорости за окно"
+    else:
+        yield f"ETA: {eta:.2f} ч"
+    for reason, n in report["top_reject_reasons"]:
+        yield f"  отклонено {n}: {reason}"
+    for bkey, valid in report["weakest_blocks"]:
+        yield f"  {bkey}: {valid}/{report['scope']['target_valid']}"
+
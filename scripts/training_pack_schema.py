@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Response schema and GBNF grammar for constrained decoding of mcq_single questions.
+
+Both are derived from the rules validate_question() enforces structurally: type=mcq_single,
+non-empty prompt and explanation, exactly 4 choices {id, text} with ids a-d, correct_answer
+one of a-d, difficulty 1..5. Sent with a request (llama.cpp `json_schema`/`grammar`, OpenAI
+`response_format`, Ollama `format`), they make the server sample only tokens that keep the
+answer well-formed, so such rejections stop costing whole LLM calls. Language and content
+checks (Russian prompt, distinct choices) stay with the validator.
+"""
+from __future__ import annotations
+
+import json
+from typing import Dict, List
+
+CHOICE_IDS = ("a", "b", "c", "d")
+
+# validate_question() errors a schema/grammar-constrained answer cannot produce.
+_STRUCTURAL_PREFIXES = (
+    "payload item is not an object",
+    "unsupported type",
+    "empty prompt",
+    "missing correct_answer",
+    "missing explanation",
+    "mcq_single requires choices",
+    "mcq_single allows at most",
+    "choice must be object",
+    "choice missing",
+    "choice ids must",
+    "correct_answer must",
+)
+
+
+def is_structural(reason: str) -> bool:
+    return reason.startswith(_STRUCTURAL_PREFIXES)
+
+
+def question_schema() -> dict:
+    text = {"type": "string", "minLength": 1}
+    choice = {
+        "type": "object",
+        "properties": {"id": {"type": "string", "enum": list(CHOICE_IDS)}, "text": text},
+        "required": ["id", "text"],
+        "additionalProperties": False,
+    }
+    return {
+        "type": "object",
+        "properties": {
+            "type": {"type": "string", "enum": ["mcq_single"]},
+            "prompt": text,
+            "choices": {"type": "array", "items": choice, "minItems": len(CHOICE_IDS), "maxItems": len(CHOICE_IDS)},
+            "correct_answer": {"type": "string", "enum": list(CHOICE_IDS)},
+            "explanation": text,
+            "difficulty": {"type": "integer", "minimum": 1, "maximum": 5},
+        },
+        "required": ["type", "prompt", "choices", "correct_answer", "explanation", "difficulty"],
+        "additionalProperties": False,
+    }
+
+
+def _questions_schema(count: int) -> dict:
+    return {"type": "array", "items": question_schema(), "minItems": 1, "maxItems": max(1, count)}
+
+
+def response_schema(count: int) -> dict:
+    """JSON array of at most `count` questions (single-block request)."""
+    return _questions_schema(count)
+
+
+def batch_response_schema(counts: Dict[str, int]) -> dict:
+    """JSON object {block id: [questions...]} for a batched request."""
+    return {
+        "type": "object",
+        "properties": {bid: _questions_schema(n) for bid, n in counts.items()},
+        "required": list(counts),
+        "additionalProperties": False,
+    }
+
+
+# Shared GBNF rules; llama.cpp grammars are whitespace-insensitive between rules.
+_GBNF_COMMON = r"""
+question ::= "{" ws "\"type\"" ws ":" ws "\"mcq_single\"" ws "," ws "\"prompt\"" ws ":" ws text ws "," ws "\"choices\"" ws ":" ws choices ws "," ws "\"correct_answer\"" ws ":" ws "\"" [a-d] "\"" ws "," ws "\"explanation\"" ws ":" ws text ws "," ws "\"difficulty\"" ws ":" ws [1-5] ws "}"
+choices ::= "[" ws choice-a ws "," ws choice-b ws "," ws choice-c ws "," ws choice-d ws "]"
+choice-a ::= "{" ws "\"id\"" ws ":" ws "\"a\"" ws "," ws "\"text\"" ws ":" ws text ws "}"
+choice-b ::= "{" ws "\"id\"" ws ":" ws "\"b\"" ws "," ws "\"text\"" ws ":" ws text ws "}"
+choice-c ::= "{" ws "\"id\"" ws ":" ws "\"c\"" ws "," ws "\"text\"" ws ":" ws text ws "}"
+choice-d ::= "{" ws "\"id\"" ws ":" ws "\"d\"" ws "," ws "\"text\"" ws ":" ws text ws "}"
+text ::= "\"" char+ "\""
+char ::= [^"\\\x7F\x00-\x1F] | "\\" (["\\/bfnrt] | "u" [0-9a-fA-F] [0-9a-fA-F] [0-9a-fA-F] [0-9a-fA-F])
+ws ::= | " " | "\n" [ \t]{0,20}
+"""
+
+
+def _gbnf_list(name: str, count: int) -> str:
+    # 1..count questions: the first one, then up to count-1 optional ", question".
+    optional = " ".join(['(ws "," ws question'] * (count - 1)) + ")?" * (count - 1) if count > 1 else ""
+    return f'{name} ::= "[" ws question {optional} ws "]"'.replace("  ", " ")
+
+
+def response_grammar(count: int) -> str:
+    return "root ::= ws questions ws\n" + _gbnf_list("questions", max(1, count)) + _GBNF_COMMON
+
+
+def batch_response_grammar(counts: Dict[str, int]) -> str:
+    lines: List[str] = []
+    members = []
+    for i, (bid, n) in enumerate(counts.items()):
+        rule = f"block{i}"
+        members.append(f'{json.dumps(json.dumps(bid))} ws ":" ws {rule}')
+        lines.append(_gbnf_list(rule, max(1, n)))
+    root = 'root ::= ws "{" ws ' + ' ws "," ws '.join(members) + ' ws "}" ws'
+    return "\n".join([root, *lines]) + _GBNF_COMMON
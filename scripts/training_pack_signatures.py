@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+"""
+Global signature index for the training pack.
+
+Maps question signature -> (block key, question id) over every training_pack/chapters file,
+so the generator rejects a question that already exists in another block while it can still
+retry, instead of validate_pack dropping it after the LLM time was spent. Stored in
+training_pack/reports/.signature-index.json with per-file mtime/size: on load only files
+changed by other writers are re-read, and the generator updates its own files in place.
+
+Each file entry doubles as the block's validity summary: number of questions, number of
+valid ones (unique signature and no block_question_errors()) and the sha256 of the file, so
+fill-training-pack.py checks "is this block done?" without parsing question JSON.
+"""
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import threading
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import training_pack_io as pack_io
+from training_pack_validation import block_question_errors, normalize_text
+
+# 2: entries carry the block validity summary (questions, valid, sha256).
+INDEX_VERSION = 2
+
+
+def question_signature(q):
+    correct_answer_id = q.get("correct_answer")
+    correct_answer_text = ""
+    choices = q.get("choices")
+    if isinstance(choices, list) and correct_answer_id is not None:
+        for c in choices:
+            if not isinstance(c, dict):
+                continue
+            if c.get("id") == correct_answer_id:
+                correct_answer_text = c.get("text", "")
+                break
+    if not normalize_text(correct_answer_text):
+        correct_answer_text = correct_answer_id
+
+    parts = [
+        normalize_text(q.get("prompt")),
+        normalize_text(correct_answer_text),
+        normalize_text(q.get("theory_block_id")),
+        normalize_text(q.get("type")),
+    ]
+    return hashlib.sha256("|".join(parts).encode("utf-8")).hexdigest()[:16]
+
+
+def renumber_question_ids(questions: List[dict]):
+    idx = 1
+    for q in questions:
+        if not isinstance(q, dict):
+            continue
+        q["id"] = f"q{idx}"
+        idx += 1
+
+
+def index_path(pack_dir: Path) -> Path:
+    return pack_dir / "reports" / ".signature-index.json"
+
+
+def payload_signatures(payload: dict) -> List[List[str]]:
+    # Same signature source as validate_pack: the stored field, else recomputed.
+    out = []
+    for q in payload.get("questions", []) if isinstance(payload, dict) else []:
+        if isinstance(q, dict):
+            out.append([q.get("signature") or question_signature(q), str(q.get("id", ""))])
+    return out
+
+
+def valid_question_count(payload: dict) -> int:
+    """Valid questions of a block file, each signature counted once (as validate_pack() does within a file)."""
+    if not isinstance(payload, dict):
+        return 0
+    chapter_id, block_id = payload.get("chapter_id", ""), payload.get("theory_block_id", "")
+    seen = set()
+    for q in payload.get("questions", []):
+        if block_question_errors(q, chapter_id, block_id):
+            continue
+        seen.add(q.get("signature") or question_signature(q))
+    return len(seen)
+
+
+def _file_entry(path: Path, payload: dict | None = None) -> dict:
+    stat = path.stat()
+    raw = path.read_bytes()
+    if payload is None:
+        try:
+            payload = json.loads(raw.decode("utf-8"))
+        except Exception:
+            payload = {}
+    block_key = ""
+    if isinstance(payload, dict) and payload.get("chapter_id") and payload.get("theory_block_id"):
+        block_key = f"{payload['chapter_id']}::{payload['theory_block_id']}"
+    questions = payload.get("questions", []) if isinstance(payload, dict) else []
+    return {
+        "mtime_ns": stat.st_mtime_ns,
+        "size": stat.st_size,
+        "sha256": hashlib.sha256(raw).hexdigest(),
+        "block_key": block_key,
+        "questions": len(questions) if isinstance(questions, list) else 0,
+        "valid": valid_question_count(payload),
+        "signatures": payload_signatures(payload),
+    }
+
+
+class SignatureIndex:
+    def __init__(self, pack_dir: Path, files: Dict[str, dict]):
+        self.pack_dir = pack_dir
+        self.files = files
+        self.dirty = False
+        self._lock = threading.Lock()
+        # signature -> {rel: (block_key, question_id)}
+        self._owners: Dict[str, Dict[str, Tuple[str, str]]] = {}
+        for rel, entry in files.items():
+            self._add(rel, entry)
+
+    def _add(self, rel: str, entry: dict):
+        for sig, qid in entry.get("signatures", []):
+            self._owners.setdefault(sig, {})[rel] = (entry.get("block_key", ""), qid)
+
+    def _remove(self, rel: str, entry: dict):
+        for sig, _ in entry.get("signatures", []):
+            owners = self._owners.get(sig)
+            if owners is not None:
+                owners.pop(rel, None)
+                if not owners:
+                    del self._owners[sig]
+
+    def __len__(self) -> int:
+        return len(self._owners)
+
+    def owners(self, sig: str) -> List[Tuple[str, str]]:
+        with self._lock:
+            return list(self._owners.get(sig, {}).values())
+
+    def conflict(self, sig: str, block_key: str) -> Tuple[str, str] | None:
+        """(block key, question id) of the same signature in another block, if any."""
+        with self._lock:
+            for owner in self._owners.get(sig, {}).values():
+                if owner[0] != block_key:
+                    return owner
+        return None
+
+    def summary(self, rel: str) -> dict | None:
+        """Validity summary of one block file as last written or loaded: questions, valid, sha256."""
+        with self._lock:
+            entry = self.files.get(rel)
+            if entry is None:
+                return None
+            return {k: entry[k] for k in ("questions", "valid", "sha256", "block_key")}
+
+    def is_current(self, rel: str) -> bool:
+        """The file on disk is the one this index last saw (same mtime/size, or absent on both sides)."""
+        path = self.pack_dir / "chapters" / rel
+        with self._lock:
+            entry = self.files.get(rel)
+        if not path.exists():
+            return entry is None
+        stat = path.stat()
+        return entry is not None and entry.get("mtime_ns") == stat.st_mtime_ns and entry.get("size") == stat.st_size
+
+    def update_file(self, rel: str, payload: dict | None = None):
+        path = self.pack_dir / "chapters" / rel
+        with self._lock:
+            old = self.files.pop(rel, None)
+            if old is not None:
+                self._remove(rel, old)
+            if path.exists():
+                entry = _file_entry(path, payload)
+                self.files[rel] = entry
+                self._add(rel, entry)
+            self.dirty = True
+
+    def save(self):
+        with self._lock:
+            if not self.dirty:
+                return
+            data = {"version": INDEX_VERSION, "files": self.files}
+            self.dirty = False
+        pack_io.atomic_write_text(index_path(self.pack_dir), json.dumps(data, ensure_ascii=False, separators=(",", ":")))
+
+    def cross_block_duplicates(self) -> int:
+        with self._lock:
+            return sum(1 for owners in self._owners.values() if len({o[0] for o in owners.values()}) > 1)
+
+
+def _pack_files(pack_dir: Path):
+    chapters_dir = pack_dir / "chapters"
+    if not chapters_dir.exists():
+        return []
+    return sorted(chapters_dir.glob("*/*.questions.json"))
+
+
+def load_signature_index(pack_dir: Path, rebuild: bool = False) -> SignatureIndex:
+    """Load the index, re-reading only files whose mtime/size changed (all files with rebuild)."""
+    previous = {}
+    path = index_path(pack_dir)
+    if path.exists() and not rebuild:
+        try:
+            data = json.loads(path.read_text(encoding="utf-8"))
+            if data.get("version") == INDEX_VERSION and isinstance(data.get("files"), dict):
+                previous = data["files"]
+        except Exception:
+            previous = {}
+    files = {}
+    changed = rebuild or not path.exists()
+    chapters_dir = pack_dir / "chapters"
+    # One streaming pass: each file is parsed, reduced to its signatures and dropped.
+    for file_path in _pack_files(pack_dir):
+        rel = file_path.relative_to(chapters_dir).as_posix()
+        old = previous.get(rel)
+        stat = file_path.stat()
+        if old and old.get("mtime_ns") == stat.st_mtime_ns and old.get("size") == stat.st_size:
+            files[rel] = old
+            continue
+        files[rel] = _file_entry(file_path)
+        changed = True
+    if set(previous) - set(files):
+        changed = True
+    index = SignatureIndex(pack_dir, files)
+    index.dirty = changed
+    index.save()
+    return index
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build training_pack/reports/.signature-index.json")
+    parser.add_argument("--course-root", default=".")
+    parser.add_argument("--rebuild", action="store_true", help="Ignore the existing index and re-read every block file")
+    args = parser.parse_args()
+    pack_dir = Path(args.course_root).resolve() / "training_pack"
+    index = load_signature_index(pack_dir, rebuild=args.rebuild)
+    print(
+        f"signature index: files={len(index.files)}, signatures={len(index)}, "
+        f"cross_block_duplicates={index.cross_block_duplicates()} -> {index_path(pack_dir)}"
+    )
+
+
+if __name__ == "__main__":
+    main()
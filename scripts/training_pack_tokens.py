@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+"""
+Token accounting for training pack generation.
+
+estimate_tokens() is a tokenizer-agnostic estimate: Latin words cost about one token per six
+letters, Cyrillic about one per three, digits and punctuation one each, which tracks BPE
+tokenizers of current local models much closer than characters / 4 on the mixed RU/EN
+prompts. TokenCounter can count exactly through llama.cpp /tokenize instead.
+
+Every LLM attempt appends its prompt/completion tokens to training_pack/runs/<stamp>/tokens.jsonl
+(one line per block; a batched request is split between its blocks by requested share), and
+write_cost_report() aggregates all runs into training_pack/reports/token-costs.json per chapter
+and block, so blocks whose theory INPUT inflates prefill can be found and trimmed.
+"""
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import math
+import re
+import threading
+from pathlib import Path
+from typing import Dict, Iterable, List, Tuple
+
+import training_pack_io as pack_io
+
+TOKENS_LOG = "tokens.jsonl"
+METHOD_SERVER = "server"
+METHOD_TOKENIZE = "tokenize"
+METHOD_ESTIMATE = "estimate"
+TOP_BLOCKS = 20
+
+_PIECE_RE = re.compile(r"[A-Za-z]+|\d|[^\W\d_]+|\n\s*|[^\w\s]")
+
+
+def estimate_tokens(text: str) -> int:
+    total = 0
+    for piece in _PIECE_RE.findall(text):
+        ch = piece[0]
+        if ch.isascii() and ch.isalpha():
+            total += math.ceil(len(piece) / 6)
+        elif ch.isalpha():
+            total += math.ceil(len(piece) / 3)
+        else:
+            total += 1
+    return total
+
+
+class TokenCounter:
+    """
+    Exact counts via llama.cpp /tokenize when `llm` is given and supports it, else estimates.
+
+    llm.tokenize() returns None when the server has no /tokenize (exact counting is then off for
+    the process) and raises on transient errors (that text alone is estimated).
+    """
+
+    def __init__(self, llm=None):
+        self.llm = llm
+        self._exact: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def count(self, text: str) -> Tuple[int, str]:
+        if self.llm is not None:
+            key = hashlib.sha1(text.encode("utf-8")).hexdigest()
+            with self._lock:
+                cached = self._exact.get(key)
+            if cached is not None:
+                return cached, METHOD_TOKENIZE
+            try:
+                exact = self.llm.tokenize(text)
+            except Exception:
+                # Timeout, dropped connection, backends ejected for now: estimate this text only.
+                return estimate_tokens(text), METHOD_ESTIMATE
+            if exact is not None:
+                with self._lock:
+                    self._exact[key] = exact
+                return exact, METHOD_TOKENIZE
+            # No /tokenize on this server: do not ask again.
+            self.llm = None
+        return estimate_tokens(text), METHOD_ESTIMATE
+
+
+def attempt_usage(stream_stats: dict, share: float = 1.0) -> dict:
+    """Prompt/completion tokens of one attempt (scaled by `share` for a block of a batched request)."""
+    if stream_stats.get("prompt_tokens") is not None:
+        prompt_tokens = int(stream_stats["prompt_tokens"]) + int(stream_stats.get("cached_prompt_tokens") or 0)
+        method = METHOD_SERVER
+    else:
+        prompt_tokens, method = int(stream_stats.get("prompt_tokens_est") or 0), METHOD_ESTIMATE
+    return {
+        "prompt_tokens": round(prompt_tokens * share),
+        "prompt_tokens_method": method,
+        "prompt_tokens_est": round(int(stream_stats.get("prompt_tokens_est") or 0) * share),
+        "cached_prompt_tokens": round(int(stream_stats.get("cached_prompt_tokens") or 0) * share),
+        "completion_tokens": round(int(stream_stats.get("completion_tokens") or 0) * share),
+        "cache_hit": bool(stream_stats.get("cache_hit")),
+        "backend": stream_stats.get("backend") or None,
+        "stall": stream_stats.get("stall"),
+    }
+
+
+def append_usage(run_dir: Path, records: List[dict]):
+    if not records:
+        return
+    with (run_dir / TOKENS_LOG).open("a", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+def iter_run_usage(run_dir: Path) -> Iterable[dict]:
+    path = run_dir / TOKENS_LOG
+    if not path.exists():
+        return
+    for line in path.read_text(encoding="utf-8").splitlines():
+        try:
+            record = json.loads(line)
+        except Exception:
+            continue
+        if isinstance(record, dict) and record.get("chapter_id") and record.get("block_id"):
+            yield record
+
+
+def iter_usage(pack_dir: Path) -> Iterable[dict]:
+    runs_root = pack_dir / "runs"
+    if not runs_root.exists():
+        return
+    for path in sorted(runs_root.glob(f"*/{TOKENS_LOG}")):
+        yield from iter_run_usage(path.parent)
+
+
+_SUMS = ("attempts", "prompt_tokens", "cached_prompt_tokens", "completion_tokens", "accepted")
+
+
+def _finish(row: dict) -> dict:
+    spent = row["prompt_tokens"] + row["completion_tokens"]
+    row["prompt_tokens_per_attempt"] = round(row["prompt_tokens"] / row["attempts"], 1) if row["attempts"] else None
+    row["tokens_per_accepted"] = round(spent / row["accepted"], 1) if row["accepted"] else None
+    return row
+
+
+def build_cost_report(records: Iterable[dict]) -> dict:
+    chapters: Dict[str, dict] = {}
+    server_prompt = server_est = cache_hits = 0
+    for r in records:
+        if r.get("cache_hit"):
+            # Served from the response cache: no tokens were spent.
+            cache_hits += 1
+            continue
+        chapter = chapters.setdefault(r["chapter_id"], dict({k: 0 for k in _SUMS}, index=r.get("chapter_index"), blocks={}))
+        block = chapter["blocks"].setdefault(r["block_id"], dict({k: 0 for k in _SUMS}, index=r.get("block_index")))
+        for row in (chapter, block):
+            row["attempts"] += 1
+            for key in _SUMS[1:]:
+                row[key] += int(r.get(key) or 0)
+        if r.get("spec_tokens") is not None:
+            block["spec_tokens"] = r["spec_tokens"]
+            block["spec_tokens_method"] = r.get("spec_tokens_method", METHOD_ESTIMATE)
+        if r.get("prompt_tokens_method") == METHOD_SERVER and r.get("prompt_tokens_est"):
+            server_prompt += int(r["prompt_tokens"])
+            server_est += int(r["prompt_tokens_est"])
+    blocks = []
+    for chapter_id, chapter in chapters.items():
+        _finish(chapter)
+        for block_id, block in chapter["blocks"].items():
+            _finish(block)
+            blocks.append(dict(block, chapter_id=chapter_id, block_id=block_id))
+    # Theory INPUT is the part of the prompt a block controls; batched prompt shares come second.
+    heaviest = sorted(blocks, key=lambda b: (-(b.get("spec_tokens") or 0), -(b["prompt_tokens_per_attempt"] or 0)))[:TOP_BLOCKS]
+    return {
+        "attempts": sum(c["attempts"] for c in chapters.values()),
+        "cache_hits": cache_hits,
+        "prompt_tokens": sum(c["prompt_tokens"] for c in chapters.values()),
+        "completion_tokens": sum(c["completion_tokens"] for c in chapters.values()),
+        "accepted": sum(c["accepted"] for c in chapters.values()),
+        # Server-counted / estimated prompt tokens: how far off estimate_tokens() is for this model.
+        "estimate_ratio": round(server_prompt / server_est, 3) if server_est else None,
+        "heaviest_prefill_blocks": [
+            {k: b.get(k) for k in ("chapter_id", "block_id", "prompt_tokens_per_attempt", "spec_tokens", "tokens_per_accepted")}
+            for b in heaviest
+        ],
+        "chapters": dict(sorted(chapters.items(), key=lambda item: (item[1]["index"] or 0, item[0]))),
+    }
+
+
+def cost_report_path(pack_dir: Path) -> Path:
+    return pack_dir / "reports" / "token-costs.json"
+
+
+def write_cost_report(pack_dir: Path) -> dict:
+    report = build_cost_report(iter_usage(pack_dir))
+    pack_io.atomic_write_json(cost_report_path(pack_dir), report)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Aggregate training_pack/runs/*/tokens.jsonl into reports/token-costs.json")
+    parser.add_argument("--course-root", default=".")
+    parser.add_argument("--top", type=int, default=10, help="Show the N blocks with the largest theory INPUT")
+    args = parser.parse_args()
+    pack_dir = Path(args.course_root).resolve() / "training_pack"
+    report = write_cost_report(pack_dir)
+    print(
+        f"token costs: attempts={report['attempts']}, prompt={report['prompt_tokens']}, "
+        f"completion={report['completion_tokens']}, accepted={report['accepted']}, "
+        f"estimate ratio={report['estimate_ratio']} -> {cost_report_path(pack_dir)}"
+    )
+    for b in report["heaviest_prefill_blocks"][: args.top]:
+        print(
+            f"  {b['chapter_id']}::{b['block_id']}: prompt/attempt={b['prompt_tokens_per_attempt']}, "
+            f"INPUT={b['spec_tokens']}, tokens/accepted={b['tokens_per_accepted']}"
+        )
+
+
+if __name__ == "__main__":
+    main()
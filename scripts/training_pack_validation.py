@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Question validation rules for the training pack.
+
+validate_question() is the single definition of a valid mcq_single question: the generator
+accepts LLM output with it, validate_pack() checks pack files with it, and the per-block
+summary in the signature index counts a block's valid questions with block_question_errors()
+(the same rules, plus the question must belong to that very block).
+"""
+from __future__ import annotations
+
+import re
+from typing import List
+
+SUPPORTED_TYPES = {"mcq_single"}
+CHOICE_IDS = {"a", "b", "c", "d"}
+
+
+def normalize_text(v):
+    if v is None:
+        return ""
+    t = str(v).strip().lower()
+    t = re.sub(r"[\"'`´«»„“”‘’‚‛‹›]", "", t)
+    return " ".join(t.split())
+
+
+def has_cyrillic(text: str) -> bool:
+    for ch in text:
+        code = ord(ch)
+        if 0x0400 <= code <= 0x04FF:
+            return True
+    return False
+
+
+def validate_question(q: dict, chapter_id: str, theory_block_ids: set) -> List[str]:
+    errors = []
+    if q.get("type") not in SUPPORTED_TYPES:
+        errors.append(f"unsupported type={q.get('type')}, only mcq_single is allowed")
+    if not normalize_text(q.get("prompt", "")):
+        errors.append("empty prompt")
+    elif not has_cyrillic(str(q.get("prompt", ""))):
+        errors.append("prompt must contain Russian text (cyrillic)")
+    if "correct_answer" not in q:
+        errors.append("missing correct_answer")
+    if not normalize_text(q.get("explanation", "")):
+        errors.append("missing explanation")
+    elif not has_cyrillic(str(q.get("explanation", ""))):
+        errors.append("explanation must contain Russian text (cyrillic)")
+    choices = q.get("choices")
+    if not isinstance(choices, list) or len(choices) < 2:
+        errors.append("mcq_single requires choices with at least 2 options")
+    else:
+        norm_choice_texts = []
+        choice_ids = []
+        for c in choices:
+            if not isinstance(c, dict):
+                errors.append("choice must be object")
+                continue
+            cid = c.get("id")
+            ctext = c.get("text")
+            if not normalize_text(cid):
+                errors.append("choice missing id")
+            if not normalize_text(ctext):
+                errors.append("choice missing text")
+            norm_choice_texts.append(normalize_text(ctext))
+            choice_ids.append(cid)
+        if len(choices) > 4:
+            errors.append("mcq_single allows at most 4 choices")
+        if len(set(choice_ids)) != len(choice_ids):
+            errors.append("choice ids must be unique")
+        if not set(choice_ids).issubset(CHOICE_IDS):
+            errors.append("choice ids must be within a,b,c,d")
+        if "correct_answer" in q and q.get("correct_answer") not in choice_ids:
+            errors.append("correct_answer must reference choices[].id")
+        elif "correct_answer" in q and q.get("correct_answer") not in CHOICE_IDS:
+            errors.append("correct_answer must be one of a,b,c,d")
+        if len(set(norm_choice_texts)) != len(norm_choice_texts):
+            errors.append("duplicate choices by text are not allowed")
+    block_id = q.get("theory_block_id")
+    if not block_id:
+        errors.append("missing theory_block_id")
+    elif block_id not in theory_block_ids:
+        errors.append(f"unknown theory_block_id={block_id}")
+    if q.get("chapter_id") and q.get("chapter_id") != chapter_id:
+        errors.append(f"chapter_id mismatch: {q.get('chapter_id')} != {chapter_id}")
+    return errors
+
+
+def block_question_errors(q, chapter_id: str, block_id: str) -> List[str]:
+    """validate_question() for a question stored in the file of block `block_id`."""
+    if not isinstance(q, dict):
+        return ["payload item is not an object"]
+    errors = validate_question(q, chapter_id, {block_id})
+    if not q.get("chapter_id"):
+        errors.append("missing chapter_id")
+    return errors
@@ -4,18 +4,25 @@ import json
 import posixpath
 import re
 import subprocess
+import sys
 import urllib.parse
 from http import HTTPStatus
 from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
 
+SCRIPTS_DIR = Path(__file__).resolve().parent.parent / "scripts"
+if str(SCRIPTS_DIR) not in sys.path:
+    sys.path.insert(0, str(SCRIPTS_DIR))
+
+import training_pack_io as pack_io  # noqa: E402
+
 
 def read_json(path: Path):
     return json.loads(path.read_text(encoding="utf-8"))
 
 
 def write_json(path: Path, payload):
-    path.write_text(json.dumps(payload, ensure_ascii=False, indent=2) + "\n", encoding="utf-8")
+    pack_io.atomic_write_json(path, payload, durable_dir=True)
 
 
 def sanitize_rel_path(raw: str) -> str:
@@ -274,17 +281,19 @@ class TrainingPackStore:
 
     def delete_question(self, rel_file: str, question_id: str):
         p = self._resolve_pack_rel_file(rel_file)
-        payload = read_json(p)
-        questions = payload.get("questions", [])
-        if not isinstance(questions, list):
-            raise ValueError("questions is not a list")
-        before = len(questions)
-        kept = [q for q in questions if str(q.get("id", "")) != str(question_id)]
-        removed = before - len(kept)
-        if removed <= 0:
-            raise KeyError(f"question not found: {question_id}")
-        payload["questions"] = kept
-        write_json(p, payload)
+        # Generators append to the same files: read-modify-write under the pack lock.
+        with pack_io.pack_lock(self.pack_root):
+            payload = read_json(p)
+            questions = payload.get("questions", [])
+            if not isinstance(questions, list):
+                raise ValueError("questions is not a list")
+            before = len(questions)
+            kept = [q for q in questions if str(q.get("id", "")) != str(question_id)]
+            removed = before - len(kept)
+            if removed <= 0:
+                raise KeyError(f"question not found: {question_id}")
+            payload["questions"] = kept
+            write_json(p, payload)
         return {"removed": removed, "remaining": len(kept)}
 
 